@@ -0,0 +1,1001 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for riptube.
+
+Each benchmark is a command, which can be run with
+python3 benchmark.py <command>. Run python3 benchmark.py --help for
+the list of commands, and their options.
+
+This module has the same license as riptube.py.
+"""
+
+import argparse
+import datetime
+import gc
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+import riptube
+
+def best_time(function, repeat):
+    """
+    Call a function a number of times, and return the shortest time it
+    took in seconds.
+    """
+    time_list = []
+
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        time_list.append(time.perf_counter() - start_time)
+
+    return min(time_list)
+
+def print_rate(name, byte_count, seconds):
+    print("{:<45} {:>10.1f} MiB/s".format(
+        name,
+        byte_count / seconds / 1024 / 1024
+    ))
+
+def old_copy_loop(source, filename):
+    """
+    Copy a source into a file with 8 KiB reads, like download_to_file did
+    before copy_to_file was written.
+    """
+    with open(filename, "wb") as out_file:
+        shutil.copyfileobj(source, out_file, 1024 * 8)
+
+def benchmark_copy(args):
+    """
+    Compare copy_to_file with different transfer options against
+    the old copy loop, copying from memory to a file on disk.
+    """
+    size = args.size * 1024 * 1024
+    data = os.urandom(size)
+    filename = os.path.join(args.directory, "riptube-benchmark.tmp")
+
+    def run_old():
+        old_copy_loop(io.BytesIO(data), filename)
+
+    def run_new(transfer_options, hash_algorithm= None):
+        with open(filename, "wb") as out_file:
+            riptube.allocate_file(
+                out_file,
+                size,
+                transfer_options.preallocate
+            )
+
+        riptube.copy_to_file(
+            io.BytesIO(data),
+            filename,
+            0,
+            size,
+            transfer_options,
+            hasher= hashlib.new(hash_algorithm) if hash_algorithm else None
+        )
+
+    case_list = [
+        ("{} KiB buffer".format(buffer_size // 1024), riptube.TransferOptions(
+            buffer_size= buffer_size,
+            preallocate= False
+        ), None)
+        for buffer_size in (1024 * 64, riptube.COPY_BUFFER_SIZE, 1024 * 1024)
+    ]
+    case_list.append((
+        "default options",
+        riptube.DEFAULT_TRANSFER_OPTIONS,
+        None
+    ))
+    case_list.append((
+        "default options, sync every 16 MiB",
+        riptube.TransferOptions(sync_interval= 1024 * 1024 * 16),
+        None
+    ))
+
+    if riptube.DIRECT_IO_SUPPORTED:
+        case_list.append((
+            "default options, O_DIRECT",
+            riptube.TransferOptions(direct_io= True),
+            None
+        ))
+
+    for hash_algorithm in riptube.HASH_ALGORITHMS:
+        case_list.append((
+            "default options, {} hash".format(hash_algorithm),
+            riptube.DEFAULT_TRANSFER_OPTIONS,
+            hash_algorithm
+        ))
+
+    print("Copying {} MiB into {}".format(args.size, args.directory))
+
+    try:
+        print_rate(
+            "old copy loop, 8 KiB reads",
+            size,
+            best_time(run_old, args.repeat)
+        )
+
+        for name, transfer_options, hash_algorithm in case_list:
+            print_rate(
+                "copy_to_file, " + name,
+                size,
+                best_time(
+                    lambda: run_new(transfer_options, hash_algorithm),
+                    args.repeat
+                )
+            )
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+def make_records(module, count):
+    """
+    Make lists of FeedItem and DownloadInfo objects, like the ones held for
+    a large channel.
+    """
+    upload_time = datetime.datetime(2013, 1, 1, 10, 0, 0)
+    media_type = module.ITAG_MAP[22]
+
+    feed_item_list = [
+        module.FeedItem(
+            "vid{:08d}".format(i),
+            upload_time + datetime.timedelta(seconds= i),
+            "Title {}".format(i),
+            "Description {}".format(i),
+        )
+        for i in range(count)
+    ]
+    option_list = [
+        module.DownloadInfo(
+            media_type,
+            "https://example.com/videoplayback?id={}".format(i)
+        )
+        for i in range(count)
+    ]
+
+    return feed_item_list, option_list
+
+def measure_records(module, count):
+    """
+    Return a list of (name, value, unit) results for the memory used for
+    each record, and the time for reading attributes from them.
+    """
+    result_list = []
+
+    for index, name in enumerate(("FeedItem", "DownloadInfo")):
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        record_list = make_records(module, count)[index]
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        # Only count the records themselves, not the strings in them.
+        string_size = sum(
+            sum(
+                sys.getsizeof(value)
+                for value in (
+                    (record.video_id, record.upload_time, record.title,
+                        record.description)
+                    if name == "FeedItem" else
+                    (record.url,)
+                )
+            )
+            for record in record_list
+        )
+
+        result_list.append((
+            "{} bytes each".format(name),
+            float(after - before - string_size) / count,
+            "bytes"
+        ))
+
+        del record_list
+
+    feed_item_list, option_list = make_records(module, 1000)
+    media_type = module.ITAG_MAP[22]
+
+    for name, statement, namespace in (
+        (
+            "FeedItem.video_id",
+            "for x in items: x.video_id",
+            {"items": feed_item_list},
+        ),
+        (
+            "DownloadInfo.media_type",
+            "for x in items: x.media_type",
+            {"items": option_list},
+        ),
+        (
+            "MediaType.resolution",
+            "for x in items: media_type.resolution",
+            {"items": option_list, "media_type": media_type},
+        ),
+        (
+            "MediaType.itag",
+            "for x in items: media_type.itag",
+            {"items": option_list, "media_type": media_type},
+        ),
+    ):
+        seconds = min(timeit.repeat(
+            statement,
+            globals= namespace,
+            number= 100,
+            repeat= 5
+        ))
+
+        result_list.append((
+            name,
+            seconds / (100 * 1000) * 1e9,
+            "ns"
+        ))
+
+    return result_list
+
+def benchmark_records(args):
+    """
+    Measure the memory used by FeedItem and DownloadInfo objects, and
+    the time for reading their attributes.
+    """
+    print("Making {} of each record".format(args.count))
+
+    for name, value, unit in measure_records(riptube, args.count):
+        print("{:<45} {:>10.1f} {}".format(name, value, unit))
+
+# The username for the feed served by the stand-in server.
+STAND_IN_USERNAME = "benchmark"
+
+# The itags of the media served by the stand-in server. The joined 720p
+# stream is the best content, unless split tracks are served, in which case
+# the 1080p video track and the audio track are.
+STREAM_MAP_ITAGS = (18, 22)
+HLS_ITAGS = (34, 35)
+DASH_ITAGS = (133, 134, 135, 140)
+SPLIT_DASH_ITAGS = (137,)
+
+def stand_in_video_id(index):
+    return "bench{:06d}".format(index)
+
+def make_feed_page(start_index, max_results, video_count, with_total):
+    """
+    Make the JSON for a page of the uploads feed, like the gdata API.
+    """
+    start_time = datetime.datetime(2013, 1, 1)
+
+    entry_list = [
+        {
+            "id": {"$t": "tag:youtube.com,2008:video:{}".format(
+                stand_in_video_id(index)
+            )},
+            "published": {"$t": (
+                start_time - datetime.timedelta(hours= index)
+            ).strftime("%Y-%m-%dT%H:%M:%S.000Z")},
+            "title": {"$t": "Benchmark video {}".format(index)},
+            "media$group": {"media$description": {
+                "$t": "A description of a video for the benchmark. " * 20
+            }},
+        }
+        for index in range(
+            start_index - 1,
+            min(start_index - 1 + max_results, video_count)
+        )
+    ]
+
+    feed = {"entry": entry_list} if entry_list else {}
+
+    if with_total:
+        feed["openSearch$totalResults"] = {"$t": video_count}
+
+    return json.dumps({"version": "1.0", "feed": feed}).encode()
+
+def make_video_info(host, video_id, length_seconds):
+    """
+    Make the urlencoded text for get_video_info.
+    """
+    # riptube reads the fields of every format in the stream map as lists.
+    stream_map = "&".join(
+        urlencode((
+            ("itag", itag),
+            ("url", "{}/media/{}/{}?expire={}".format(
+                host,
+                video_id,
+                itag,
+                int(time.time()) + 3600
+            )),
+            ("sig", "0123456789ABCDEF"),
+            ("fallback_host", "localhost"),
+        ))
+        for itag in STREAM_MAP_ITAGS
+    )
+
+    return urlencode((
+        ("status", "ok"),
+        ("length_seconds", length_seconds),
+        ("url_encoded_fmt_stream_map", stream_map),
+        ("hlsvp", "{}/hls/{}.m3u8".format(host, video_id)),
+        ("dashmpd", "{}/dash/{}.mpd".format(host, video_id)),
+    )).encode()
+
+def make_hls_playlist(host, video_id):
+    """
+    Make an .m3u playlist for the HLS formats.
+    """
+    line_list = ["#EXTM3U"]
+
+    for itag in HLS_ITAGS:
+        line_list.append("#EXT-X-STREAM-INF:BANDWIDTH=1000000")
+        line_list.append("{}/media/{}/{}/itag/{}/index.m3u8".format(
+            host,
+            video_id,
+            itag,
+            itag
+        ))
+
+    return "\n".join(line_list).encode()
+
+def make_dash_document(host, video_id, itag_list, size_dict, segment_count):
+    """
+    Make a DASH document, with a SegmentList of 'segment_count' segments
+    for each Representation.
+    """
+    representation_list = []
+
+    for itag in itag_list:
+        size = size_dict[itag]
+        segment_size = max(size // segment_count, 1)
+
+        representation_list.append(
+            '<Representation id="{}" bandwidth="{}">'
+            '<BaseURL yt:contentLength="{}">{}/media/{}/{}</BaseURL>'
+            '<SegmentList>{}</SegmentList>'
+            '</Representation>'.format(
+                itag,
+                size * 8 // 60,
+                size,
+                host,
+                video_id,
+                itag,
+                "".join(
+                    '<SegmentURL media="sq/{}" mediaRange="{}-{}"/>'.format(
+                        index,
+                        start,
+                        min(start + segment_size, size) - 1
+                    )
+                    for index, start in enumerate(
+                        range(0, size, segment_size)
+                    )
+                )
+            )
+        )
+
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<MPD xmlns="urn:mpeg:DASH:schema:MPD:2011" '
+        'xmlns:yt="http://youtube.com/yt/2012/10/10">'
+        '<Period><AdaptationSet>{}</AdaptationSet></Period></MPD>'.format(
+            "".join(representation_list)
+        )
+    ).encode()
+
+def make_split_media(directory, size, seconds):
+    """
+    Make a video track and an audio track with ffmpeg, with about 'size'
+    bytes of video, and return the data for both.
+    """
+    video_filename = os.path.join(directory, "video.mp4")
+    audio_filename = os.path.join(directory, "audio.m4a")
+
+    with open(os.devnull, "wb") as null_out:
+        subprocess.check_call((
+            "ffmpeg", "-y",
+            "-f", "lavfi", "-i", "testsrc=size=1920x1080:rate=30",
+            "-t", str(seconds),
+            "-c:v", "mpeg4", "-b:v", str(size * 8 // seconds),
+            video_filename
+        ), stdout= null_out, stderr= null_out)
+        subprocess.check_call((
+            "ffmpeg", "-y",
+            "-f", "lavfi", "-i", "sine",
+            "-t", str(seconds),
+            "-c:a", "aac",
+            audio_filename
+        ), stdout= null_out, stderr= null_out)
+
+    result_list = []
+
+    for filename in (video_filename, audio_filename):
+        with open(filename, "rb") as media_file:
+            result_list.append(media_file.read())
+
+        os.remove(filename)
+
+    return result_list
+
+RANGE_REGEX = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+class StandInHandler (BaseHTTPRequestHandler):
+    """
+    This handler answers the requests riptube makes, like YouTube would,
+    after the server's latency, and sends bodies at the server's bandwidth.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, data, content_type, code= 200, header_list= (),
+    cut_after= None):
+        """
+        Send a response. If cut_after is set, the connection is closed
+        after that many bytes of the body, like a download which fails.
+        """
+        server = self.server
+
+        time.sleep(server.latency)
+
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+
+        for name, value in header_list:
+            self.send_header(name, value)
+
+        self.end_headers()
+
+        view = memoryview(data)
+        start_time = time.time()
+        sent_count = 0
+
+        while sent_count < len(view):
+            if cut_after is not None and sent_count >= cut_after:
+                self.close_connection = True
+                break
+
+            chunk = view[sent_count:sent_count + 1024 * 64]
+            self.wfile.write(chunk)
+            sent_count += len(chunk)
+
+            if server.bandwidth is not None:
+                delay = start_time + sent_count / server.bandwidth \
+                    - time.time()
+
+                if delay > 0:
+                    time.sleep(delay)
+
+        with server.lock:
+            server.byte_count += sent_count
+
+    def send_media(self, data):
+        match = RANGE_REGEX.match(self.headers.get("Range") or "")
+
+        if match is None:
+            return self.send_body(
+                data,
+                "video/mp4",
+                cut_after= self.server.cut_after
+            )
+
+        start = int(match.group(1))
+        end = min(
+            int(match.group(2)) if match.group(2) else len(data) - 1,
+            len(data) - 1
+        )
+
+        if start >= len(data):
+            return self.send_body(b"", "text/plain", 416)
+
+        self.send_body(data[start:end + 1], "video/mp4", 206, (
+            ("Content-Range", "bytes {}-{}/{}".format(
+                start,
+                end,
+                len(data)
+            )),
+        ), self.server.cut_after)
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        path_list = url.path.strip("/").split("/")
+
+        if url.path.startswith("/feeds/api/users/"):
+            self.send_body(make_feed_page(
+                int(query["start-index"][0]),
+                int(query["max-results"][0]),
+                server.video_count,
+                "openSearch:totalResults" in query["fields"][0]
+            ), "application/json")
+        elif url.path == "/get_video_info" \
+        and query["video_id"][0] in server.removed_video_ids:
+            self.send_body(urlencode((
+                ("status", "fail"),
+                ("errorcode", 100),
+                ("reason", "This video has been removed."),
+            )).encode(), "application/x-www-form-urlencoded")
+        elif url.path == "/get_video_info":
+            self.send_body(make_video_info(
+                server.host,
+                query["video_id"][0],
+                server.length_seconds
+            ), "application/x-www-form-urlencoded")
+        elif path_list[0] == "hls":
+            self.send_body(make_hls_playlist(
+                server.host,
+                path_list[1].split(".")[0]
+            ), "application/x-mpegURL")
+        elif path_list[0] == "dash":
+            self.send_body(make_dash_document(
+                server.host,
+                path_list[1].split(".")[0],
+                server.dash_itags,
+                server.size_dict,
+                server.dash_segments
+            ), "video/vnd.mpeg.dash.mpd")
+        elif path_list[0] == "media" \
+        and path_list[1] in server.removed_video_ids:
+            self.send_body(b"Not found", "text/plain", 404)
+        elif path_list[0] == "media":
+            self.send_media(server.media_dict.get(
+                int(path_list[2]),
+                server.media_dict[None]
+            ))
+        else:
+            self.send_body(b"Not found", "text/plain", 404)
+
+class StandInServer (ThreadingHTTPServer):
+    """
+    This server stands in for the YouTube services riptube uses, on
+    localhost, serving a feed of 'video_count' videos. Joined media is
+    'size' bytes of random data, and split tracks are made with ffmpeg.
+    Every response waits for 'latency' seconds, and bodies are sent at
+    no more than 'bandwidth' bytes per second for each connection.
+
+    Videos with IDs in removed_video_ids are answered like videos which
+    were taken down. If cut_after is set, media responses are cut off
+    after that many bytes.
+    """
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, video_count, size, latency= 0.0, bandwidth= None,
+    split= False, dash_segments= 1, length_seconds= 60):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+
+        self.host = "http://127.0.0.1:{}".format(self.server_address[1])
+        self.video_count = video_count
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.dash_segments = dash_segments
+        self.length_seconds = length_seconds
+        self.removed_video_ids = set()
+        self.cut_after = None
+        self.lock = threading.Lock()
+        self.byte_count = 0
+
+        self.media_dict = {None: os.urandom(size)}
+
+        if split:
+            temp_directory = tempfile.mkdtemp()
+
+            try:
+                self.media_dict[137], self.media_dict[140] = \
+                    make_split_media(temp_directory, size, 10)
+            finally:
+                shutil.rmtree(temp_directory)
+
+            self.dash_itags = DASH_ITAGS + SPLIT_DASH_ITAGS
+        else:
+            self.dash_itags = DASH_ITAGS
+
+        self.size_dict = {
+            itag: len(self.media_dict.get(itag, self.media_dict[None]))
+            for itag in self.dash_itags
+        }
+
+    def start(self):
+        """
+        Serve requests in a background thread, and point riptube at
+        the server.
+        """
+        thread = threading.Thread(target= self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        riptube.API_URL = self.host + "/feeds/api"
+        riptube.INFO_URL = self.host + "/get_video_info"
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on purpose, like when a download is stopped.
+        pass
+
+class PhaseTimes (object):
+    """
+    This object times the calls to functions in riptube, for the phases
+    of the download path, while it is used as a context manager.
+    """
+    def __init__(self, phase_list):
+        # A list of (phase name, function name) pairs.
+        self.phase_list = phase_list
+        self.time_dict = {name: [] for name, function_name in phase_list}
+        self.__lock = threading.Lock()
+        self.__original_list = []
+
+    def __timed(self, name, function):
+        def timed_function(*args, **kwargs):
+            start_time = time.perf_counter()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self.__lock:
+                    self.time_dict[name].append(
+                        time.perf_counter() - start_time
+                    )
+
+        return timed_function
+
+    def __enter__(self):
+        for name, function_name in self.phase_list:
+            function = getattr(riptube, function_name)
+            self.__original_list.append((function_name, function))
+            setattr(riptube, function_name, self.__timed(name, function))
+
+        return self
+
+    def __exit__(self, *args):
+        for function_name, function in self.__original_list:
+            setattr(riptube, function_name, function)
+
+        self.__original_list = []
+
+    def print_summary(self):
+        print("{:<12} {:>6} {:>10} {:>10} {:>10}".format(
+            "Phase", "Calls", "Mean ms", "p50 ms", "p95 ms"
+        ))
+
+        for name, function_name in self.phase_list:
+            time_list = sorted(self.time_dict[name])
+
+            if not time_list:
+                continue
+
+            print("{:<12} {:>6} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                name,
+                len(time_list),
+                sum(time_list) / len(time_list) * 1000,
+                time_list[len(time_list) // 2] * 1000,
+                time_list[min(
+                    int(len(time_list) * 0.95),
+                    len(time_list) - 1
+                )] * 1000
+            ))
+
+def benchmark_download(args):
+    """
+    Download a feed of videos from a local stand-in server, and report
+    the videos per hour, bytes per second and the time for each phase.
+    """
+    server = StandInServer(
+        args.videos,
+        args.size * 1024 * 1024,
+        args.latency,
+        riptube.parse_byte_rate(args.bandwidth),
+        args.split,
+        args.dash_segments
+    )
+    server.start()
+
+    riptube.RATE_CONTROLLER.max_rate = args.max_request_rate
+
+    output_directory = tempfile.mkdtemp(dir= args.directory)
+
+    print("Downloading {} videos of {} MiB, latency {}s, bandwidth {}".format(
+        args.videos,
+        args.size,
+        args.latency,
+        args.bandwidth
+    ))
+
+    try:
+        start_time = time.perf_counter()
+        feed_item_list = list(riptube.user_videos(STAND_IN_USERNAME))
+        feed_seconds = time.perf_counter() - start_time
+
+        print("Read the feed of {} videos in {:.3f}s".format(
+            len(feed_item_list),
+            feed_seconds
+        ))
+
+        phase_times = PhaseTimes((
+            ("info", "download_info_for_feed_item"),
+            ("fetch", "fetch_feed_item"),
+            ("mux", "mux_feed_item"),
+            ("write", "finalize_feed_item"),
+        ))
+
+        start_time = time.perf_counter()
+
+        with phase_times:
+            riptube.download_videos_for_user(
+                STAND_IN_USERNAME,
+                output_directory,
+                jobs= args.jobs,
+                mux_jobs= args.mux_jobs,
+                transfer_options= riptube.TransferOptions(
+                    segment_count= args.segments,
+                    stream_mux= args.stream_mux,
+                    hash_algorithm=
+                        args.hash if args.hash != "none" else None
+                )
+            )
+
+        seconds = time.perf_counter() - start_time
+
+        byte_count = sum(
+            os.path.getsize(os.path.join(directory, filename))
+            for directory, _, filename_list in os.walk(output_directory)
+            for filename in filename_list
+            if not filename.endswith(".json")
+        )
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(output_directory)
+
+    print("Downloaded {:.1f} MiB in {:.2f}s".format(
+        byte_count / 1024 / 1024,
+        seconds
+    ))
+    print("{:<45} {:>10.0f}".format(
+        "Videos per hour",
+        args.videos / seconds * 3600
+    ))
+    print_rate("Bytes per second", byte_count, seconds)
+    phase_times.print_summary()
+
+def benchmark_parsers(args):
+    """
+    Time the parsers for feed pages, video info, HLS playlists and DASH
+    documents, on documents like the ones the stand-in server makes.
+    """
+    host = "http://127.0.0.1:1"
+    video_id = stand_in_video_id(0)
+    feed_data = make_feed_page(1, riptube.MAX_RESULTS, 1000, True)
+    info_data = make_video_info(host, video_id, 60)
+    hls_data = make_hls_playlist(host, video_id)
+    dash_data = make_dash_document(
+        host,
+        video_id,
+        DASH_ITAGS + SPLIT_DASH_ITAGS,
+        {itag: 1024 * 1024 * 100 for itag in DASH_ITAGS + SPLIT_DASH_ITAGS},
+        args.dash_segments
+    )
+
+    def parse_feed():
+        return tuple(riptube.iter_feed_page(
+            feed_data[start:start + riptube.FEED_READ_SIZE]
+            for start in range(0, len(feed_data), riptube.FEED_READ_SIZE)
+        ))
+
+    def parse_feed_whole():
+        return riptube.feed_items_from_page_data(feed_data)
+
+    def parse_info():
+        return tuple(riptube.download_options_from_stream_map(
+            riptube.parse_video_info("", info_data.decode())
+        ))
+
+    def parse_hls():
+        return tuple(riptube.download_options_from_hls_playlist(
+            hls_data.decode()
+        ))
+
+    def parse_dash():
+        return tuple(riptube.download_options_from_dash_xml(dash_data))
+
+    print("{:<45} {:>10} {:>12}".format("Parser", "KiB", "us per call"))
+
+    for name, function, data in (
+        ("feed page, incremental", parse_feed, feed_data),
+        ("feed page, json.loads", parse_feed_whole, feed_data),
+        ("get_video_info", parse_info, info_data),
+        ("HLS playlist", parse_hls, hls_data),
+        (
+            "DASH document, {} segments".format(args.dash_segments),
+            parse_dash,
+            dash_data
+        ),
+    ):
+        seconds = best_time(
+            lambda: [function() for i in range(args.number)],
+            args.repeat
+        ) / args.number
+
+        print("{:<45} {:>10.1f} {:>12.1f}".format(
+            name,
+            len(data) / 1024,
+            seconds * 1000 * 1000
+        ))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description= "Benchmarks for riptube.")
+    subparsers = parser.add_subparsers(dest= "command")
+
+    copy_parser = subparsers.add_parser(
+        "copy",
+        help= "Time copying downloads into files."
+    )
+    copy_parser.set_defaults(function= benchmark_copy)
+    copy_parser.add_argument(
+        "--size",
+        type= int,
+        default= 256,
+        metavar= "MIB",
+        help= "The number of MiB to copy."
+    )
+    copy_parser.add_argument(
+        "--directory",
+        default= tempfile.gettempdir(),
+        help= "The directory to write the file in."
+    )
+    copy_parser.add_argument(
+        "--repeat",
+        type= int,
+        default= 3,
+        metavar= "N",
+        help= "The number of times to run each case, keeping the best."
+    )
+
+    records_parser = subparsers.add_parser(
+        "records",
+        help= "Measure the memory and attribute access time for records."
+    )
+    records_parser.set_defaults(function= benchmark_records)
+    records_parser.add_argument(
+        "--count",
+        type= int,
+        default= 100000,
+        metavar= "N",
+        help= "The number of records to make."
+    )
+
+    download_parser = subparsers.add_parser(
+        "download",
+        help= "Download videos from a local stand-in for YouTube."
+    )
+    download_parser.set_defaults(function= benchmark_download)
+    download_parser.add_argument(
+        "--videos",
+        type= int,
+        default= 100,
+        metavar= "N",
+        help= "The number of videos in the feed."
+    )
+    download_parser.add_argument(
+        "--size",
+        type= int,
+        default= 8,
+        metavar= "MIB",
+        help= "The size of each video in MiB."
+    )
+    download_parser.add_argument(
+        "--latency",
+        type= float,
+        default= 0.02,
+        metavar= "SECONDS",
+        help= "The time the server waits before every response."
+    )
+    download_parser.add_argument(
+        "--bandwidth",
+        default= "unlimited",
+        metavar= "RATE",
+        help= "The most bytes per second for each response, like 10M."
+    )
+    download_parser.add_argument(
+        "--split",
+        action= "store_true",
+        help= (
+            "Serve separate video and audio tracks made with ffmpeg, which "
+            "have to be joined together."
+        )
+    )
+    download_parser.add_argument(
+        "--dash-segments",
+        type= int,
+        default= 100,
+        metavar= "N",
+        help= "The number of segments for each format in DASH documents."
+    )
+    download_parser.add_argument(
+        "--jobs",
+        type= int,
+        default= 4,
+        metavar= "N",
+        help= "The number of videos to download at the same time."
+    )
+    download_parser.add_argument(
+        "--mux-jobs",
+        type= int,
+        default= 1,
+        metavar= "N",
+        help= "The number of ffmpeg processes to join tracks with."
+    )
+    download_parser.add_argument(
+        "--segments",
+        type= int,
+        default= 1,
+        metavar= "N",
+        help= "The number of byte ranges to download each file in."
+    )
+    download_parser.add_argument(
+        "--stream-mux",
+        action= "store_true",
+        help= "Send split tracks straight into ffmpeg."
+    )
+    download_parser.add_argument(
+        "--hash",
+        choices= riptube.HASH_ALGORITHMS + ("none",),
+        default= riptube.DEFAULT_HASH_ALGORITHM,
+        help= "The hash to compute for downloaded files."
+    )
+    download_parser.add_argument(
+        "--max-request-rate",
+        type= float,
+        default= riptube.RATE_CONTROLLER.max_rate,
+        metavar= "R",
+        help= "The most requests per second riptube makes to the server."
+    )
+    download_parser.add_argument(
+        "--directory",
+        default= tempfile.gettempdir(),
+        help= "The directory to download the videos in."
+    )
+
+    parsers_parser = subparsers.add_parser(
+        "parsers",
+        help= "Time the parsers for feeds, video info and manifests."
+    )
+    parsers_parser.set_defaults(function= benchmark_parsers)
+    parsers_parser.add_argument(
+        "--dash-segments",
+        type= int,
+        default= 1000,
+        metavar= "N",
+        help= "The number of segments for each format in the DASH document."
+    )
+    parsers_parser.add_argument(
+        "--number",
+        type= int,
+        default= 20,
+        metavar= "N",
+        help= "The number of calls to time together."
+    )
+    parsers_parser.add_argument(
+        "--repeat",
+        type= int,
+        default= 3,
+        metavar= "N",
+        help= "The number of times to time the calls, keeping the best."
+    )
+
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+
+    args.function(args)
@@ -38,21 +38,31 @@ code also. Without youtube-dl, the author might not have been able to
 understand everything required to make this module work.
 """
 
-from itertools import count, repeat, cycle, chain
+from itertools import count, repeat, cycle, islice
+from collections import deque, OrderedDict
 from functools import partial, reduce
+import argparse
+import codecs
+import errno
+import hashlib
+import io
+import mmap
+import multiprocessing
 import operator
+import random
 import os
-import sys
 import shutil
+import sys
 import re
 import json
 import datetime
 import time
 import socket
+import sqlite3
 import subprocess
 import tempfile
 from queue import Queue
-from threading import Thread
+from threading import Thread, Lock, Condition, Event
 from xml.etree import cElementTree as ElementTree
 
 PYTHON_2 = sys.version_info[0] == 2
@@ -60,23 +70,18 @@ PYTHON_2 = sys.version_info[0] == 2
 if PYTHON_2:
     # Python 2 has a different module structure for network functions.
     from urllib import urlencode
-    from urlparse import parse_qs
-    from urllib2 import Request
+    from urlparse import parse_qs, urlsplit, urljoin
     from urllib2 import HTTPError
 
-    import contextlib
-    import urllib2
-
-    urlopen = lambda *args, **kwargs: contextlib.closing(
-        urllib2.urlopen(*args, **kwargs)
-    )
+    import httplib as http_client
 
     compat_str = basestring
 else:
-    from urllib.parse import urlencode, parse_qs
-    from urllib.request import Request, urlopen
+    from urllib.parse import urlencode, parse_qs, urlsplit, urljoin
     from urllib.error import HTTPError
 
+    import http.client as http_client
+
     compat_str = str
 
 API_URL = "https://gdata.youtube.com/feeds/api"
@@ -100,7 +105,7 @@ AUDIO_RATING_DICT = {
 
 VIDEO_ID_REGEX = re.compile("^[\w\-]{11}$")
 
-JSON_FORMAT_VERSION = "1.1"
+JSON_FORMAT_VERSION = "1.2"
 
 # A function for computing the product of a sequence.
 product = partial(reduce, operator.mul)
@@ -109,6 +114,9 @@ class FeedItem (object):
     """
     This object represents a feed item taken from a video feed.
     """
+    # Slots keep the many items for a channel small.
+    __slots__ = ("video_id", "upload_time", "title", "description")
+
     def __init__(self, video_id, upload_time, title, description):
         assert VIDEO_ID_REGEX.match(video_id)
         assert isinstance(upload_time, datetime.datetime)
@@ -128,11 +136,33 @@ class FeedItem (object):
             "description": self.description,
         }
 
+    @classmethod
+    def from_json(cls, feed_item_json):
+        """
+        Make a FeedItem from the JSON returned by to_json.
+        """
+        return cls(
+            feed_item_json["video_id"],
+            from_epoch(feed_item_json["upload_time"]),
+            feed_item_json["title"],
+            feed_item_json["description"],
+        )
+
 class MediaType (object):
     """
     This object holds information about a media type, including
     bitrate, file type, etc.
     """
+    __slots__ = (
+        "__itag",
+        "__file_type",
+        "__resolution",
+        "__video_format",
+        "__video_bitrate",
+        "__audio_format",
+        "__audio_bitrate",
+    )
+
     def __init__(self, itag, file_type, resolution, video_format,
     video_bitrate, audio_format, audio_bitrate):
         assert isinstance(itag, int)
@@ -191,7 +221,7 @@ class MediaType (object):
 
         This is a pair width, height.
         """
-        assert self.has_video
+        assert self.__video_format is not None
 
         return self.__resolution
 
@@ -231,7 +261,7 @@ class MediaType (object):
 
         This is the minimum bitrate for the video content.
         """
-        assert self.has_video
+        assert self.__video_format is not None
 
         return self.__video_bitrate
 
@@ -242,9 +272,9 @@ class MediaType (object):
 
         This is the minimum bitrate for the audio content.
         """
-        assert self.has_audio
+        assert self.__audio_format is not None
 
-        return self.__video_bitrate
+        return self.__audio_bitrate
 
     def to_json(self):
         return {
@@ -261,14 +291,49 @@ class DownloadInfo (object):
     """
     This object encapsulates information for a downloadable piece of media.
 
-    URLs will expire after a short time.
+    URLs will expire after a short time. The length of the video in seconds
+    is set when it is known, for estimating the size of the download.
+
+    DASH documents also say the bits per second for each download, and
+    sometimes the exact size in bytes, which are used over the estimates
+    from the media type when they are known.
     """
-    def __init__(self, media_type, url):
+    __slots__ = (
+        "media_type", "url", "length_seconds", "bandwidth", "content_length"
+    )
+
+    def __init__(self, media_type, url, length_seconds= None,
+    bandwidth= None, content_length= None):
         assert isinstance(media_type, MediaType)
         assert isinstance(url, compat_str)
 
         self.media_type = media_type
         self.url = url
+        self.length_seconds = length_seconds
+        self.bandwidth = bandwidth
+        self.content_length = content_length
+
+    def bits_per_second(self):
+        """
+        Return the bits per second for this download.
+        """
+        if self.bandwidth is not None:
+            return self.bandwidth
+
+        return media_bits_per_second(self.media_type)
+
+    def estimated_size(self):
+        """
+        Estimate the number of bytes for this download from the bitrates,
+        or return None if the length of the video isn't known.
+        """
+        if self.content_length is not None:
+            return self.content_length
+
+        if self.length_seconds is None:
+            return None
+
+        return int(self.bits_per_second() * self.length_seconds / 8)
 
     def to_json(self):
         return {
@@ -609,6 +674,64 @@ ITAG_MAP = {
     )
 }
 
+def video_rank_key(media_type):
+    """
+    Produce a key for sorting a media type by video quality.
+    """
+    return (
+        VIDEO_RATING_DICT[media_type.file_type],
+        product(media_type.resolution),
+        media_type.video_bitrate,
+    )
+
+def audio_rank_key(media_type):
+    """
+    Produce a key for sorting a media type by audio quality.
+    """
+    return (
+        AUDIO_RATING_DICT[media_type.audio_format],
+        media_type.audio_bitrate,
+    )
+
+def rank_dict(media_type_seq, key):
+    """
+    Given some media types and a key function, return a dictionary from
+    itag to rank, where a higher rank is better. Media types with equal
+    keys have the same rank.
+    """
+    key_list = sorted(set(key(media_type) for media_type in media_type_seq))
+    key_rank_dict = {key_value: i for i, key_value in enumerate(key_list)}
+
+    return {
+        media_type.itag: key_rank_dict[key(media_type)]
+        for media_type in media_type_seq
+    }
+
+# The quality ranks for every media type, so download options can be
+# compared without computing the keys again.
+VIDEO_RANK_DICT = rank_dict(
+    [media_type for media_type in ITAG_MAP.values() if media_type.has_video],
+    video_rank_key
+)
+AUDIO_RANK_DICT = rank_dict(
+    [media_type for media_type in ITAG_MAP.values() if media_type.has_audio],
+    audio_rank_key
+)
+
+def media_bits_per_second(media_type):
+    """
+    Return the bits per second for the video and audio in a media type.
+    """
+    bits = 0
+
+    if media_type.has_video:
+        bits += media_type.video_bitrate * 1000 * 1000
+
+    if media_type.has_audio:
+        bits += media_type.audio_bitrate * 1000
+
+    return bits
+
 def to_epoch(datetime_obj):
     """
     Convert a datetime object to an epoch value, as returned by time.time().
@@ -625,433 +748,5141 @@ def to_epoch(datetime_obj):
     else:
         return datetime_obj.timestamp()
 
-def browser_spoof_open(url):
-    return urlopen(
-        Request(url, headers={
-            "User-agent": (
-                "Mozilla/5.0 (X11; Linux x86_64; rv:25.0) "
-                "Gecko/20100101 Firefox/25.0"
-            ),
-        }),
-        timeout= 1
-    )
-
-def create_feed_url(username, page_index):
-    """
-    Create a URL which can be used to a page of video information.
-
-    The maximum number of possible items per page will be used, per YouTube's
-    API, and the page_index is zero-based.
-    """
-    # TODO: Regex for the username? Taking Google+ into account?
-    assert isinstance(page_index, int)
-    assert page_index >= 0
-
-    return "{}/users/{}/uploads?{}".format(API_URL, username, urlencode((
-        # Fetch as JSON.
-        ("alt", "json"),
-        ("strict", True),
-        # Use API version 2
-        ("v", 2),
-        # 'fields' will constrain the results to include only certain fields.
-        ("fields", "entry(id,title,published,media:group(media:description))"),
-        ("start-index", page_index * MAX_RESULTS + 1),
-        ("max-results", MAX_RESULTS),
-    )))
-
-def download_video_feed(feed_url):
+def from_epoch(epoch):
     """
-    Given a feed URL, download a tuple of FeedItems.
+    Convert an epoch value from to_epoch back to a datetime object.
     """
-    with urlopen(feed_url) as conn:
-        data = json.loads(conn.read().decode())
+    if sys.version_info[0:2] < (3, 3):
+        return datetime.datetime.utcfromtimestamp(epoch)
+    else:
+        return datetime.datetime.fromtimestamp(epoch)
 
-    return tuple(
-        FeedItem(
-            # The ID is part of the text of the string.
-            video_id= entry["id"]["$t"].rsplit(":", 1)[1],
-            # The upload time is an ISO UTC date with milliseconds.
-            # The milliseconds are apparently always zero.
-            upload_time= datetime.datetime.strptime(
-                entry["published"]["$t"],
-                "%Y-%m-%dT%H:%M:%S.000Z"
-            ),
-            title= entry["title"]["$t"],
-            description= entry["media$group"]["media$description"]["$t"],
-        )
-        for entry in data["feed"].get("entry", [])
-    )
+# The maximum number of redirects to follow for one request.
+MAX_REDIRECTS = 10
 
-def create_info_url(video_id):
-    assert VIDEO_ID_REGEX.match(video_id)
+REDIRECT_CODES = (301, 302, 303, 307, 308)
 
-    return "{}?{}".format(INFO_URL, urlencode((
-        ("asv", 3),
-        ("el", "detailpage"),
-        ("hl", "en_US"),
-        ("video_id", video_id),
-    )))
+# These HTTP codes mean that requests are being made too quickly.
+THROTTLE_CODES = (403, 429, 503)
 
-def download_options_from_stream_map(video_info):
+class TokenBucket (object):
     """
-    Yield a sequence of download options from the stream map.
+    This object allows events at some rate per second, with bursts of up to
+    'burst' events at once.
     """
-    # The list of downloads is yet another encoded string.
-    stream_map = parse_qs(video_info["url_encoded_fmt_stream_map"][0])
+    def __init__(self, rate, burst):
+        assert rate > 0
+        assert burst >= 1
 
-    # A signature string needs to be added to the download URL.
-    # This signature sometimes has ,quality=... after it.
-    # This signature is sometimes listed once, other times listed
-    # for each entry.
-    fallback_host = stream_map["fallback_host"][0]
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = float(burst)
+        self.__time = time.time()
+        self.__lock = Lock()
 
-    def full_url(base_url, sig):
-        return "{}&signature={}&fallback_host={}".format(
-            base_url, sig.split(",")[0], fallback_host
-        )
+    def take(self):
+        """
+        Take a token, and return the number of seconds to wait before
+        using it. The token is reserved even if the wait isn't zero.
+        """
+        with self.__lock:
+            now = time.time()
 
-    return (
-        DownloadInfo(
-            # The tag sometimes has ,quality= in it.
-            ITAG_MAP[int(itag.split(",")[0])],
-            full_url(base_url, sig)
-        )
-        for itag, base_url, sig in
-        zip(stream_map["itag"], stream_map["url"], cycle(stream_map["sig"]))
-    )
+            self.__tokens = min(
+                self.burst,
+                self.__tokens + (now - self.__time) * self.rate
+            )
+            self.__time = now
+            self.__tokens -= 1
 
-M3U_ITAG_RE = re.compile(r"itag/(\d+?)/")
+            if self.__tokens >= 0:
+                return 0
 
-def download_options_from_hlsvp(video_info):
+            return -self.__tokens / self.rate
+
+class RateController (object):
     """
-    Given some video info, download the available formats through hlsvp.
-    This will be downloaded through an .m3u playlist.
+    This object limits the rate of requests to each host with a token
+    bucket, and adapts the rate to the responses from the host.
+
+    The rate for a host is halved when it answers with one of the
+    THROTTLE_CODES, at most once a second, and it grows again by
+    'increase' requests per second for each successful response,
+    up to max_rate.
+
+    The time spent waiting, both for the buckets and for backing off
+    after errors, is counted, so it can be reported.
     """
-    m3u_url = video_info.get("hlsvp")
+    def __init__(self, max_rate= 20.0, min_rate= 0.2, burst= 10,
+    increase= 0.1):
+        assert 0 < min_rate <= max_rate
+
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.increase = increase
+        self.__lock = Lock()
+        self.__bucket_dict = {}
+        self.__last_decrease_dict = {}
+        self.wait_time = 0.0
+        self.backoff_time = 0.0
+        self.throttle_count = 0
+
+    def __bucket(self, host):
+        with self.__lock:
+            bucket = self.__bucket_dict.get(host)
+
+            if bucket is None:
+                bucket = TokenBucket(self.max_rate, self.burst)
+                self.__bucket_dict[host] = bucket
+
+            return bucket
+
+    def rate(self, host):
+        """
+        Return the current number of requests per second for a host.
+        """
+        return self.__bucket(host).rate
 
-    if not m3u_url:
-        return
+    def reserve(self, host):
+        """
+        Reserve a request to a host, and return the number of seconds to
+        wait before making it. The time is counted as time spent waiting.
+        """
+        delay = self.__bucket(host).take()
 
-    # Download the m3u playlist.
-    with browser_spoof_open(m3u_url) as conn:
-        playlist = conn.read().decode().split("\n")
+        if delay > 0:
+            with self.__lock:
+                self.wait_time += delay
 
-    # Get the URLs out of the playlist.
-    url_seq = (line for line in playlist if line and not line.startswith("#"))
+        return max(delay, 0)
 
-    for url in url_seq:
-        yield DownloadInfo(
-            ITAG_MAP[int(M3U_ITAG_RE.search(url).groups()[0])],
-            url
-        )
+    def wait(self, host):
+        """
+        Wait until a request can be made to a host.
+        """
+        delay = self.reserve(host)
 
-# The XSD for DASH is here:
-# http://standards.iso.org/ittf/PubliclyAvailableStandards/
-#   MPEG-DASH_schema_files/DASH-MPD.xsd
-#
-# The part of DASH documents we care about flows like so:
-# MPD -> Period -> AdaptationSet -> Representation -> BaseURL
-#
-# Take the id attribute of the Representations, take the text of the BaseURLs.
+        if delay > 0:
+            time.sleep(delay)
 
-REPRESENTATION_XPATH = ".//{urn:mpeg:DASH:schema:MPD:2011}Representation"
-BASE_URL_XPATH = "{urn:mpeg:DASH:schema:MPD:2011}BaseURL"
+    def record_response(self, host, status):
+        """
+        Adapt the rate for a host to the status of a response from it.
+        """
+        bucket = self.__bucket(host)
 
-def download_options_from_dash_document(video_info):
-    """
-    Given some video info, download available formats from a DASH
-    document, if one is available.
-    """
-    manifest_url_list = video_info.get("dashmpd")
+        with self.__lock:
+            if status in THROTTLE_CODES:
+                self.throttle_count += 1
+                now = time.time()
 
-    if not manifest_url_list:
-        return
+                if now - self.__last_decrease_dict.get(host, 0) >= 1:
+                    self.__last_decrease_dict[host] = now
+                    bucket.rate = max(self.min_rate, bucket.rate / 2)
+            elif status < 400:
+                bucket.rate = min(self.max_rate, bucket.rate + self.increase)
 
-    with browser_spoof_open(manifest_url_list[0]) as conn:
-        # Read the XML document from the downloaded data.
-        document = ElementTree.fromstring(conn.read())
+    def record_backoff(self, seconds):
+        """
+        Count some seconds spent waiting after an error.
+        """
+        with self.__lock:
+            self.backoff_time += seconds
 
-    # Search for the Representation elements in the document.
-    for representation in document.findall(REPRESENTATION_XPATH):
-        # Find the BaseURL element in the Representation.
-        url_element = representation.find(BASE_URL_XPATH)
+    def backoff(self, seconds):
+        """
+        Sleep for some seconds after an error, and count the time.
+        """
+        self.record_backoff(seconds)
+        time.sleep(seconds)
 
-        yield DownloadInfo(
-            ITAG_MAP[int(representation.attrib["id"])],
-            url_element.text
-        )
+    def summary(self):
+        """
+        Return a line describing how much requests have been slowed down.
+        """
+        with self.__lock:
+            return (
+                "{} throttling responses, {:.1f}s waiting to make requests, "
+                "{:.1f}s backing off after errors"
+            ).format(self.throttle_count, self.wait_time, self.backoff_time)
 
-def download_info(info_url):
-    with browser_spoof_open(info_url) as conn:
-        # The video info is a urlencoded string.
-        video_info = parse_qs(conn.read().decode())
+# This controls the rate of all of the requests made by this module.
+RATE_CONTROLLER = RateController()
 
-    if "errorcode" in video_info:
-        raise RuntimeError("Download failed for {} with reason: {}".format(
-            info_url, video_info.get("reason")
-        ))
+def backoff_delay(attempt, base= 1.0, limit= 60.0):
+    """
+    Return the number of seconds to wait before trying something again,
+    after 'attempt' tries have failed, counting from zero.
 
-    return tuple(chain(
-        download_options_from_stream_map(video_info),
-        download_options_from_hlsvp(video_info),
-        download_options_from_dash_document(video_info),
-    ))
+    The delay doubles with each attempt up to the limit, and a random
+    part of up to half of it is taken off, so threads which failed at
+    the same time don't all try again at the same time.
+    """
+    delay = min(limit, base * 2 ** attempt)
 
-def download_info_for_feed_item(feed_item):
-    return download_info(create_info_url(feed_item.video_id))
+    return delay / 2 + random.uniform(0, delay / 2)
 
-def highest_quality_content(download_options):
+class PooledResponse (object):
     """
-    Select the highest quality content from a sequence of download options.
-    This can be either a single audio-video option, or a pair of two options
-    each with high quality audio and video as separate downloads.
+    This object is a response for a request made with an HTTPConnectionPool.
+
+    The body can be read like a file. The connection is given back to the
+    pool when the response is closed, and it will be used again if the
+    whole body was read.
     """
-    def video_quality_key(option):
-        """
-        Produce a key for sorting a download option by video quality.
-        """
-        return (
-            VIDEO_RATING_DICT[option.media_type.file_type],
-            product(option.media_type.resolution),
-            option.media_type.video_bitrate,
-        )
+    def __init__(self, pool, key, connection, response, url):
+        self.__pool = pool
+        self.__key = key
+        self.__connection = connection
+        self.__response = response
+        self.url = url
 
-    def audio_quality_key(option):
+    @property
+    def status(self):
         """
-        Produce a key for sorting a download option by audio quality.
+        Return the HTTP status code for the response.
         """
-        return (
-            AUDIO_RATING_DICT[option.media_type.audio_format],
-            option.media_type.audio_bitrate
-        )
+        return self.__response.status
 
-    highest_audio = None
-    highest_video = None
-    highest_audio_video = None
+    @property
+    def reason(self):
+        return self.__response.reason
 
-    # Linear search download options for highest quality audio, video
-    # and audio-video content.
-    for option in download_options:
-        if option.media_type.has_video:
-            # This option has video content.
-            if highest_video is None \
-            or video_quality_key(option) > video_quality_key(highest_video):
-                # The video content of this is higher quality.
-                highest_video = option
-
-                if option.media_type.has_audio:
-                    # It also has audio, so it's the highest audio-video.
-                    highest_audio_video = option
-        else:
-            # This is audio only content.
-            if highest_audio is None \
-            or audio_quality_key(option) > audio_quality_key(highest_audio):
-                # The audio content of this is higher quality.
-                highest_audio = option
+    @property
+    def headers(self):
+        return self.__response.msg
 
-    # Now compare the split content and the joined content and return
-    # what we believe to be best.
+    def getheader(self, name, default= None):
+        return self.__response.getheader(name, default)
 
-    if highest_audio is None \
-    or video_quality_key(highest_video) \
-     < video_quality_key(highest_audio_video):
-        # Wont don't have split tracks, or the joined one is just better
-        # anyway. Let's use that.
-        return highest_audio_video
+    def read(self, *args):
+        return self.__response.read(*args)
 
-    # We have split tracks that are better, so use those.
-    return (highest_video, highest_audio)
+    def readinto(self, buffer):
+        return self.__response.readinto(buffer)
 
-def user_videos(username):
-    """
-    Generate a list of all videos for a user.
-    """
-    for page_index in count():
-        entry_list = download_video_feed(
-            create_feed_url(username, page_index)
-        )
+    def close(self):
+        if self.__connection is None:
+            return
 
-        for entry in entry_list:
-            yield entry
+        # HTTPResponse closes itself when the whole body has been read.
+        reusable = self.__response.isclosed() \
+            and not self.__response.will_close
 
-        if len(entry_list) < MAX_RESULTS:
-            break
+        self.__response.close()
+        self.__pool._release(self.__key, self.__connection, reusable)
+        self.__connection = None
 
-def base_filename_for_feed_item(feed_item):
-    """
-    Return a base filename for a YouTube feed item.
+    def __enter__(self):
+        return self
 
-    This is returned in the format <epoch>_<video_id>
-    """
-    return "{}_{}".format(
-        int(to_epoch(feed_item.upload_time)),
-        feed_item.video_id
-    )
+    def __exit__(self, *args):
+        self.close()
 
-def download_to_file(url, filename):
-    """
-    Download an entire file to a given filename.
+class HTTPConnectionPool (object):
     """
-    with browser_spoof_open(url) as download_conn:
-        with open(filename, "wb") as out_file:
-            shutil.copyfileobj(download_conn, out_file, 1024 * 8)
+    This object keeps HTTP connections open between requests, so
+    connections to the same host can be used again, from any thread.
 
-def download_feed_item(feed_item, base_directory):
-    """
-    Download a feed item into a directory.
+    No more than max_connections_per_host connections will be open for
+    one host at a time. Threads will wait for a connection when the
+    limit is reached, except for requests which reserve a connection
+    outside of the limit, for a thread which already holds one and needs
+    a second to finish.
 
-    Return a pair (video_filename, json_filename) if the item is downloaded,
-    otherwise return None if the video has already been downloaded.
+    If a RateController is given, each request will wait for it, and the
+    status of each response will be reported to it.
     """
-    join_path = partial(os.path.join, base_directory)
+    def __init__(self, max_connections_per_host= 8, rate_controller= None):
+        assert isinstance(max_connections_per_host, int)
+        assert max_connections_per_host >= 1
 
-    base_filename = base_filename_for_feed_item(feed_item)
+        self.max_connections_per_host = max_connections_per_host
+        self.rate_controller = rate_controller
+        self.__condition = Condition(Lock())
+        self.__idle_dict = {}
+        self.__open_count_dict = {}
 
-    json_filename = join_path("{}.json".format(base_filename))
+    def __acquire(self, key, timeout, reserved):
+        """
+        Return a pair (connection, reused) for a (scheme, host, port) key,
+        waiting for a connection if the limit for the host has been reached,
+        unless the connection is reserved.
+        """
+        with self.__condition:
+            while True:
+                idle_list = self.__idle_dict.get(key)
 
-    if os.path.exists(json_filename):
-        # Stop here, we already have this video.
-        return
+                if idle_list:
+                    connection = idle_list.pop()
+                    connection.timeout = timeout
 
-    content = highest_quality_content(
-        download_info_for_feed_item(feed_item)
-    )
+                    if connection.sock is not None:
+                        connection.sock.settimeout(timeout)
 
-    video_content = (
-        content[0]
-        if isinstance(content, tuple) else
-        content
-    )
+                    return (connection, True)
 
-    assert video_content.media_type.has_video
+                open_count = self.__open_count_dict.get(key, 0)
 
-    video_filename = join_path("{}.{}".format(
-        base_filename, video_content.media_type.file_type
-    ))
+                if reserved or open_count < self.max_connections_per_host:
+                    self.__open_count_dict[key] = open_count + 1
+                    break
 
-    if os.path.exists(video_filename):
-        # Delete the video file if it's there already.
-        os.remove(video_filename)
+                self.__condition.wait()
 
-    if isinstance(content, tuple):
-        # Download video and audio at the same time.
-        que = Queue()
-        exception_queue = Queue()
+        scheme, host, port = key
 
-        def download_in_queue():
-            try:
-                download_to_file(*que.get())
-            except Exception as ex:
-                exception_queue.put(ex)
+        if scheme == "https":
+            connection_class = http_client.HTTPSConnection
+        else:
+            connection_class = http_client.HTTPConnection
 
-                # TODO: It would be nice to be able to terminate the other
-                # thread here.
+        return (connection_class(host, port, timeout= timeout), False)
 
-                if isinstance(ex, (KeyboardInterrupt, SystemExit)):
-                    # Re-raise interrupts so cleanup code works.
-                    raise ex
-            finally:
-                que.task_done()
+    def _release(self, key, connection, reusable):
+        """
+        Give a connection back to the pool. The connection will be closed
+        if it cannot be used again.
+        """
+        with self.__condition:
+            if reusable:
+                self.__idle_dict.setdefault(key, []).append(connection)
+            else:
+                connection.close()
+                self.__open_count_dict[key] -= 1
 
-        temp_video_filename = tempfile.mkstemp(prefix= base_filename)[1]
-        temp_audio_filename = tempfile.mkstemp(prefix= base_filename)[1]
+            self.__condition.notify()
 
-        try:
-            que.put((content[0].url, temp_video_filename))
-            que.put((content[1].url, temp_audio_filename))
+    def close_idle(self):
+        """
+        Close all of the connections which are not being used.
+        """
+        with self.__condition:
+            for key, idle_list in self.__idle_dict.items():
+                for connection in idle_list:
+                    connection.close()
 
-            for i in range(2):
-                Thread(target= download_in_queue).start()
+                self.__open_count_dict[key] -= len(idle_list)
+                del idle_list[:]
 
-            que.join()
+            self.__condition.notify_all()
 
-            if not exception_queue.empty():
-                raise exception_queue.get()
+    def __request(self, url, headers, timeout, reserved):
+        parts = urlsplit(url)
 
-            # Now use ffmpeg to join the audio and video content together.
-            subprocess.check_call((
-                "ffmpeg",
-                "-i", temp_video_filename,
-                "-i", temp_audio_filename,
-                "-c", "copy", os.path.abspath(video_filename)
-            ))
-        finally:
-            # Clean up temporary files.
-            os.remove(temp_video_filename)
-            os.remove(temp_audio_filename)
-    else:
-        # Download one audio-video file.
-        download_to_file(video_content.url, video_filename)
-
-    # Now write the JSOn file with the metadata.
-    with open(json_filename, "w") as out_file:
-        json.dump({
-            "version": JSON_FORMAT_VERSION,
-            "content": (
-                [content[0].to_json(), content[1].to_json()]
-                if isinstance(content, tuple) else
-                [content.to_json()]
-            ),
-            "feed_item": feed_item.to_json(),
-        }, out_file)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError("Unsupported URL: {}".format(url))
 
-    return (video_filename, json_filename)
+        key = (
+            parts.scheme,
+            parts.hostname,
+            parts.port or (443 if parts.scheme == "https" else 80)
+        )
 
-def download_videos_for_user(username, output_directory, log_file= None):
-    def log(format_string, *args):
-        if log_file is not None:
-            log_file.write(format_string.format(*args))
-            log_file.write("\n")
+        path = parts.path or "/"
 
-    username = username.lower()
+        if parts.query:
+            path += "?" + parts.query
 
-    user_directory = os.path.join(output_directory, username)
+        while True:
+            connection, reused = self.__acquire(key, timeout, reserved)
 
-    if not os.path.exists(user_directory):
-        os.mkdir(user_directory)
+            try:
+                connection.request("GET", path, headers= headers)
+                response = connection.getresponse()
+            except Exception as ex:
+                self._release(key, connection, False)
 
-    log("Downloading videos for username: {}", username)
+                if reused \
+                and isinstance(ex, (http_client.HTTPException, socket.error)) \
+                and not isinstance(ex, socket.timeout):
+                    # The server closed the connection while it was idle,
+                    # so try again with a new connection.
+                    continue
 
-    for feed_item in user_videos(username):
-        while True:
-            try:
-                feed_result = download_feed_item(feed_item, user_directory)
-                break
-            except (socket.timeout, HTTPError) as err:
-                # This hack sucks, but I can't figure out how to stop
-                # the request errors from happening randomly.
-                if not isinstance(err, socket.timeout) \
-                and err.code != 403 \
-                and err.code != 400 \
-                and err.code != 503:
-                    raise err
-
-                log("Got a request error, sleeping a little...")
-                time.sleep(3)
-
-        if feed_result is not None:
-            log("Grabbed item {} - {}", feed_item.video_id, feed_item.title)
-            log("filename: {}", feed_result[0])
-            log("JSON filename: {}", feed_result[1])
+                raise
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        sys.exit("Usage: riptube.py <username> [<output_directory>]")
+            return PooledResponse(self, key, connection, response, url)
 
-    try:
-        with open(os.devnull, "wb") as null_out:
-            subprocess.check_call(
-                ("ffmpeg", "-h"),
-                stdout= null_out,
-                stderr= null_out
-            )
-    except:
-        sys.exit("'ffmpeg -h' failed! Please install ffmpeg.")
+    def open(self, url, headers= None, timeout= None, reserved= False):
+        """
+        Make a GET request for a URL, following redirects, and return
+        a PooledResponse, which should be closed after it has been used.
+
+        If reserved is True, the request won't wait for the limit on
+        connections for the host. This should only be used by a thread
+        which holds another connection already, so there are never more
+        than twice as many connections as the limit.
+
+        HTTPError will be raised for error responses, like urlopen does.
+        """
+        headers = dict(headers or ())
+
+        for redirect_count in range(MAX_REDIRECTS + 1):
+            host = urlsplit(url).hostname
+
+            if self.rate_controller is not None:
+                self.rate_controller.wait(host)
+
+            response = self.__request(url, headers, timeout, reserved)
+
+            if self.rate_controller is not None:
+                self.rate_controller.record_response(host, response.status)
 
-    username = sys.argv[1]
-    output_dir = sys.argv[2] if len(sys.argv) >= 3 else "output"
+            location = response.getheader("Location")
 
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
+            if response.status in REDIRECT_CODES and location:
+                # Read the rest of the body so the connection can be used.
+                response.read()
+                response.close()
 
-    download_videos_for_user(username, output_dir, log_file= sys.stderr)
+                url = urljoin(url, location)
+                continue
+
+            if response.status >= 400:
+                response.close()
+
+                raise HTTPError(
+                    url,
+                    response.status,
+                    response.reason,
+                    response.headers,
+                    None
+                )
+
+            return response
+
+        response.close()
+
+        raise HTTPError(
+            url,
+            response.status,
+            "Too many redirects",
+            response.headers,
+            None
+        )
+
+# This pool is used for all of the requests made by this module.
+HTTP_POOL = HTTPConnectionPool(rate_controller= RATE_CONTROLLER)
+
+def browser_spoof_headers():
+    """
+    Return a dictionary of request headers for looking like a browser.
+    """
+    return {
+        "User-agent": (
+            "Mozilla/5.0 (X11; Linux x86_64; rv:25.0) "
+            "Gecko/20100101 Firefox/25.0"
+        ),
+    }
+
+def browser_spoof_open(url, reserved= False):
+    return HTTP_POOL.open(
+        url,
+        browser_spoof_headers(),
+        timeout= 1,
+        reserved= reserved
+    )
+
+FEED_ENTRY_FIELDS = "entry(id,title,published,media:group(media:description))"
+
+def create_feed_url(username, page_index, with_total= False):
+    """
+    Create a URL which can be used to a page of video information.
+
+    The maximum number of possible items per page will be used, per YouTube's
+    API, and the page_index is zero-based. If with_total is True, the
+    page will also include the total number of videos in the feed.
+    """
+    # TODO: Regex for the username? Taking Google+ into account?
+    assert isinstance(page_index, int)
+    assert page_index >= 0
+
+    fields = FEED_ENTRY_FIELDS
+
+    if with_total:
+        fields = "openSearch:totalResults," + fields
+
+    return "{}/users/{}/uploads?{}".format(API_URL, username, urlencode((
+        # Fetch as JSON.
+        ("alt", "json"),
+        ("strict", True),
+        # Use API version 2
+        ("v", 2),
+        # 'fields' will constrain the results to include only certain fields.
+        ("fields", fields),
+        ("start-index", page_index * MAX_RESULTS + 1),
+        ("max-results", MAX_RESULTS),
+    )))
+
+# Feeds are read from the network in chunks of this many bytes.
+FEED_READ_SIZE = 1024 * 16
+
+# Feed pages up to this many bytes are read whole and decoded with
+# json.loads, which takes less time than decoding them incrementally.
+# Bigger pages, and pages without a Content-Length, are decoded as they
+# download, so the first videos on them can be used before the rest of
+# the page arrives, without holding the whole page in memory.
+FEED_WHOLE_PAGE_SIZE = 1024 * 64
+
+# Once the total for a feed is known, this many of the other pages are
+# downloaded at the same time by default, which is within the limit of
+# connections per host, so a feed of thousands of pages is listed in
+# a fraction of the round trips.
+DEFAULT_PREFETCH_PAGES = 8
+
+JSON_DECODER = json.JSONDecoder()
+
+class _JSONTextStream (object):
+    """
+    This object reads JSON text from a sequence of chunks of UTF-8 data,
+    one token or value at a time, keeping only the text which hasn't been
+    decoded yet.
+    """
+    def __init__(self, chunk_seq):
+        self.__chunk_iter = iter(chunk_seq)
+        self.__utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.__text = ""
+        self.__position = 0
+        self.__ended = False
+
+    def __read_more(self):
+        """
+        Read another chunk, and return False if there are no more.
+        """
+        if self.__ended:
+            return False
+
+        chunk = next(self.__chunk_iter, None)
+
+        if chunk is None:
+            self.__ended = True
+            new_text = self.__utf8_decoder.decode(b"", True)
+        else:
+            new_text = self.__utf8_decoder.decode(chunk)
+
+        # Drop the text which has been decoded already.
+        self.__text = self.__text[self.__position:] + new_text
+        self.__position = 0
+
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace, and return the next character, or an empty
+        string at the end of the text.
+        """
+        while True:
+            text = self.__text
+
+            while self.__position < len(text) \
+            and text[self.__position] in " \t\r\n":
+                self.__position += 1
+
+            if self.__position < len(text):
+                return text[self.__position]
+
+            if not self.__read_more():
+                return ""
+
+    def expect(self, characters):
+        """
+        Read one of some characters, like "," or "}", and return it.
+        """
+        character = self.peek()
+
+        if not character or character not in characters:
+            raise ValueError("Expected one of {!r} in JSON, found {!r}".format(
+                characters,
+                character
+            ))
+
+        self.__position += 1
+
+        return character
+
+    def decode(self):
+        """
+        Decode the next whole JSON value.
+        """
+        self.peek()
+
+        while True:
+            try:
+                value, end = JSON_DECODER.raw_decode(
+                    self.__text,
+                    self.__position
+                )
+
+                # A number at the end of the text might be cut off,
+                # so values are only used when there's text after them.
+                if end < len(self.__text) or self.__ended:
+                    self.__position = end
+
+                    return value
+            except ValueError:
+                if self.__ended:
+                    raise
+
+            self.__read_more()
+
+    def object_keys(self):
+        """
+        Generate the keys of a JSON object, after the opening brace has
+        been read. The value for each key must be read before the next key
+        is taken.
+        """
+        if self.peek() == "}":
+            self.expect("}")
+            return
+
+        while True:
+            key = self.decode()
+            self.expect(":")
+
+            yield key
+
+            if self.expect(",}") == "}":
+                return
+
+FEED_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+
+def parse_feed_time(text):
+    """
+    Parse an upload time from a feed, which is an ISO UTC date with
+    milliseconds, like datetime.strptime with FEED_TIME_FORMAT does, but
+    quicker. The milliseconds are apparently always zero.
+    """
+    if len(text) == 24 \
+    and text[4] == "-" and text[7] == "-" and text[10] == "T" \
+    and text[13] == ":" and text[16] == ":" and text[19:] == ".000Z":
+        try:
+            return datetime.datetime(
+                int(text[0:4]),
+                int(text[5:7]),
+                int(text[8:10]),
+                int(text[11:13]),
+                int(text[14:16]),
+                int(text[17:19]),
+            )
+        except ValueError:
+            pass
+
+    # Let strptime deal with anything unusual, and raise the error.
+    return datetime.datetime.strptime(text, FEED_TIME_FORMAT)
+
+def feed_item_from_json(entry):
+    """
+    Given the decoded JSON for an entry in a video feed, return a FeedItem.
+    """
+    return FeedItem(
+        # The ID is part of the text of the string.
+        video_id= entry["id"]["$t"].rsplit(":", 1)[1],
+        upload_time= parse_feed_time(entry["published"]["$t"]),
+        title= entry["title"]["$t"],
+        description= entry["media$group"]["media$description"]["$t"],
+    )
+
+def iter_feed_page(chunk_seq, on_total= None):
+    """
+    Given a sequence of chunks of the JSON data for a page of a video feed,
+    generate the FeedItems on the page as soon as each entry is decoded,
+    without decoding the whole page first.
+
+    If on_total is given, it will be called with the total number of videos
+    in the feed, if the page has it.
+    """
+    stream = _JSONTextStream(chunk_seq)
+    stream.expect("{")
+
+    for key in stream.object_keys():
+        if key != "feed":
+            stream.decode()
+            continue
+
+        stream.expect("{")
+
+        for feed_key in stream.object_keys():
+            if feed_key == "entry":
+                stream.expect("[")
+
+                if stream.peek() == "]":
+                    stream.expect("]")
+                    continue
+
+                while True:
+                    yield feed_item_from_json(stream.decode())
+
+                    if stream.expect(",]") == "]":
+                        break
+            else:
+                value = stream.decode()
+
+                if feed_key == "openSearch$totalResults" \
+                and on_total is not None:
+                    on_total(int(value["$t"]))
+
+_END_OF_PAGE = object()
+
+class FeedPageDownload (object):
+    """
+    This object downloads a page of a video feed in a background thread.
+
+    The FeedItems on the page can be taken by iterating over this object
+    once, as soon as they are decoded, while the rest of the page is still
+    being downloaded. len() waits for the page to finish, and returns
+    the number of items on it.
+    """
+    def __init__(self, feed_url):
+        self.__que = Queue()
+        self.__total_results = None
+        self.__total_event = Event()
+        self.__done_event = Event()
+        self.__item_count = 0
+        self.__error = None
+
+        thread = Thread(target= self.__run, args= (feed_url,))
+        thread.daemon = True
+        thread.start()
+
+    def __set_total(self, total_results):
+        self.__total_results = total_results
+        self.__total_event.set()
+
+    def __run(self, feed_url):
+        try:
+            with HTTP_POOL.open(feed_url) as conn:
+                content_length = conn.getheader("Content-Length")
+
+                if content_length is not None \
+                and int(content_length) <= FEED_WHOLE_PAGE_SIZE:
+                    feed_item_seq = feed_items_from_page_data(
+                        conn.read(),
+                        self.__set_total
+                    )
+                else:
+                    feed_item_seq = iter_feed_page(
+                        iter(partial(conn.read, FEED_READ_SIZE), b""),
+                        self.__set_total
+                    )
+
+                for feed_item in feed_item_seq:
+                    self.__item_count += 1
+                    self.__que.put(feed_item)
+        except Exception as ex:
+            self.__error = ex
+        finally:
+            self.__done_event.set()
+            self.__total_event.set()
+            self.__que.put(_END_OF_PAGE)
+
+    def total_results(self):
+        """
+        Wait until the total number of videos in the feed is known, and
+        return it, or None if the page doesn't have it.
+        """
+        self.__total_event.wait()
+
+        if self.__error is not None:
+            raise self.__error
+
+        return self.__total_results
+
+    def __iter__(self):
+        while True:
+            feed_item = self.__que.get()
+
+            if feed_item is _END_OF_PAGE:
+                break
+
+            yield feed_item
+
+        if self.__error is not None:
+            raise self.__error
+
+    def __len__(self):
+        self.__done_event.wait()
+
+        if self.__error is not None:
+            raise self.__error
+
+        return self.__item_count
+
+def feed_items_from_json(data):
+    """
+    Given the decoded JSON for a page of a video feed, return a tuple
+    of FeedItems.
+    """
+    return tuple(
+        feed_item_from_json(entry)
+        for entry in data["feed"].get("entry", [])
+    )
+
+def feed_items_from_page_data(page_data, on_total= None):
+    """
+    Given all of the JSON data for a page of a video feed, decode it at
+    once and return a tuple of FeedItems, calling on_total like
+    iter_feed_page does.
+    """
+    data = json.loads(page_data.decode("utf-8"))
+    total = data["feed"].get("openSearch$totalResults")
+
+    if total is not None and on_total is not None:
+        on_total(int(total["$t"]))
+
+    return feed_items_from_json(data)
+
+def create_info_url(video_id):
+    assert VIDEO_ID_REGEX.match(video_id)
+
+    return "{}?{}".format(INFO_URL, urlencode((
+        ("asv", 3),
+        ("el", "detailpage"),
+        ("hl", "en_US"),
+        ("video_id", video_id),
+    )))
+
+def download_options_from_stream_map(video_info):
+    """
+    Yield a sequence of download options from the stream map.
+    """
+    # The list of downloads is yet another encoded string.
+    stream_map = parse_qs(video_info["url_encoded_fmt_stream_map"][0])
+
+    # A signature string needs to be added to the download URL.
+    # This signature sometimes has ,quality=... after it.
+    # This signature is sometimes listed once, other times listed
+    # for each entry.
+    fallback_host = stream_map["fallback_host"][0]
+
+    def full_url(base_url, sig):
+        return "{}&signature={}&fallback_host={}".format(
+            base_url, sig.split(",")[0], fallback_host
+        )
+
+    return (
+        DownloadInfo(
+            # The tag sometimes has ,quality= in it.
+            ITAG_MAP[int(itag.split(",")[0])],
+            full_url(base_url, sig)
+        )
+        for itag, base_url, sig in
+        zip(stream_map["itag"], stream_map["url"], cycle(stream_map["sig"]))
+    )
+
+M3U_ITAG_RE = re.compile(r"itag/(\d+?)/")
+
+def download_options_from_hlsvp(video_info):
+    """
+    Given some video info, download the available formats through hlsvp.
+    This will be downloaded through an .m3u playlist.
+    """
+    m3u_url_list = video_info.get("hlsvp")
+
+    if not m3u_url_list:
+        return ()
+
+    # Download the m3u playlist.
+    with browser_spoof_open(m3u_url_list[0]) as conn:
+        playlist_text = conn.read().decode()
+
+    return download_options_from_hls_playlist(playlist_text)
+
+def download_options_from_hls_playlist(playlist_text):
+    """
+    Yield a sequence of download options from the text of an .m3u playlist.
+    """
+    playlist = playlist_text.split("\n")
+
+    # Get the URLs out of the playlist.
+    url_seq = (line for line in playlist if line and not line.startswith("#"))
+
+    for url in url_seq:
+        yield DownloadInfo(
+            ITAG_MAP[int(M3U_ITAG_RE.search(url).groups()[0])],
+            url
+        )
+
+# The XSD for DASH is here:
+# http://standards.iso.org/ittf/PubliclyAvailableStandards/
+#   MPEG-DASH_schema_files/DASH-MPD.xsd
+#
+# The part of DASH documents we care about flows like so:
+# MPD -> Period -> AdaptationSet -> Representation -> BaseURL
+#
+# Take the id and bandwidth attributes of the Representations, take the text
+# of the BaseURLs. The size of the media comes from the contentLength
+# attribute YouTube puts on the BaseURLs, or from the byte range of the last
+# segment in a SegmentList.
+
+DASH_NAMESPACE = "{urn:mpeg:DASH:schema:MPD:2011}"
+REPRESENTATION_TAG = DASH_NAMESPACE + "Representation"
+BASE_URL_TAG = DASH_NAMESPACE + "BaseURL"
+SEGMENT_URL_XPATH = DASH_NAMESPACE + "SegmentList/" + DASH_NAMESPACE \
+    + "SegmentURL"
+CONTENT_LENGTH_ATTRIBUTE = "{http://youtube.com/yt/2012/10/10}contentLength"
+
+def download_options_from_dash_document(video_info):
+    """
+    Given some video info, download available formats from a DASH
+    document, if one is available.
+
+    The formats are generated while the document is still being downloaded.
+    """
+    manifest_url_list = video_info.get("dashmpd")
+
+    if not manifest_url_list:
+        return
+
+    with browser_spoof_open(manifest_url_list[0]) as conn:
+        for option in download_options_from_dash_stream(conn):
+            yield option
+
+def dash_content_length(representation, url_element):
+    """
+    Return the size in bytes of the media for a DASH Representation
+    element, or None if the document doesn't say.
+    """
+    content_length = url_element.get(CONTENT_LENGTH_ATTRIBUTE)
+
+    if content_length is not None:
+        return int(content_length)
+
+    # The last segment in a list ends at the end of the media.
+    end = None
+
+    for segment in representation.iterfind(SEGMENT_URL_XPATH):
+        media_range = segment.get("mediaRange")
+
+        if media_range is None:
+            return None
+
+        end = max(end or 0, int(media_range.split("-")[1]) + 1)
+
+    return end
+
+def download_options_from_dash_stream(source):
+    """
+    Yield a sequence of download options from a file object for a DASH
+    document, as each Representation in the document is read.
+
+    Elements are dropped from the document once they have been used,
+    so large documents don't need to be held in memory.
+    """
+    # The elements which are open are kept, so finished Representations
+    # can be removed from the elements they are in.
+    element_stack = []
+
+    for event, element in ElementTree.iterparse(source, ("start", "end")):
+        if event == "start":
+            element_stack.append(element)
+            continue
+
+        element_stack.pop()
+
+        if element.tag != REPRESENTATION_TAG:
+            continue
+
+        url_element = element.find(BASE_URL_TAG)
+        bandwidth = element.get("bandwidth")
+
+        yield DownloadInfo(
+            ITAG_MAP[int(element.get("id"))],
+            url_element.text,
+            bandwidth= int(bandwidth) if bandwidth is not None else None,
+            content_length= dash_content_length(element, url_element),
+        )
+
+        if element_stack:
+            element_stack[-1].remove(element)
+
+def download_options_from_dash_xml(document_data):
+    """
+    Yield a sequence of download options from the data for a DASH document.
+    """
+    return download_options_from_dash_stream(io.BytesIO(document_data))
+
+def parse_video_info(info_url, info_text):
+    """
+    Parse the text downloaded from an info URL into a dictionary of lists.
+
+    A RuntimeError will be raised if YouTube reported an error.
+    """
+    # The video info is a urlencoded string.
+    video_info = parse_qs(info_text)
+
+    if "errorcode" in video_info:
+        raise RuntimeError("Download failed for {} with reason: {}".format(
+            info_url, video_info.get("reason")
+        ))
+
+    return video_info
+
+def set_length_seconds(download_options, video_info):
+    """
+    Set the length of the video from the video info on a sequence of
+    download options, and return them as a tuple.
+    """
+    download_options = tuple(download_options)
+
+    try:
+        length_seconds = int(video_info["length_seconds"][0])
+    except (KeyError, IndexError, ValueError):
+        length_seconds = None
+
+    for option in download_options:
+        option.length_seconds = length_seconds
+
+    return download_options
+
+def download_info(info_url, satisfied= None):
+    """
+    Download the info for a video, and return a tuple of DownloadInfo
+    objects for every available format.
+
+    The formats in the stream map come with the info. The HLS playlist and
+    the DASH document are then downloaded at the same time. If a function
+    'satisfied' is given, it will be called with the formats from the
+    stream map first, and if it returns True, the playlist and the document
+    won't be downloaded at all.
+    """
+    with browser_spoof_open(info_url) as conn:
+        video_info = parse_video_info(info_url, conn.read().decode())
+
+    stream_map_options = set_length_seconds(
+        download_options_from_stream_map(video_info),
+        video_info
+    )
+
+    if satisfied is not None and satisfied(stream_map_options):
+        return stream_map_options
+
+    if video_info.get("hlsvp"):
+        hls_call = BackgroundCall(
+            lambda: tuple(download_options_from_hlsvp(video_info))
+        )
+    else:
+        hls_call = None
+
+    dash_options = tuple(download_options_from_dash_document(video_info))
+
+    return stream_map_options + set_length_seconds(
+        (hls_call.result() if hls_call is not None else ()) + dash_options,
+        video_info
+    )
+
+# Cached download info is used for at most this many seconds.
+DOWNLOAD_INFO_TTL = 60 * 30
+
+# Cached download info isn't used this many seconds before the signed
+# URLs in it expire.
+URL_EXPIRY_MARGIN = 60 * 2
+
+URL_EXPIRE_REGEX = re.compile(r"[?&/]expire[=/](\d+)")
+
+def url_expire_time(url):
+    """
+    Return the time a signed media URL expires at, or None if the URL
+    doesn't say when it expires.
+    """
+    match = URL_EXPIRE_REGEX.search(url)
+
+    return int(match.group(1)) if match else None
+
+class DownloadInfoCache (object):
+    """
+    This object keeps the DownloadInfo tuples for videos by video_id, so
+    the info doesn't need to be downloaded again when a download is retried.
+
+    Entries are used for up to 'ttl' seconds, or until just before the
+    first signed URL in them expires, whichever is sooner. When there are
+    more than max_size entries, the least recently used one is dropped.
+    """
+    def __init__(self, ttl= DOWNLOAD_INFO_TTL, max_size= 1024):
+        assert ttl >= 0
+        assert max_size >= 1
+
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hit_count = 0
+        self.miss_count = 0
+        self.__lock = Lock()
+        self.__entry_dict = OrderedDict()
+
+    def get(self, video_id):
+        """
+        Return the cached download options for a video, or None.
+        """
+        with self.__lock:
+            entry = self.__entry_dict.pop(video_id, None)
+
+            if entry is None or entry[0] <= time.time():
+                self.miss_count += 1
+
+                return None
+
+            # Put the entry back at the end, as the most recently used.
+            self.__entry_dict[video_id] = entry
+            self.hit_count += 1
+
+            return entry[1]
+
+    def put(self, video_id, download_options):
+        """
+        Cache the download options for a video.
+        """
+        download_options = tuple(download_options)
+        expire_time = time.time() + self.ttl
+
+        for option in download_options:
+            url_time = url_expire_time(option.url)
+
+            if url_time is not None:
+                expire_time = min(expire_time, url_time - URL_EXPIRY_MARGIN)
+
+        with self.__lock:
+            self.__entry_dict.pop(video_id, None)
+            self.__entry_dict[video_id] = (expire_time, download_options)
+
+            while len(self.__entry_dict) > self.max_size:
+                self.__entry_dict.popitem(last= False)
+
+    def invalidate(self, video_id):
+        """
+        Forget the cached download options for a video.
+        """
+        with self.__lock:
+            self.__entry_dict.pop(video_id, None)
+
+    def summary(self):
+        with self.__lock:
+            return "{} hits, {} misses".format(self.hit_count, self.miss_count)
+
+# This holds the download info for the videos downloaded by this module.
+DOWNLOAD_INFO_CACHE = DownloadInfoCache()
+
+def download_info_for_feed_item(feed_item, cache= DOWNLOAD_INFO_CACHE,
+satisfied= None):
+    """
+    Return a tuple of DownloadInfo objects for a feed item, from the cache
+    if it has them, or downloaded otherwise. 'satisfied' is passed on to
+    download_info.
+    """
+    download_options = cache.get(feed_item.video_id)
+
+    if download_options is None:
+        download_options = download_info(
+            create_info_url(feed_item.video_id),
+            satisfied
+        )
+        cache.put(feed_item.video_id, download_options)
+
+    return download_options
+
+class SelectionPolicy (object):
+    """
+    This object sets limits on the content highest_quality_content picks,
+    so the size of an archive can be traded against quality.
+
+    max_height limits the height of the video, in pixels. max_video_bitrate
+    limits the video bitrate, in Mbit/s. max_size limits the number of bytes
+    for the video and audio together, estimated from the bitrates, for
+    videos where the length is known.
+
+    preferred_formats is a sequence of file types, like ("mp4", "webm"),
+    which are preferred in that order over any other file types, before
+    the quality is compared. By default, open formats are preferred.
+
+    When no content is within the limits, the smallest content is picked.
+    """
+    def __init__(self, max_height= None, max_video_bitrate= None,
+    max_size= None, preferred_formats= ()):
+        assert max_height is None or max_height > 0
+        assert max_video_bitrate is None or max_video_bitrate > 0
+        assert max_size is None or max_size > 0
+
+        self.max_height = max_height
+        self.max_video_bitrate = max_video_bitrate
+        self.max_size = max_size
+        self.preferred_formats = tuple(preferred_formats)
+
+        if self.preferred_formats:
+            self.__video_rank_dict = rank_dict(
+                [
+                    media_type
+                    for media_type in ITAG_MAP.values()
+                    if media_type.has_video
+                ],
+                self.__preferred_video_rank_key
+            )
+        else:
+            self.__video_rank_dict = VIDEO_RANK_DICT
+
+        allowed_rank_list = [
+            self.__video_rank_dict[media_type.itag]
+            for media_type in ITAG_MAP.values()
+            if media_type.has_video and self.allows_video(media_type)
+        ]
+
+        # This is the best rank any video allowed by the limits could have.
+        # When the limits don't allow any video, this is None, and the
+        # policy is never satisfied early.
+        self.__best_video_rank = \
+            max(allowed_rank_list) if allowed_rank_list else None
+
+    def __preferred_video_rank_key(self, media_type):
+        if media_type.file_type in self.preferred_formats:
+            preference = -self.preferred_formats.index(media_type.file_type)
+        else:
+            preference = -len(self.preferred_formats)
+
+        return (preference,) + video_rank_key(media_type)
+
+    def video_rank(self, media_type):
+        return self.__video_rank_dict[media_type.itag]
+
+    def allows_video(self, media_type):
+        """
+        Return True if the video in a media type is within the limits.
+        """
+        return (
+            (
+                self.max_height is None
+                or media_type.resolution[1] <= self.max_height
+            )
+            and (
+                self.max_video_bitrate is None
+                or media_type.video_bitrate <= self.max_video_bitrate
+            )
+        )
+
+    def fits_size(self, option_seq):
+        """
+        Return True if the estimated size for some download options
+        together is within max_size, or if the size can't be estimated.
+        """
+        if self.max_size is None:
+            return True
+
+        size_list = [option.estimated_size() for option in option_seq]
+
+        return None in size_list or sum(size_list) <= self.max_size
+
+    def satisfied(self, download_options):
+        """
+        Return True if the best content which could be picked from
+        some download options can't be beaten by any other media type.
+
+        This can be given to download_info, so manifests aren't downloaded
+        when they can't offer anything better.
+        """
+        return any(
+            option.media_type.has_audio
+            and self.allows_video(option.media_type)
+            and self.fits_size((option,))
+            and self.video_rank(option.media_type) == self.__best_video_rank
+            for option in download_options
+            if option.media_type.has_video
+        )
+
+DEFAULT_SELECTION_POLICY = SelectionPolicy()
+
+def highest_quality_content(download_options, policy= None):
+    """
+    Select the highest quality content from a sequence of download options.
+    This can be either a single audio-video option, or a pair of two options
+    each with high quality audio and video as separate downloads.
+
+    If a SelectionPolicy is given, the content will be the best content
+    within the limits of the policy.
+    """
+    policy = policy or DEFAULT_SELECTION_POLICY
+
+    download_options = tuple(download_options)
+
+    video_list = sorted(
+        (
+            option
+            for option in download_options
+            if option.media_type.has_video
+        ),
+        key= lambda option: policy.video_rank(option.media_type),
+        reverse= True
+    )
+    audio_list = sorted(
+        (
+            option
+            for option in download_options
+            if not option.media_type.has_video
+        ),
+        key= lambda option: AUDIO_RANK_DICT[option.media_type.itag],
+        reverse= True
+    )
+
+    if not video_list:
+        raise RuntimeError("There is no video content to download")
+
+    def candidates():
+        """
+        Generate the content to pick from, from the best video down.
+        """
+        for option in video_list:
+            if option.media_type.has_audio:
+                yield option
+            else:
+                # Video only content is joined with the best audio which
+                # will fit.
+                for audio_option in audio_list:
+                    yield (option, audio_option)
+
+    def fits(content):
+        video_option = content[0] if isinstance(content, tuple) else content
+
+        return policy.allows_video(video_option.media_type) \
+            and policy.fits_size(
+                content if isinstance(content, tuple) else (content,)
+            )
+
+    def video_rank(content):
+        video_option = content[0] if isinstance(content, tuple) else content
+
+        return policy.video_rank(video_option.media_type)
+
+    best_content = None
+
+    for content in candidates():
+        if not fits(content):
+            continue
+
+        if best_content is None:
+            best_content = content
+        elif video_rank(content) < video_rank(best_content):
+            break
+        elif not isinstance(content, tuple) \
+        and isinstance(best_content, tuple):
+            # Audio-video content is used over split tracks of the same
+            # video quality.
+            best_content = content
+            break
+
+    if best_content is None:
+        if not any(True for content in candidates()):
+            raise RuntimeError("There is no content with audio to download")
+
+        # Nothing fits the limits, so use the smallest content.
+        best_content = min(
+            candidates(),
+            key= lambda content: (
+                sum(option.bits_per_second() for option in content)
+                if isinstance(content, tuple) else
+                content.bits_per_second()
+            )
+        )
+
+    return best_content
+
+class BackgroundCall (object):
+    """
+    This object calls a function in a background thread. The result
+    can be collected later, which will wait for the call to finish.
+    """
+    def __init__(self, function, *args):
+        self.__que = Queue(1)
+        self.__result = None
+
+        thread = Thread(target= self.__run, args= (function, args))
+        thread.daemon = True
+        thread.start()
+
+    def __run(self, function, args):
+        try:
+            self.__que.put((True, function(*args)))
+        except Exception as ex:
+            self.__que.put((False, ex))
+
+    def result(self):
+        """
+        Wait for the call to finish and return the value, or raise
+        the exception the function raised.
+        """
+        if self.__result is None:
+            self.__result = self.__que.get()
+
+        success, value = self.__result
+
+        if not success:
+            raise value
+
+        return value
+
+def remaining_page_indexes(total_results):
+    """
+    Given the total number of videos in a feed, or None if the total is
+    not known, return an iterable of the page indexes after the first page.
+    """
+    if total_results is None:
+        return count(1)
+
+    # Round the page count up, for the last partial page.
+    return range(1, (total_results + MAX_RESULTS - 1) // MAX_RESULTS)
+
+def feed_pages(username, prefetch= DEFAULT_PREFETCH_PAGES):
+    """
+    Generate the pages of the uploads feed for a user, in order, as
+    FeedPageDownload objects, which produce the FeedItems on each page as
+    they are downloaded. The last page is the first one with less than
+    MAX_RESULTS items in it, or the last one by the total for the feed.
+
+    The first page is downloaded with the total number of videos in the
+    feed, and once the total is known, up to 'prefetch' of the other pages
+    will be downloaded at the same time, while the current page is
+    being used.
+    """
+    assert isinstance(prefetch, int)
+    assert prefetch >= 0
+
+    def download_page(page_index):
+        return FeedPageDownload(create_feed_url(username, page_index))
+
+    page = FeedPageDownload(create_feed_url(username, 0, with_total= True))
+
+    page_index_iter = iter(remaining_page_indexes(page.total_results()))
+
+    # Start downloading the next pages before the first one is used.
+    pending_pages = deque(
+        download_page(page_index)
+        for page_index in islice(page_index_iter, prefetch)
+    )
+
+    while True:
+        yield page
+
+        if len(page) < MAX_RESULTS:
+            # This is the end of the feed. Any pages still being
+            # downloaded are past the end, so they are left alone.
+            break
+
+        if prefetch > 0:
+            if not pending_pages:
+                # There are no more pages, going by the total.
+                break
+
+            page = pending_pages.popleft()
+
+            for page_index in islice(page_index_iter, 1):
+                # Start downloading another page, so 'prefetch' pages are
+                # downloaded ahead again while this one is used.
+                pending_pages.append(download_page(page_index))
+        else:
+            page_index = next(page_index_iter, None)
+
+            if page_index is None:
+                break
+
+            page = download_page(page_index)
+
+def user_videos(username, prefetch= DEFAULT_PREFETCH_PAGES):
+    """
+    Generate a list of all videos for a user.
+
+    Up to 'prefetch' pages of the feed will be downloaded ahead of
+    the videos being generated. See feed_pages.
+    """
+    for entry_list in feed_pages(username, prefetch):
+        for entry in entry_list:
+            yield entry
+
+def base_filename_for_feed_item(feed_item):
+    """
+    Return a base filename for a YouTube feed item.
+
+    This is returned in the format <epoch>_<video_id>
+    """
+    return "{}_{}".format(
+        int(to_epoch(feed_item.upload_time)),
+        feed_item.video_id
+    )
+
+# The ways the files for videos can be laid out in a user directory.
+# "flat" puts every file straight in the user directory. "prefix" puts
+# files in directories named after the first two characters of the video
+# ID, and "date" puts files in <year>/<month> directories for the time
+# the video was uploaded, in UTC.
+DIRECTORY_LAYOUTS = ("flat", "prefix", "date")
+
+DEFAULT_LAYOUT = "flat"
+
+# This matches the names of all of the files for a video, and takes out
+# the base filename.
+BASE_FILENAME_REGEX = re.compile(r"^(\d+_[\w\-]{11})\.")
+
+def layout_directory(base_directory, base_filename, layout):
+    """
+    Return the directory the files for a base filename, as returned by
+    base_filename_for_feed_item, are kept in for a layout.
+    """
+    assert layout in DIRECTORY_LAYOUTS
+
+    if layout == "flat":
+        return base_directory
+
+    epoch, video_id = base_filename.split("_", 1)
+
+    if layout == "prefix":
+        return os.path.join(base_directory, video_id[:2])
+
+    upload_time = time.gmtime(int(epoch))
+
+    return os.path.join(
+        base_directory,
+        "{:04d}".format(upload_time.tm_year),
+        "{:02d}".format(upload_time.tm_mon)
+    )
+
+def json_filenames_for_feed_item(feed_item, base_directory,
+layout_seq= DIRECTORY_LAYOUTS):
+    """
+    Generate the filenames the JSON file for a feed item could have in
+    a directory, for each layout in a sequence of layouts.
+    """
+    base_filename = base_filename_for_feed_item(feed_item)
+
+    for layout in layout_seq:
+        yield os.path.join(
+            layout_directory(base_directory, base_filename, layout),
+            "{}.json".format(base_filename)
+        )
+
+def make_directories(directory):
+    """
+    Create a directory and the directories above it, if they aren't
+    there already.
+    """
+    try:
+        os.makedirs(directory)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+def prune_hidden_directories(directory_list):
+    """
+    Sort a list of directories from os.walk in place, and take out
+    the hidden ones, like the temporary directories for redownloads, so
+    they aren't walked.
+    """
+    directory_list[:] = sorted(
+        directory
+        for directory in directory_list
+        if not directory.startswith(".")
+    )
+
+# A user directory where every video is known to be in one layout has
+# the name of the layout in this file.
+LAYOUT_FILENAME = ".riptube-layout"
+
+def directory_layout(user_directory):
+    """
+    Return the layout every video in a user directory is in, or None if
+    that isn't known, because the directory may have videos in a mix of
+    layouts which haven't been migrated.
+    """
+    try:
+        with open(os.path.join(user_directory, LAYOUT_FILENAME)) as in_file:
+            layout = in_file.read().strip()
+    except (IOError, OSError):
+        return None
+
+    return layout if layout in DIRECTORY_LAYOUTS else None
+
+def set_directory_layout(user_directory, layout):
+    """
+    Record the layout every video in a user directory is in, or that it
+    isn't known, if layout is None.
+    """
+    filename = os.path.join(user_directory, LAYOUT_FILENAME)
+
+    if layout is None:
+        if os.path.exists(filename):
+            os.remove(filename)
+    else:
+        assert layout in DIRECTORY_LAYOUTS
+
+        with open(filename, "w") as out_file:
+            out_file.write(layout + "\n")
+
+def prepare_user_directory(user_directory, layout):
+    """
+    Make a user directory for downloading videos into a layout, if it
+    isn't there already. A new directory is recorded as being in
+    the layout. If the directory is recorded as being in another layout,
+    that is forgotten, as videos in this one will be added to it.
+    """
+    if not os.path.exists(user_directory):
+        os.mkdir(user_directory)
+        set_directory_layout(user_directory, layout)
+    elif directory_layout(user_directory) not in (None, layout):
+        set_directory_layout(user_directory, None)
+
+def needs_any_layout(user_directory, layout):
+    """
+    Return True if videos in a user directory could be in layouts other
+    than 'layout', because the directory isn't known to be in it. That is
+    known once migrate_layout has finished for the directory.
+    """
+    return directory_layout(user_directory) != layout
+
+def archive_layouts(user_directory, layout, any_layout= None):
+    """
+    Return a tuple of the layouts to look for downloaded videos in, in
+    a user directory, starting with 'layout'.
+
+    If any_layout is True, every layout is used, and if it is False, only
+    'layout' is. If it is None, needs_any_layout decides.
+    """
+    if any_layout is None:
+        any_layout = needs_any_layout(user_directory, layout)
+
+    if not any_layout:
+        return (layout,)
+
+    return (layout,) + tuple(
+        other_layout
+        for other_layout in DIRECTORY_LAYOUTS
+        if other_layout != layout
+    )
+
+def migrate_layout(user_directory, layout, catalog= None):
+    """
+    Move the files for videos in a user directory into a layout, in place,
+    and return the number of videos which were moved. The files can be in
+    any layout, or a mix of them, to begin with.
+
+    The JSON file for each video is moved last, so if the migration stops,
+    the videos with JSON files in the new places are complete, and running
+    the migration again will move the rest. Directories left empty are
+    removed. If an ArchiveCatalog is given, the filenames in it are
+    updated for the videos which were moved. Once every video has been
+    moved, the directory is recorded as being in the layout, so other
+    layouts aren't looked in for it any more.
+    """
+    assert layout in DIRECTORY_LAYOUTS
+
+    move_list = []
+
+    for directory, directory_list, filename_list in os.walk(user_directory):
+        prune_hidden_directories(directory_list)
+
+        for filename in filename_list:
+            match = BASE_FILENAME_REGEX.match(filename)
+
+            if match is None:
+                continue
+
+            new_directory = layout_directory(
+                user_directory,
+                match.group(1),
+                layout
+            )
+
+            if os.path.normpath(directory) != os.path.normpath(new_directory):
+                move_list.append((directory, new_directory, filename))
+
+    move_list.sort(key= lambda move: move[2].endswith(".json"))
+
+    video_move_list = []
+
+    for directory, new_directory, filename in move_list:
+        make_directories(new_directory)
+        os.rename(
+            os.path.join(directory, filename),
+            os.path.join(new_directory, filename)
+        )
+
+        if filename.endswith(".json"):
+            video_move_list.append((
+                BASE_FILENAME_REGEX.match(filename).group(1).split("_", 1)[1],
+                new_directory
+            ))
+
+    user_directory = os.path.normpath(user_directory)
+
+    for directory in set(move[0] for move in move_list):
+        directory = os.path.normpath(directory)
+
+        # Remove the directory, and the ones above it, until one isn't empty.
+        while directory != user_directory \
+        and directory.startswith(user_directory):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+
+            directory = os.path.dirname(directory)
+
+    if catalog is not None:
+        catalog.move_videos(video_move_list)
+
+    set_directory_layout(user_directory, layout)
+
+    return len(video_move_list)
+
+# Files will not be split into segments smaller than this.
+MIN_SEGMENT_SIZE = 1024 * 1024
+
+# The default size of the buffer for copying downloads into files.
+COPY_BUFFER_SIZE = 1024 * 256
+
+# Writes with O_DIRECT have to start at offsets which are multiples of this,
+# from memory aligned to it, with lengths which are multiples of it.
+DIRECT_IO_ALIGNMENT = 4096
+
+DIRECT_IO_SUPPORTED = hasattr(os, "O_DIRECT") and not PYTHON_2
+
+# The hashes which can be recorded for downloaded files.
+HASH_ALGORITHMS = tuple(
+    algorithm
+    for algorithm in ("sha256", "blake2b")
+    if algorithm in getattr(hashlib, "algorithms_guaranteed", ("sha256",))
+)
+
+DEFAULT_HASH_ALGORITHM = "sha256"
+
+# Passing pipes to ffmpeg needs pass_fds, which Python 2 doesn't have.
+STREAM_MUX_SUPPORTED = os.name == "posix" and not PYTHON_2
+
+# Downloads are slowed down in steps of about this many seconds.
+BANDWIDTH_SLICE_TIME = 0.1
+
+# Unused bandwidth can be saved up for this many seconds.
+BANDWIDTH_BURST_TIME = 0.5
+
+BYTE_COUNT_REGEX = re.compile(r"^(\d+(?:\.\d+)?)([kmg]?)$", re.IGNORECASE)
+
+def parse_byte_count(text):
+    """
+    Parse a number of bytes, like "500K" or "1.5M", where K, M and G are
+    powers of 1024.
+    """
+    match = BYTE_COUNT_REGEX.match(text.strip())
+
+    if match is None or float(match.group(1)) <= 0:
+        raise ValueError("Invalid number of bytes: {}".format(text))
+
+    return int(
+        float(match.group(1))
+        * 1024 ** " kmg".index(match.group(2).lower() or " ")
+    )
+
+def parse_byte_rate(text):
+    """
+    Parse a number of bytes per second, like parse_byte_count does. None is
+    returned for "unlimited".
+    """
+    if text.strip().lower() == "unlimited":
+        return None
+
+    return parse_byte_count(text)
+
+def parse_bandwidth_schedule(text):
+    """
+    Parse a schedule like "08:00=1M,18:00=10M,23:00=unlimited" into a sorted
+    list of pairs (minute_of_day, rate), where each rate is used from its
+    time of day until the next time.
+    """
+    schedule = []
+
+    for part in text.split(","):
+        time_text, equals, rate_text = part.partition("=")
+        time_match = re.match(r"^(\d{1,2}):(\d{2})$", time_text.strip())
+
+        if not equals or time_match is None:
+            raise ValueError("Invalid schedule entry: {}".format(part))
+
+        hour, minute = int(time_match.group(1)), int(time_match.group(2))
+
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError("Invalid time of day: {}".format(time_text))
+
+        schedule.append((hour * 60 + minute, parse_byte_rate(rate_text)))
+
+    return sorted(schedule)
+
+def _min_rate(*rate_seq):
+    """
+    Return the lowest rate, where None means no limit.
+    """
+    limited_list = [rate for rate in rate_seq if rate is not None]
+
+    return min(limited_list) if limited_list else None
+
+class BandwidthGovernor (object):
+    """
+    This object limits the bytes per second for all downloads together.
+
+    The limit is max_rate, or the rate from a time of day schedule made with
+    parse_bandwidth_schedule, whichever is lower. None means no limit.
+    The limit is shared fairly between the downloads which are running,
+    and each download can have a lower limit of its own.
+
+    Downloads use the limit through a BandwidthShare from share().
+    """
+    def __init__(self, max_rate= None, schedule= ()):
+        self.max_rate = max_rate
+        self.schedule = list(schedule)
+        self.__lock = Lock()
+        self.__next_time = 0.0
+        self.__active_count = 0
+        self.wait_time = 0.0
+
+    @property
+    def limited(self):
+        return self.max_rate is not None or bool(self.schedule)
+
+    def current_rate(self, now= None):
+        """
+        Return the limit for all downloads at a datetime, by default now.
+        """
+        if not self.schedule:
+            return self.max_rate
+
+        now = now or datetime.datetime.now()
+        minute_of_day = now.hour * 60 + now.minute
+
+        # Before the first time, the last rate from the day before is used.
+        scheduled_rate = self.schedule[-1][1]
+
+        for start_minute, rate in self.schedule:
+            if start_minute <= minute_of_day:
+                scheduled_rate = rate
+
+        return _min_rate(self.max_rate, scheduled_rate)
+
+    def share(self, max_rate= None):
+        """
+        Return a BandwidthShare for one download, with an optional limit
+        of its own.
+        """
+        return BandwidthShare(self, max_rate)
+
+    def _add(self, share):
+        with self.__lock:
+            self.__active_count += 1
+
+    def _remove(self, share):
+        with self.__lock:
+            self.__active_count -= 1
+
+    def _share_rate(self, share):
+        """
+        Return the rate one download can use now, or None if there's
+        no limit.
+        """
+        global_rate = self.current_rate()
+
+        if global_rate is not None:
+            global_rate = float(global_rate) / max(self.__active_count, 1)
+
+        return _min_rate(global_rate, share.max_rate)
+
+    def _reserve(self, share, byte_count):
+        """
+        Record that some bytes were downloaded, and return the number of
+        seconds to wait so the limits aren't passed.
+        """
+        with self.__lock:
+            now = time.time()
+            delay = 0.0
+            global_rate = self.current_rate()
+
+            if global_rate is not None:
+                self.__next_time = max(
+                    self.__next_time,
+                    now - BANDWIDTH_BURST_TIME
+                ) + float(byte_count) / global_rate
+                delay = self.__next_time - now
+
+            share_rate = self._share_rate(share)
+
+            if share_rate is not None:
+                share.next_time = max(
+                    share.next_time,
+                    now - BANDWIDTH_BURST_TIME
+                ) + float(byte_count) / share_rate
+                delay = max(delay, share.next_time - now)
+
+            if delay > 0:
+                self.wait_time += delay
+
+            return delay
+
+    def summary(self):
+        """
+        Return a line describing how much downloads have been slowed down.
+        """
+        with self.__lock:
+            rate = self.current_rate()
+
+            return "{} limit, {:.1f}s waiting".format(
+                "no" if rate is None else "{} bytes/s".format(rate),
+                self.wait_time
+            )
+
+class BandwidthShare (object):
+    """
+    This object is the share of a BandwidthGovernor for one download,
+    which can be used by several threads for the ranges of the download.
+
+    The share should be used with 'with', so the governor knows how many
+    downloads are sharing the limit.
+    """
+    def __init__(self, governor, max_rate= None):
+        assert max_rate is None or max_rate > 0
+
+        self.governor = governor
+        self.max_rate = max_rate
+        # A new download doesn't have any unused bandwidth saved up.
+        self.next_time = time.time()
+
+    @property
+    def limited(self):
+        return self.max_rate is not None or self.governor.limited
+
+    def read_size(self, size):
+        """
+        Return how much of 'size' bytes should be read at once, so
+        the download is slowed down in small steps, not long pauses.
+        """
+        if not self.limited:
+            return size
+
+        rate = self.governor._share_rate(self)
+
+        if rate is None:
+            return size
+
+        step_size = int(rate * BANDWIDTH_SLICE_TIME)
+        step_size -= step_size % DIRECT_IO_ALIGNMENT
+
+        return min(size, max(step_size, DIRECT_IO_ALIGNMENT))
+
+    def throttle(self, byte_count):
+        """
+        Wait after some bytes have been downloaded, if that's needed to
+        keep to the limits.
+        """
+        if self.limited:
+            delay = self.governor._reserve(self, byte_count)
+
+            if delay > 0:
+                time.sleep(delay)
+
+    def __enter__(self):
+        self.governor._add(self)
+
+        return self
+
+    def __exit__(self, *args):
+        self.governor._remove(self)
+
+# This limits the bandwidth for all of the downloads made by this module.
+BANDWIDTH_GOVERNOR = BandwidthGovernor()
+
+class TransferOptions (object):
+    """
+    This object holds options for how media files are downloaded.
+
+    segment_count is the number of Range requests a file will be split
+    into, which will be downloaded at the same time.
+
+    If stream_mux is True, separate video and audio tracks will be sent
+    straight into ffmpeg as they are downloaded, instead of being written
+    to track files first. See stream_mux_to_file.
+
+    buffer_size is the number of bytes read from the network for each
+    write. If preallocate is True, the space for files of a known size is
+    reserved on disk before they are written, which stops large files
+    being fragmented. If direct_io is True, files are written with O_DIRECT,
+    which skips the page cache. If sync_interval is set, data is flushed to
+    disk after that many bytes are written. See copy_to_file.
+
+    If max_download_rate is set, each file will be downloaded at no more
+    than that many bytes per second. The limit for all downloads together
+    is set with BANDWIDTH_GOVERNOR.
+
+    hash_algorithm is the hash computed for files as they are written,
+    from HASH_ALGORITHMS, or None for no hashes.
+    """
+    def __init__(self, segment_count= 1, stream_mux= False,
+    buffer_size= COPY_BUFFER_SIZE, preallocate= True, direct_io= False,
+    sync_interval= None, max_download_rate= None,
+    hash_algorithm= DEFAULT_HASH_ALGORITHM):
+        assert isinstance(segment_count, int)
+        assert segment_count >= 1
+        assert not stream_mux or STREAM_MUX_SUPPORTED
+        assert isinstance(buffer_size, int)
+        assert buffer_size >= 1
+        assert not direct_io or DIRECT_IO_SUPPORTED
+        assert not direct_io or buffer_size % DIRECT_IO_ALIGNMENT == 0
+        assert sync_interval is None or sync_interval >= 1
+        assert max_download_rate is None or max_download_rate > 0
+        assert hash_algorithm is None or hash_algorithm in HASH_ALGORITHMS
+
+        self.segment_count = segment_count
+        self.stream_mux = stream_mux
+        self.buffer_size = buffer_size
+        self.preallocate = preallocate
+        self.direct_io = direct_io
+        self.sync_interval = sync_interval
+        self.max_download_rate = max_download_rate
+        self.hash_algorithm = hash_algorithm
+
+DEFAULT_TRANSFER_OPTIONS = TransferOptions()
+
+def open_byte_range(url, start, end= None):
+    """
+    Request the bytes from start to end, inclusive, for a URL, or to the end
+    of the file if end is None.
+
+    The server may ignore the range and send the whole file, in which case
+    the response status will be 200 instead of 206.
+    """
+    if end is None:
+        byte_range = "bytes={}-".format(start)
+    else:
+        byte_range = "bytes={}-{}".format(start, end)
+
+    headers = browser_spoof_headers()
+    headers["Range"] = byte_range
+
+    return HTTP_POOL.open(url, headers, timeout= 1)
+
+CONTENT_RANGE_REGEX = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+def parse_content_range(response):
+    """
+    Return a triple (start, end, total) for the Content-Range header of
+    a response, or None if the response doesn't have one.
+    """
+    match = CONTENT_RANGE_REGEX.match(
+        (response.getheader("Content-Range") or "").strip()
+    )
+
+    if response.status != 206 or match is None:
+        return None
+
+    return tuple(int(number) for number in match.groups())
+
+def split_byte_range(size, segment_count):
+    """
+    Split a number of bytes into up to segment_count pairs (start, end),
+    where end is exclusive. No segment but the last will be smaller
+    than MIN_SEGMENT_SIZE.
+    """
+    segment_count = max(1, min(segment_count, size // MIN_SEGMENT_SIZE))
+    segment_size = size // segment_count
+    # Segments start on aligned offsets, so they can be written with O_DIRECT.
+    segment_size -= segment_size % DIRECT_IO_ALIGNMENT
+
+    return tuple(
+        (
+            index * segment_size,
+            size if index == segment_count - 1 else (index + 1) * segment_size
+        )
+        for index in range(segment_count)
+    )
+
+def write_all(out_file, data):
+    """
+    Write all of some data to an unbuffered file.
+    """
+    view = memoryview(data)
+
+    while view:
+        view = view[out_file.write(view):]
+
+def allocate_file(out_file, size, preallocate= True):
+    """
+    Make an open file the given size, so ranges can be written anywhere.
+
+    If preallocate is True, the space for the file will be reserved on disk
+    with posix_fallocate, where that is available.
+    """
+    out_file.truncate(size)
+
+    if preallocate and size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(out_file.fileno(), 0, size)
+        except OSError:
+            # Some file systems can't do this, and that's fine.
+            pass
+
+def _read_into(source, view):
+    """
+    Read data from a file-like source into a memoryview, and return the
+    number of bytes read, which will be 0 at the end of the data.
+    """
+    if hasattr(source, "readinto"):
+        return source.readinto(view) or 0
+
+    data = source.read(len(view))
+    view[:len(data)] = data
+
+    return len(data)
+
+def _open_direct(filename):
+    """
+    Open a file for writing with O_DIRECT, or return None if the file
+    system doesn't support that.
+    """
+    try:
+        return os.open(filename, os.O_WRONLY | os.O_DIRECT)
+    except OSError as err:
+        if err.errno != errno.EINVAL:
+            raise
+
+        return None
+
+def _sync_file(fd):
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+def hash_file_range(filename, start, end, hasher,
+buffer_size= COPY_BUFFER_SIZE):
+    """
+    Update a hash object with the bytes of a file from 'start' up to 'end',
+    or to the end of the file if 'end' is None.
+    """
+    view = memoryview(bytearray(buffer_size))
+
+    with open(filename, "rb", buffering= 0) as in_file:
+        in_file.seek(start)
+        position = start
+
+        while end is None or position < end:
+            limit = buffer_size if end is None else min(
+                buffer_size,
+                end - position
+            )
+            read_count = _read_into(in_file, view[:limit])
+
+            if not read_count:
+                break
+
+            hasher.update(view[:read_count])
+            position += read_count
+
+def file_hash_json(algorithm, size, segment_list):
+    """
+    Return the JSON recorded for the hashes of a file, given a list of
+    (start, end, hexdigest) triples for the segments it was written in.
+
+    A file written in one piece has one hash, and a file written in
+    several segments at the same time has a hash for each segment.
+    """
+    if len(segment_list) == 1:
+        return {
+            "algorithm": algorithm,
+            "size": size,
+            "hash": segment_list[0][2],
+        }
+
+    return {
+        "algorithm": algorithm,
+        "size": size,
+        "segments": [list(segment) for segment in segment_list],
+    }
+
+def hash_file(filename, algorithm):
+    """
+    Read a whole file, and return the JSON for its hash.
+    """
+    size = os.path.getsize(filename)
+    hasher = hashlib.new(algorithm)
+    hash_file_range(filename, 0, size, hasher)
+
+    return file_hash_json(algorithm, size, [(0, size, hasher.hexdigest())])
+
+def copy_to_file(source, filename, start, end= None,
+transfer_options= DEFAULT_TRANSFER_OPTIONS, on_write= None,
+bandwidth_share= None, hasher= None):
+    """
+    Copy the data from a file-like source, like an HTTP response, into an
+    existing file from byte 'start', up to byte 'end' if it is given, or
+    to the end of the data otherwise.
+
+    The data is read into one buffer which is used again for every read,
+    so no new objects are made for the data. With direct_io in the transfer
+    options, the data is written with O_DIRECT where it is aligned, and
+    written normally at the edges where it isn't. With a sync_interval,
+    the data is flushed to disk after that many bytes.
+
+    If on_write is given, it will be called with the number of bytes
+    which were written after each write. If a BandwidthShare is given,
+    the copy will be slowed down to keep to its limits. If a hash object
+    from hashlib is given, it will be updated with the data from the same
+    buffer as it is written, so the data isn't read again. The position after
+    the last byte written is returned. IncompleteRead will be raised if
+    the data ends before 'end'.
+    """
+    buffer_size = transfer_options.buffer_size
+    sync_interval = transfer_options.sync_interval
+
+    direct_fd = _open_direct(filename) if transfer_options.direct_io else None
+
+    try:
+        if direct_fd is None:
+            view = memoryview(bytearray(buffer_size))
+        else:
+            # Anonymous memory maps are aligned to pages.
+            view = memoryview(mmap.mmap(-1, buffer_size))
+
+        with open(filename, "r+b", buffering= 0) as out_file:
+            position = start
+            fill = 0
+            unsynced_count = 0
+
+            while end is None or position < end:
+                aligned = position % DIRECT_IO_ALIGNMENT == 0
+
+                if fill > 0:
+                    # Keep filling up to the same limit.
+                    pass
+                elif direct_fd is None or aligned:
+                    limit = buffer_size
+
+                    if bandwidth_share is not None:
+                        limit = bandwidth_share.read_size(limit)
+                else:
+                    # Fill up to the next aligned offset first.
+                    limit = (
+                        DIRECT_IO_ALIGNMENT
+                        - position % DIRECT_IO_ALIGNMENT
+                    )
+
+                if end is not None and fill == 0:
+                    limit = min(limit, end - position)
+
+                read_count = _read_into(source, view[fill:limit])
+                fill += read_count
+
+                if read_count and fill < limit:
+                    continue
+
+                # The buffer is full, or the data ended, so write it out.
+                if hasher is not None and fill:
+                    hasher.update(view[:fill])
+
+                if direct_fd is not None and aligned:
+                    direct_size = fill - fill % DIRECT_IO_ALIGNMENT
+                else:
+                    direct_size = 0
+
+                if direct_size:
+                    os.lseek(direct_fd, position, os.SEEK_SET)
+                    direct_view = view[:direct_size]
+
+                    while direct_view:
+                        direct_view = direct_view[
+                            os.write(direct_fd, direct_view):
+                        ]
+
+                if fill > direct_size:
+                    out_file.seek(position + direct_size)
+                    write_all(out_file, view[direct_size:fill])
+
+                position += fill
+
+                if sync_interval is not None:
+                    unsynced_count += fill
+
+                    if unsynced_count >= sync_interval:
+                        _sync_file(out_file.fileno())
+                        unsynced_count = 0
+
+                if on_write is not None and fill:
+                    on_write(fill)
+
+                if bandwidth_share is not None and fill:
+                    bandwidth_share.throttle(fill)
+
+                fill = 0
+
+                if not read_count:
+                    if end is not None:
+                        raise http_client.IncompleteRead(b"", end - position)
+
+                    # That was the end of a file of unknown size.
+                    break
+
+            if unsynced_count:
+                _sync_file(out_file.fileno())
+    finally:
+        if direct_fd is not None:
+            os.close(direct_fd)
+
+    return position
+
+# The progress for a download is saved after this many bytes.
+RESUME_SAVE_INTERVAL = 1024 * 1024 * 4
+
+class PartialDownload (object):
+    """
+    This object records the progress of a download into a .part file, so
+    an interrupted download can be continued later.
+
+    The progress is saved in a .resume file next to the download, which
+    records the itag of the media and the byte ranges of the file with
+    how much of each range has been written. The URL isn't saved, because
+    the URLs expire. The hash of each range is saved when the range is
+    finished, if the file is being hashed.
+    """
+    def __init__(self, filename, itag, size, range_list, complete= False,
+    hash_algorithm= None, hash_list= None):
+        assert itag is None or isinstance(itag, int)
+        assert size is None or isinstance(size, int)
+        assert hash_list is None or len(hash_list) == len(range_list)
+
+        self.filename = filename
+        self.itag = itag
+        self.size = size
+        # A list of [start, end, done] lists, where end is exclusive, and
+        # None if the size isn't known, and done is the next byte to write.
+        self.range_list = range_list
+        self.complete = complete
+        self.hash_algorithm = hash_algorithm
+        # The hex digest for each finished range, or None.
+        self.hash_list = hash_list or [None] * len(range_list)
+        self.__lock = Lock()
+
+    @property
+    def part_filename(self):
+        return self.filename + ".part"
+
+    @property
+    def state_filename(self):
+        return self.filename + ".resume"
+
+    @property
+    def bytes_done(self):
+        """
+        Return the number of bytes which have been written so far.
+        """
+        return sum(done - start for start, end, done in self.range_list)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load the progress for a download to a filename, or return None if
+        there is no saved progress, or it can't be read.
+        """
+        try:
+            with open(filename + ".resume") as state_file:
+                state = json.load(state_file)
+
+            return cls(
+                filename,
+                state["itag"],
+                state["size"],
+                [list(byte_range) for byte_range in state["ranges"]],
+                state["complete"],
+                state.get("hash_algorithm"),
+                state.get("hashes")
+            )
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def hash_json(self, algorithm):
+        """
+        Return the JSON for the hashes of the downloaded file, hashing any
+        ranges which don't have a hash for the algorithm yet by reading
+        them from the file, or None if the algorithm is None.
+        """
+        if algorithm is None:
+            return None
+
+        if algorithm != self.hash_algorithm:
+            self.hash_algorithm = algorithm
+            self.hash_list = [None] * len(self.range_list)
+
+        filename = self.filename if self.complete else self.part_filename
+
+        for range_index, (start, end, done) in enumerate(self.range_list):
+            if self.hash_list[range_index] is None:
+                hasher = hashlib.new(algorithm)
+                hash_file_range(filename, start, done, hasher)
+                self.hash_list[range_index] = hasher.hexdigest()
+
+        return file_hash_json(algorithm, self.size, [
+            (start, done, hex_digest)
+            for (start, end, done), hex_digest in
+            zip(self.range_list, self.hash_list)
+        ])
+
+    def advance(self, range_index, byte_count):
+        """
+        Record that some more bytes were written for a range.
+        """
+        with self.__lock:
+            self.range_list[range_index][2] += byte_count
+
+    def save(self):
+        """
+        Save the progress to the .resume file.
+        """
+        with self.__lock:
+            temp_filename = self.state_filename + ".tmp"
+
+            with open(temp_filename, "w") as state_file:
+                json.dump({
+                    "itag": self.itag,
+                    "size": self.size,
+                    "ranges": self.range_list,
+                    "complete": self.complete,
+                    "hash_algorithm": self.hash_algorithm,
+                    "hashes": self.hash_list,
+                }, state_file)
+
+            replace_file(temp_filename, self.state_filename)
+
+def replace_file(source, destination):
+    """
+    Rename a file, replacing the destination if it exists.
+    """
+    if hasattr(os, "replace"):
+        os.replace(source, destination)
+    else:
+        if os.path.exists(destination):
+            os.remove(destination)
+
+        os.rename(source, destination)
+
+def remove_download_state(filename):
+    """
+    Remove the saved progress and any partial data for a download.
+
+    This should be called once a downloaded file has been used, as the
+    progress will say a finished download is already done.
+    """
+    for suffix in (".resume", ".part"):
+        if os.path.exists(filename + suffix):
+            os.remove(filename + suffix)
+
+class RangeNotSupported (Exception):
+    """
+    This exception is raised when a server doesn't answer a Range request
+    with the range which was asked for, so a download can't be continued.
+    """
+    pass
+
+def _open_range_for_resume(url, partial, range_index):
+    start, end, done = partial.range_list[range_index]
+
+    download_conn = open_byte_range(
+        url,
+        done,
+        end - 1 if end is not None else None
+    )
+
+    content_range = parse_content_range(download_conn)
+
+    if content_range is None \
+    or content_range[0] != done \
+    or (end is not None and content_range[1] != end - 1) \
+    or (partial.size is not None and content_range[2] != partial.size):
+        download_conn.close()
+
+        raise RangeNotSupported(
+            "Bad response for bytes {}- of {}".format(done, url)
+        )
+
+    return download_conn
+
+def _download_ranges(url, partial, first_conn= None,
+transfer_options= DEFAULT_TRANSFER_OPTIONS):
+    """
+    Download the unfinished ranges for a partial download at the same
+    time, and rename the .part file when all of them are finished.
+
+    If first_conn is given, it will be used for the first range.
+
+    If the transfer options have a hash_algorithm, each range is hashed as
+    it is written, starting with the bytes already written for ranges
+    which are being continued. The JSON for the hashes is returned.
+    """
+    hash_algorithm = transfer_options.hash_algorithm
+
+    if hash_algorithm != partial.hash_algorithm:
+        partial.hash_algorithm = hash_algorithm
+        partial.hash_list = [None] * len(partial.range_list)
+
+    def download_range(range_index):
+        start, end, done = partial.range_list[range_index]
+
+        if range_index == 0 and first_conn is not None:
+            download_conn = first_conn
+        else:
+            download_conn = _open_range_for_resume(url, partial, range_index)
+
+        partial.hash_list[range_index] = None
+
+        if hash_algorithm is not None:
+            hasher = hashlib.new(hash_algorithm)
+
+            if done > start:
+                hash_file_range(partial.part_filename, start, done, hasher)
+        else:
+            hasher = None
+
+        # This is a list so it can be changed in the function below.
+        unsaved_count = [0]
+
+        def on_write(byte_count):
+            partial.advance(range_index, byte_count)
+            unsaved_count[0] += byte_count
+
+            if unsaved_count[0] >= RESUME_SAVE_INTERVAL:
+                partial.save()
+                unsaved_count[0] = 0
+
+        with download_conn:
+            done = copy_to_file(
+                download_conn,
+                partial.part_filename,
+                done,
+                end,
+                transfer_options,
+                on_write,
+                bandwidth_share,
+                hasher
+            )
+
+        if end is None:
+            partial.range_list[range_index][1] = done
+            partial.size = done
+
+        if hasher is not None:
+            partial.hash_list[range_index] = hasher.hexdigest()
+
+    unfinished_index_list = [
+        range_index
+        for range_index, (start, end, done) in enumerate(partial.range_list)
+        if end is None or done < end
+    ]
+
+    # The ranges of one file share one part of the bandwidth.
+    bandwidth_share = BANDWIDTH_GOVERNOR.share(
+        transfer_options.max_download_rate
+    )
+
+    try:
+        with bandwidth_share:
+            run_in_threads(
+                download_range,
+                unfinished_index_list,
+                max(len(unfinished_index_list), 1)
+            )
+    finally:
+        if first_conn is not None:
+            # Close the first response, in case it wasn't needed.
+            first_conn.close()
+
+        # Save what was done, even if the download failed.
+        partial.save()
+
+    hash_json = partial.hash_json(hash_algorithm)
+
+    replace_file(partial.part_filename, partial.filename)
+    partial.complete = True
+    partial.save()
+
+    return hash_json
+
+def _start_download(url, filename, itag, transfer_options):
+    try:
+        # Ask for everything, so the same response can be used if the
+        # server doesn't support ranges.
+        first_conn = open_byte_range(url, 0)
+    except HTTPError as err:
+        if err.code != 416:
+            raise err
+
+        # A range can't be satisfied for an empty file.
+        first_conn = browser_spoof_open(url)
+
+    try:
+        content_range = parse_content_range(first_conn)
+
+        if content_range is None or content_range[0] != 0:
+            # The server doesn't support ranges, so use one stream
+            # and hope that ranges work if it needs to be continued.
+            content_length = first_conn.getheader("Content-Length")
+            total_size = int(content_length) if content_length else None
+
+            partial = PartialDownload(
+                filename,
+                itag,
+                total_size,
+                [[0, total_size, 0]]
+            )
+        else:
+            total_size = content_range[2]
+
+            partial = PartialDownload(filename, itag, total_size, [
+                [start, end, start]
+                for start, end in
+                split_byte_range(total_size, transfer_options.segment_count)
+            ])
+
+        with open(partial.part_filename, "wb") as out_file:
+            if partial.size is not None:
+                allocate_file(
+                    out_file,
+                    partial.size,
+                    transfer_options.preallocate
+                )
+
+        partial.save()
+    except:
+        first_conn.close()
+        raise
+
+    return _download_ranges(url, partial, first_conn, transfer_options)
+
+def download_to_file(url, filename,
+transfer_options= DEFAULT_TRANSFER_OPTIONS, itag= None):
+    """
+    Download an entire file to a given filename.
+
+    If the transfer options ask for more than one segment and the server
+    supports Range requests, the file will be split into byte ranges which
+    are downloaded at the same time, and written to their places in
+    the file. Otherwise, the file is downloaded in one stream.
+
+    The data is written to <filename>.part, with the progress saved in
+    <filename>.resume. If this function is called again for the same itag
+    after a download failed, possibly with a new URL, the download will
+    continue where it stopped. If the download already finished, nothing
+    will be done. Call remove_download_state to forget the progress.
+
+    The JSON for the hashes of the file is returned, or None if
+    the transfer options don't have a hash_algorithm.
+    """
+    partial = PartialDownload.load(filename)
+
+    if partial is not None and partial.itag == itag:
+        if partial.complete and os.path.exists(filename):
+            # The file was already downloaded.
+            hash_json = partial.hash_json(transfer_options.hash_algorithm)
+            partial.save()
+
+            return hash_json
+
+        if not partial.complete and os.path.exists(partial.part_filename):
+            try:
+                return _download_ranges(
+                    url,
+                    partial,
+                    transfer_options= transfer_options
+                )
+            except RangeNotSupported:
+                # The download can't be continued, so start again.
+                pass
+
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    remove_download_state(filename)
+
+    return _start_download(url, filename, itag, transfer_options)
+
+def mux_command(video_filename, audio_filename, output_filename):
+    """
+    Return the ffmpeg command for joining separate video and audio files
+    together into one output file, without encoding them again.
+    """
+    return (
+        "ffmpeg",
+        "-i", video_filename,
+        "-i", audio_filename,
+        "-c", "copy", os.path.abspath(output_filename)
+    )
+
+def download_tracks(content, track_filename_list,
+transfer_options= DEFAULT_TRANSFER_OPTIONS):
+    """
+    Download a pair of (video, audio) DownloadInfo objects to a pair of
+    track filenames at the same time.
+
+    A list of the JSON for the hashes of the tracks is returned, like for
+    download_to_file.
+    """
+    que = Queue()
+    exception_queue = Queue()
+    hash_json_list = [None, None]
+
+    def download_in_queue():
+        try:
+            track_index, args = que.get()
+            hash_json_list[track_index] = download_to_file(*args)
+        except Exception as ex:
+            exception_queue.put(ex)
+
+            # TODO: It would be nice to be able to terminate the other
+            # thread here.
+
+            if isinstance(ex, (KeyboardInterrupt, SystemExit)):
+                # Re-raise interrupts so cleanup code works.
+                raise ex
+        finally:
+            que.task_done()
+
+    for track_index, (track, track_filename) in enumerate(
+        zip(content, track_filename_list)
+    ):
+        que.put((track_index, (
+            track.url,
+            track_filename,
+            transfer_options,
+            track.media_type.itag
+        )))
+
+    for i in range(2):
+        Thread(target= download_in_queue).start()
+
+    que.join()
+
+    if not exception_queue.empty():
+        raise exception_queue.get()
+
+    return hash_json_list
+
+def mux_tracks(track_filename_list, video_filename):
+    """
+    Join a pair of (video, audio) track files together into the video file
+    with ffmpeg, and then remove the track files.
+    """
+    if os.path.exists(video_filename):
+        # Delete the video file if ffmpeg was stopped before.
+        os.remove(video_filename)
+
+    subprocess.check_call(mux_command(
+        track_filename_list[0],
+        track_filename_list[1],
+        video_filename
+    ))
+
+    # Clean up the track files.
+    for track_filename in track_filename_list:
+        os.remove(track_filename)
+        remove_download_state(track_filename)
+
+def stream_mux_to_file(video_url, audio_url, output_filename,
+transfer_options= DEFAULT_TRANSFER_OPTIONS, track_hash_list= None):
+    """
+    Download separate video and audio tracks straight into ffmpeg through
+    pipes, so the tracks are joined together into the output file as the
+    data arrives, without writing the tracks to disk first.
+
+    Return True if the output file was written. Return False if ffmpeg
+    failed, as it will for tracks which can't be read without seeking,
+    in which case the tracks should be downloaded to files instead.
+    Request errors will be raised, and the output file will be removed.
+
+    Streamed downloads can't be continued if they stop, so the whole item
+    will be downloaded again. The tracks are read with the buffer size and
+    bandwidth limits from the transfer options.
+
+    If a list is given for track_hash_list, the JSON for the hashes of
+    the tracks will be put in it, as they are hashed on the way into ffmpeg.
+    """
+    assert STREAM_MUX_SUPPORTED
+
+    # Both responses are opened before ffmpeg is started. ffmpeg can
+    # stop reading the video track until it has some of the audio track, so
+    # the audio connection is reserved outside of the limit for the host.
+    # Otherwise, with enough items streaming from one host, the video tracks
+    # could hold every connection, and the audio tracks would never start.
+    conn_list = [browser_spoof_open(video_url)]
+
+    try:
+        conn_list.append(browser_spoof_open(audio_url, reserved= True))
+
+        pipe_list = [os.pipe(), os.pipe()]
+        read_fd_list = [read_fd for read_fd, write_fd in pipe_list]
+
+        try:
+            with open(os.devnull, "rb") as null_in:
+                process = subprocess.Popen(
+                    mux_command(
+                        "pipe:{}".format(read_fd_list[0]),
+                        "pipe:{}".format(read_fd_list[1]),
+                        output_filename
+                    ),
+                    stdin= null_in,
+                    pass_fds= read_fd_list
+                )
+        except:
+            for read_fd, write_fd in pipe_list:
+                os.close(write_fd)
+
+            raise
+        finally:
+            # Only ffmpeg reads from the pipes now.
+            for read_fd in read_fd_list:
+                os.close(read_fd)
+    except:
+        for conn in conn_list:
+            conn.close()
+
+        raise
+
+    exception_queue = Queue()
+    hash_algorithm = transfer_options.hash_algorithm
+    hash_json_list = [None, None]
+
+    def feed_pipe(track_index, conn, write_fd):
+        try:
+            # The pipe is opened first, so it's always closed, and ffmpeg
+            # won't wait for data that will never come.
+            with os.fdopen(write_fd, "wb") as pipe_file:
+                bandwidth_share = BANDWIDTH_GOVERNOR.share(
+                    transfer_options.max_download_rate
+                )
+
+                try:
+                    content_length = conn.getheader("Content-Length")
+                    left = int(content_length) if content_length else None
+                    size = 0
+
+                    if hash_algorithm is not None:
+                        hasher = hashlib.new(hash_algorithm)
+                    else:
+                        hasher = None
+
+                    with bandwidth_share:
+                        while True:
+                            data = conn.read(bandwidth_share.read_size(
+                                transfer_options.buffer_size
+                            ))
+
+                            if not data:
+                                break
+
+                            pipe_file.write(data)
+                            bandwidth_share.throttle(len(data))
+                            size += len(data)
+
+                            if hasher is not None:
+                                hasher.update(data)
+
+                            if left is not None:
+                                left -= len(data)
+
+                    if left:
+                        # Don't let ffmpeg finish with part of a track.
+                        raise http_client.IncompleteRead(b"", left)
+
+                    if hasher is not None:
+                        hash_json_list[track_index] = file_hash_json(
+                            hash_algorithm,
+                            size,
+                            [(0, size, hasher.hexdigest())]
+                        )
+                finally:
+                    conn.close()
+        except Exception as ex:
+            exception_queue.put(ex)
+
+    thread_list = [
+        Thread(target= feed_pipe, args= (track_index, conn, write_fd))
+        for track_index, (conn, (read_fd, write_fd)) in
+        enumerate(zip(conn_list, pipe_list))
+    ]
+
+    for thread in thread_list:
+        thread.start()
+
+    for thread in thread_list:
+        thread.join()
+
+    return_code = process.wait()
+
+    request_error = None
+
+    while not exception_queue.empty():
+        ex = exception_queue.get()
+
+        # The pipe is closed when ffmpeg stops early.
+        if not isinstance(ex, BrokenPipeError):
+            request_error = ex
+
+    if request_error is not None or return_code != 0:
+        if os.path.exists(output_filename):
+            os.remove(output_filename)
+
+        if request_error is not None:
+            raise request_error
+
+        return False
+
+    if track_hash_list is not None:
+        track_hash_list[:] = hash_json_list
+
+    return True
+
+def is_feed_item_archived(feed_item, base_directory, catalog= None,
+layout= DEFAULT_LAYOUT, any_layout= None):
+    """
+    Return True if a feed item has already been downloaded into a directory.
+
+    The catalog is checked first, if one is given. Otherwise, or if the
+    catalog doesn't know about the item, the JSON file for the item is
+    looked for in the layouts from archive_layouts, and a JSON file which
+    is found is added to the catalog. By default, that is every layout,
+    until the directory has been migrated to the layout.
+    """
+    if catalog is not None and catalog.is_archived(feed_item.video_id):
+        return True
+
+    for json_filename in json_filenames_for_feed_item(
+        feed_item,
+        base_directory,
+        archive_layouts(base_directory, layout, any_layout)
+    ):
+        if os.path.exists(json_filename):
+            break
+    else:
+        return False
+
+    if catalog is not None:
+        catalog.import_json_file(
+            os.path.basename(os.path.normpath(base_directory)),
+            json_filename
+        )
+
+    return True
+
+def unarchived_feed_items(feed_item_seq, base_directory, catalog= None,
+stop_after= None, on_archived= None, layout= DEFAULT_LAYOUT,
+any_layout= None):
+    """
+    Generate the feed items from a sequence which haven't been downloaded
+    into a directory yet, checked like for is_feed_item_archived. Which
+    layouts to look in is only decided once, before the first item.
+
+    If stop_after is set, the sequence will stop being read after that
+    many items in a row were already downloaded. Feeds list the newest
+    videos first, so this will stop at the videos from the last run.
+
+    on_archived will be called with each item which was already downloaded,
+    if it is given.
+    """
+    assert stop_after is None or stop_after >= 1
+
+    if any_layout is None:
+        any_layout = needs_any_layout(base_directory, layout)
+
+    archived_count = 0
+
+    for feed_item in feed_item_seq:
+        if is_feed_item_archived(
+            feed_item,
+            base_directory,
+            catalog,
+            layout,
+            any_layout
+        ):
+            archived_count += 1
+
+            if on_archived is not None:
+                on_archived(feed_item)
+
+            if stop_after is not None and archived_count >= stop_after:
+                break
+        else:
+            archived_count = 0
+
+            yield feed_item
+
+class FeedItemDownload (object):
+    """
+    This object holds the state for one feed item as it goes through
+    the steps of being downloaded.
+
+    The steps are prepare_feed_item, fetch_feed_item, mux_feed_item and
+    finalize_feed_item, which can be run by different threads, so
+    the network, ffmpeg and the disk can be used for different items
+    at the same time.
+
+    The files are kept in the directory for the layout.
+    """
+    def __init__(self, feed_item, base_directory, content,
+    layout= DEFAULT_LAYOUT):
+        assert isinstance(feed_item, FeedItem)
+        assert isinstance(content, (DownloadInfo, tuple))
+
+        self.feed_item = feed_item
+        self.base_directory = base_directory
+        self.content = content
+
+        base_filename = base_filename_for_feed_item(feed_item)
+
+        join_path = partial(
+            os.path.join,
+            layout_directory(base_directory, base_filename, layout)
+        )
+
+        video_content = (
+            content[0]
+            if isinstance(content, tuple) else
+            content
+        )
+
+        assert video_content.media_type.has_video
+
+        self.json_filename = join_path("{}.json".format(base_filename))
+        self.video_filename = join_path("{}.{}".format(
+            base_filename, video_content.media_type.file_type
+        ))
+
+        if isinstance(content, tuple):
+            # The tracks are kept next to the video, so they can be
+            # continued if the download stops.
+            self.track_filename_list = [
+                join_path("{}.{}.{}".format(
+                    base_filename, track_name, track.media_type.file_type
+                ))
+                for track_name, track in zip(("video", "audio"), content)
+            ]
+        else:
+            self.track_filename_list = []
+
+        # This is set to True when there are track files to join together.
+        self.needs_mux = False
+
+        # The hash to record for the files, and the JSON for the hashes
+        # of the video and the tracks, which is set as they are written.
+        self.hash_algorithm = None
+        self.video_hash_json = None
+        self.track_hash_json_list = None
+
+    def integrity_json(self):
+        """
+        Return the JSON recorded for the hashes of the files, or None if
+        the files weren't hashed.
+        """
+        if self.video_hash_json is None:
+            return None
+
+        integrity_json = {"video": self.video_hash_json}
+
+        if self.track_hash_json_list is not None:
+            integrity_json["tracks"] = self.track_hash_json_list
+
+        return integrity_json
+
+def prepare_feed_item(feed_item, base_directory, catalog= None,
+policy= DEFAULT_SELECTION_POLICY, layout= DEFAULT_LAYOUT):
+    """
+    Pick the content to download for a feed item with a SelectionPolicy,
+    and return a FeedItemDownload for it, with files in the layout.
+
+    None will be returned if the video has already been downloaded.
+    If an ArchiveCatalog is given, it will be used for checking if the item
+    was downloaded before.
+    """
+    # The other layouts were looked in before the item was queued.
+    if is_feed_item_archived(
+        feed_item,
+        base_directory,
+        catalog,
+        layout,
+        any_layout= False
+    ):
+        # Stop here, we already have this video.
+        return
+
+    content = highest_quality_content(
+        download_info_for_feed_item(feed_item, satisfied= policy.satisfied),
+        policy
+    )
+
+    return FeedItemDownload(feed_item, base_directory, content, layout)
+
+def remove_stale_downloads(download):
+    """
+    Remove the saved progress and partial data for earlier downloads of
+    the video for a FeedItemDownload into other files, and the files which
+    were finished for them. These are left behind when a run stops, and
+    a different file type, or separate tracks instead of one file, are
+    picked for the video in the next run.
+    """
+    item_directory = os.path.dirname(download.video_filename)
+    base_filename = base_filename_for_feed_item(download.feed_item)
+    # Tracks are downloaded into the track files, and joined into
+    # the video file by ffmpeg, which doesn't leave progress behind.
+    keep_set = set(
+        download.track_filename_list or [download.video_filename]
+    )
+
+    # The names the files could have had are checked, rather than listing
+    # the directory, which can be very big in the flat layout.
+    for file_type in sorted(set(
+        media_type.file_type
+        for media_type in ITAG_MAP.values()
+    )):
+        for name_format in ("{}.{}", "{}.video.{}", "{}.audio.{}"):
+            filename = os.path.join(
+                item_directory,
+                name_format.format(base_filename, file_type)
+            )
+
+            if filename in keep_set:
+                continue
+
+            if os.path.exists(filename + ".resume") \
+            or os.path.exists(filename + ".part"):
+                remove_download_state(filename)
+
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+def fetch_feed_item(download, transfer_options= DEFAULT_TRANSFER_OPTIONS):
+    """
+    Download the media files for a FeedItemDownload.
+
+    Separate tracks are downloaded to track files, which mux_feed_item
+    will join together, unless the transfer options say that the tracks
+    should be sent straight into ffmpeg.
+
+    If the media URLs are refused, the cached download info for the item
+    is dropped, so new URLs will be used if the item is tried again.
+
+    The files are hashed as they are written, with the hash_algorithm from
+    the transfer options. Video files made with ffmpeg are read again to
+    hash them, as ffmpeg writes them.
+
+    Downloads of the video into other files which were left by an earlier
+    run are removed, see remove_stale_downloads.
+    """
+    content = download.content
+    hash_algorithm = transfer_options.hash_algorithm
+
+    download.hash_algorithm = hash_algorithm
+
+    make_directories(os.path.dirname(download.video_filename))
+    remove_stale_downloads(download)
+
+    try:
+        if isinstance(content, tuple):
+            if os.path.exists(download.video_filename):
+                # Delete the video file if ffmpeg was stopped before.
+                os.remove(download.video_filename)
+
+            track_hash_list = []
+
+            streamed = transfer_options.stream_mux and stream_mux_to_file(
+                content[0].url,
+                content[1].url,
+                download.video_filename,
+                transfer_options,
+                track_hash_list
+            )
+
+            if streamed:
+                if hash_algorithm is not None:
+                    download.track_hash_json_list = track_hash_list
+                    download.video_hash_json = hash_file(
+                        download.video_filename,
+                        hash_algorithm
+                    )
+            else:
+                track_hash_list = download_tracks(
+                    content,
+                    download.track_filename_list,
+                    transfer_options
+                )
+
+                if hash_algorithm is not None:
+                    download.track_hash_json_list = track_hash_list
+
+                download.needs_mux = True
+        else:
+            # Download one audio-video file.
+            download.video_hash_json = download_to_file(
+                content.url,
+                download.video_filename,
+                transfer_options,
+                content.media_type.itag
+            )
+    except HTTPError as err:
+        if err.code == 403:
+            # The signed URLs have probably expired.
+            DOWNLOAD_INFO_CACHE.invalidate(download.feed_item.video_id)
+
+        raise
+
+def mux_feed_item(download):
+    """
+    Use ffmpeg to join the audio and video tracks for a FeedItemDownload
+    together, if that needs to be done, and hash the joined video file.
+    """
+    if download.needs_mux:
+        mux_tracks(download.track_filename_list, download.video_filename)
+        download.needs_mux = False
+
+        if download.hash_algorithm is not None:
+            download.video_hash_json = hash_file(
+                download.video_filename,
+                download.hash_algorithm
+            )
+
+def finalize_feed_item(download, catalog= None):
+    """
+    Write the JSON file with the metadata for a FeedItemDownload, and
+    the catalog row if an ArchiveCatalog is given.
+
+    A pair (video_filename, json_filename) is returned.
+    """
+    assert not download.needs_mux
+
+    write_feed_item_json(
+        download.json_filename,
+        download.feed_item,
+        download.content,
+        catalog,
+        download.video_filename,
+        os.path.basename(os.path.normpath(download.base_directory)),
+        download.integrity_json()
+    )
+
+    remove_download_state(download.video_filename)
+
+    return (download.video_filename, download.json_filename)
+
+def download_feed_item(feed_item, base_directory,
+transfer_options= DEFAULT_TRANSFER_OPTIONS, catalog= None,
+policy= DEFAULT_SELECTION_POLICY, layout= DEFAULT_LAYOUT):
+    """
+    Download a feed item into a directory, running all of the steps for
+    a FeedItemDownload in order.
+
+    Return a pair (video_filename, json_filename) if the item is downloaded,
+    otherwise return None if the video has already been downloaded.
+
+    If an ArchiveCatalog is given, it will be used for checking if the item
+    was downloaded before, and it will be updated with the JSON file.
+    The content is picked with the SelectionPolicy, and the files are put
+    in the directory for the layout.
+    """
+    download = prepare_feed_item(
+        feed_item,
+        base_directory,
+        catalog,
+        policy,
+        layout
+    )
+
+    if download is None:
+        return
+
+    fetch_feed_item(download, transfer_options)
+    mux_feed_item(download)
+
+    return finalize_feed_item(download, catalog)
+
+def write_feed_item_json(json_filename, feed_item, content, catalog= None,
+video_filename= None, username= None, integrity_json= None):
+    """
+    Write the JSON file with the metadata for a downloaded feed item.
+
+    The content is either one DownloadInfo or a pair of them,
+    as returned by highest_quality_content.
+
+    If an ArchiveCatalog is given, the item will be recorded in it in
+    the same transaction as the JSON file is written, with the filename
+    for the video. The username is the name of the directory the JSON file
+    is in, unless it is given.
+
+    If the JSON for the hashes of the files is given, it is recorded in
+    the "integrity" field.
+    """
+    item_json = {
+        "version": JSON_FORMAT_VERSION,
+        "content": (
+            [content[0].to_json(), content[1].to_json()]
+            if isinstance(content, tuple) else
+            [content.to_json()]
+        ),
+        "feed_item": feed_item.to_json(),
+    }
+
+    if integrity_json is not None:
+        item_json["integrity"] = integrity_json
+
+    def write_json():
+        with open(json_filename, "w") as out_file:
+            json.dump(item_json, out_file)
+
+    if catalog is None:
+        write_json()
+    else:
+        catalog.record(
+            username or os.path.basename(
+                os.path.dirname(os.path.abspath(json_filename))
+            ),
+            item_json,
+            json_filename,
+            video_filename,
+            write_json
+        )
+
+# The catalog is kept in this file in the output directory.
+CATALOG_FILENAME = "riptube.sqlite3"
+
+class ArchiveCatalog (object):
+    """
+    This object is an index of the videos in an output directory, kept in
+    an SQLite database keyed by video ID.
+
+    The catalog records the status of each video, the itags which were
+    chosen, the size of the video file, the upload time and the time the
+    video was archived, so the archive can be checked and queried without
+    looking at the files. The JSON files are still written, and the catalog
+    can be built again from them with import_directory.
+
+    The status is "complete" for archived videos, and "failed" for videos
+    which couldn't be downloaded, which are tried again by the next run.
+
+    One catalog can be used from many threads.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.directory = os.path.dirname(os.path.abspath(filename))
+        self.__lock = Lock()
+        self.__connection = sqlite3.connect(
+            filename,
+            check_same_thread= False
+        )
+
+        with self.__lock:
+            with self.__connection:
+                self.__connection.execute("PRAGMA journal_mode=WAL")
+                self.__connection.execute(
+                    "CREATE TABLE IF NOT EXISTS video ("
+                    "video_id TEXT PRIMARY KEY, "
+                    "username TEXT NOT NULL, "
+                    "status TEXT NOT NULL, "
+                    "upload_time INTEGER, "
+                    "title TEXT, "
+                    "itags TEXT, "
+                    "byte_size INTEGER, "
+                    "video_filename TEXT, "
+                    "json_filename TEXT, "
+                    "archived_time REAL"
+                    ")"
+                )
+                self.__connection.execute(
+                    "CREATE INDEX IF NOT EXISTS video_username "
+                    "ON video (username, upload_time)"
+                )
+
+    @classmethod
+    def for_output_directory(cls, output_directory):
+        """
+        Open the catalog for an output directory, creating it if needed.
+        """
+        return cls(os.path.join(output_directory, CATALOG_FILENAME))
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+    def is_archived(self, video_id):
+        """
+        Return True if the catalog says a video has been archived.
+        """
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT status FROM video WHERE video_id = ?",
+                (video_id,)
+            ).fetchone()
+
+        return row is not None and row[0] == "complete"
+
+    def __relative_path(self, filename):
+        if filename is None:
+            return None
+
+        return os.path.relpath(os.path.abspath(filename), self.directory)
+
+    def __row(self, username, item_json, json_filename, video_filename,
+    archived_time):
+        feed_item_json = item_json["feed_item"]
+
+        try:
+            byte_size = os.path.getsize(video_filename)
+        except (TypeError, OSError):
+            byte_size = None
+
+        return (
+            feed_item_json["video_id"],
+            username,
+            "complete",
+            int(feed_item_json["upload_time"]),
+            feed_item_json["title"],
+            ",".join(
+                str(content_json["media_type"]["itag"])
+                for content_json in item_json["content"]
+            ),
+            byte_size,
+            self.__relative_path(video_filename),
+            self.__relative_path(json_filename),
+            archived_time,
+        )
+
+    def __insert(self, row_seq):
+        self.__connection.executemany(
+            "INSERT OR REPLACE INTO video VALUES (?,?,?,?,?,?,?,?,?,?)",
+            row_seq
+        )
+
+    def record(self, username, item_json, json_filename, video_filename,
+    write_function= None):
+        """
+        Record an archived video, given the data for its JSON file.
+
+        If a write_function is given, it will be called inside of the
+        transaction for the new row, so the row will only be saved if the
+        function succeeds.
+        """
+        row = self.__row(
+            username,
+            item_json,
+            json_filename,
+            video_filename,
+            time.time()
+        )
+
+        with self.__lock:
+            with self.__connection:
+                self.__insert((row,))
+
+                if write_function is not None:
+                    write_function()
+
+    def record_failure(self, username, feed_item):
+        """
+        Record that a video failed to download, with the time it failed,
+        unless the video was archived before.
+        """
+        now = time.time()
+
+        with self.__lock:
+            with self.__connection:
+                self.__connection.execute(
+                    "INSERT OR IGNORE INTO video (video_id, username, "
+                    "status, upload_time, title, archived_time) "
+                    "VALUES (?,?,?,?,?,?)",
+                    (
+                        feed_item.video_id,
+                        username,
+                        "failed",
+                        int(to_epoch(feed_item.upload_time)),
+                        feed_item.title,
+                        now,
+                    )
+                )
+                self.__connection.execute(
+                    "UPDATE video SET archived_time = ? "
+                    "WHERE video_id = ? AND status = 'failed'",
+                    (now, feed_item.video_id)
+                )
+
+    def forget(self, video_id):
+        """
+        Remove a video from the catalog, so it will be downloaded again.
+        """
+        with self.__lock:
+            with self.__connection:
+                self.__connection.execute(
+                    "DELETE FROM video WHERE video_id = ?",
+                    (video_id,)
+                )
+
+    def move_videos(self, move_seq):
+        """
+        Given a sequence of pairs (video_id, directory), record that
+        the files for each video were moved into a new directory.
+        """
+        with self.__lock:
+            with self.__connection:
+                for video_id, directory in move_seq:
+                    row = self.__connection.execute(
+                        "SELECT video_filename, json_filename FROM video "
+                        "WHERE video_id = ?",
+                        (video_id,)
+                    ).fetchone()
+
+                    if row is None:
+                        continue
+
+                    self.__connection.execute(
+                        "UPDATE video SET video_filename = ?, "
+                        "json_filename = ? WHERE video_id = ?",
+                        tuple(
+                            self.__relative_path(os.path.join(
+                                directory,
+                                os.path.basename(filename)
+                            ))
+                            if filename is not None else
+                            None
+                            for filename in row
+                        ) + (video_id,)
+                    )
+
+    def __row_for_json_file(self, username, json_filename):
+        """
+        Return a row for an existing JSON file, or None if the file
+        isn't a JSON file for a video.
+        """
+        try:
+            with open(json_filename) as json_file:
+                item_json = json.load(json_file)
+
+            file_type = item_json["content"][0]["media_type"]["file_type"]
+        except (IOError, OSError, ValueError, KeyError, IndexError,
+        TypeError):
+            return None
+
+        video_filename = "{}.{}".format(
+            os.path.splitext(json_filename)[0],
+            file_type
+        )
+
+        return self.__row(
+            username,
+            item_json,
+            json_filename,
+            video_filename,
+            os.path.getmtime(json_filename)
+        )
+
+    def import_json_file(self, username, json_filename):
+        """
+        Add a video to the catalog from a JSON file which was written
+        before. Return True if the file was for a video.
+        """
+        row = self.__row_for_json_file(username, json_filename)
+
+        if row is not None:
+            with self.__lock:
+                with self.__connection:
+                    self.__insert((row,))
+
+        return row is not None
+
+    def import_directory(self, output_directory):
+        """
+        Build the catalog from the JSON files in the user directories of
+        an output directory, in any layout. Return the number of videos
+        imported.
+        """
+        row_list = []
+
+        for username in sorted(os.listdir(output_directory)):
+            user_directory = os.path.join(output_directory, username)
+
+            if not os.path.isdir(user_directory):
+                continue
+
+            for directory, directory_list, filename_list in os.walk(
+                user_directory
+            ):
+                prune_hidden_directories(directory_list)
+
+                for filename in sorted(filename_list):
+                    if filename.endswith(".json"):
+                        row = self.__row_for_json_file(
+                            username,
+                            os.path.join(directory, filename)
+                        )
+
+                        if row is not None:
+                            row_list.append(row)
+
+        with self.__lock:
+            with self.__connection:
+                self.__insert(row_list)
+
+        return len(row_list)
+
+def archive_json_filenames(output_directory):
+    """
+    Generate the filenames of the JSON files for every video in the user
+    directories of an output directory, in any layout.
+    """
+    for username in sorted(os.listdir(output_directory)):
+        user_directory = os.path.join(output_directory, username)
+
+        if not os.path.isdir(user_directory):
+            continue
+
+        for directory, directory_list, filename_list in os.walk(
+            user_directory
+        ):
+            prune_hidden_directories(directory_list)
+
+            for filename in sorted(filename_list):
+                if filename.endswith(".json") \
+                and BASE_FILENAME_REGEX.match(filename):
+                    yield os.path.join(directory, filename)
+
+def video_filename_for_json(json_filename, item_json):
+    """
+    Return the filename of the video next to a JSON file for it.
+    """
+    return "{}.{}".format(
+        os.path.splitext(json_filename)[0],
+        item_json["content"][0]["media_type"]["file_type"]
+    )
+
+def verify_json_file(json_filename, probe= False):
+    """
+    Check the video for a JSON file, and return a triple
+    (json_filename, problem_list, byte_count), where problem_list is a list
+    of strings saying what is wrong, which is empty if nothing is, and
+    byte_count is the number of bytes which were read.
+
+    The video file must exist, and its size and hashes must match
+    the integrity field of the JSON, when the JSON has one. If probe is
+    True, ffprobe must also be able to read the video.
+    """
+    try:
+        with open(json_filename) as json_file:
+            item_json = json.load(json_file)
+
+        video_filename = video_filename_for_json(json_filename, item_json)
+        hash_json = (item_json.get("integrity") or {}).get("video")
+    except (IOError, OSError, ValueError, KeyError, IndexError,
+    TypeError) as err:
+        return (json_filename, ["The JSON file can't be read: {}".format(
+            err
+        )], 0)
+
+    if not os.path.exists(video_filename):
+        return (json_filename, ["{} is missing".format(video_filename)], 0)
+
+    problem_list = []
+    byte_count = 0
+    size = os.path.getsize(video_filename)
+
+    if hash_json is not None:
+        if size != hash_json["size"]:
+            problem_list.append("{} is {} bytes, not {}".format(
+                video_filename,
+                size,
+                hash_json["size"]
+            ))
+        else:
+            segment_list = hash_json.get("segments") or [
+                (0, size, hash_json["hash"])
+            ]
+
+            for start, end, hex_digest in segment_list:
+                hasher = hashlib.new(hash_json["algorithm"])
+                hash_file_range(video_filename, start, end, hasher)
+                byte_count += end - start
+
+                if hasher.hexdigest() != hex_digest:
+                    problem_list.append(
+                        "The hash for bytes {}-{} of {} doesn't match".format(
+                            start,
+                            end - 1,
+                            video_filename
+                        )
+                    )
+
+    if probe:
+        try:
+            with open(os.devnull, "wb") as null_out:
+                process = subprocess.Popen(
+                    ("ffprobe", "-v", "error", video_filename),
+                    stdout= null_out,
+                    stderr= subprocess.PIPE
+                )
+        except OSError as err:
+            # ffprobe is missing, or can't be run.
+            problem_list.append("ffprobe can't be run: {}".format(err))
+
+            return (json_filename, problem_list, byte_count)
+
+        error_text = process.communicate()[1].decode("utf-8", "replace")
+
+        if process.returncode != 0 or error_text.strip():
+            problem_list.append("ffprobe can't read {}: {}".format(
+                video_filename,
+                error_text.strip().split("\n")[0]
+            ))
+
+    return (json_filename, problem_list, byte_count)
+
+def verify_archive(output_directory, jobs= None, probe= False):
+    """
+    Check every video in an output directory with verify_json_file, with
+    a pool of 'jobs' processes, one for each CPU by default, and generate
+    the results as they are finished.
+    """
+    assert jobs is None or jobs >= 1
+
+    pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+
+    try:
+        for result in pool.imap_unordered(
+            partial(verify_json_file, probe= probe),
+            archive_json_filenames(output_directory),
+            4
+        ):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+# These HTTP codes are returned randomly, and requests can be tried again.
+RETRY_CODES = (400, 403, 429, 503)
+
+# The number of times an item will be tried before giving up.
+DEFAULT_RETRY_BUDGET = 10
+
+def is_retryable_error(err):
+    """
+    Return True if an exception is a request error which is worth trying
+    again for.
+    """
+    if isinstance(err, HTTPError):
+        return err.code in RETRY_CODES
+
+    # Downloads which were cut off will be continued.
+    return isinstance(err, (socket.timeout, http_client.IncompleteRead))
+
+def call_with_retries(function, log, retry_budget= DEFAULT_RETRY_BUDGET):
+    """
+    Call a function, calling it again when the request errors which
+    YouTube randomly returns are hit, and return what it returns.
+
+    The function will be tried up to retry_budget times, waiting longer
+    after each failure, before the last error is raised. If retry_budget
+    is None, the function will be tried forever.
+    """
+    for attempt in count():
+        try:
+            return function()
+        except Exception as err:
+            # This hack sucks, but I can't figure out how to stop
+            # the request errors from happening randomly.
+            if not is_retryable_error(err):
+                raise
+
+            if retry_budget is not None and attempt + 1 >= retry_budget:
+                log("Giving up after {} tries: {}", attempt + 1, err)
+                raise
+
+            delay = backoff_delay(attempt)
+
+            log(
+                "Got a request error ({}), sleeping for {:.1f}s...",
+                err,
+                delay
+            )
+            RATE_CONTROLLER.backoff(delay)
+
+def download_feed_item_with_retries(feed_item, base_directory, log,
+transfer_options= DEFAULT_TRANSFER_OPTIONS, catalog= None,
+retry_budget= DEFAULT_RETRY_BUDGET, policy= DEFAULT_SELECTION_POLICY,
+layout= DEFAULT_LAYOUT):
+    """
+    Download a feed item into a directory, retrying the download when
+    the request errors which YouTube randomly returns are hit.
+
+    The item will be tried up to retry_budget times, like for
+    call_with_retries. The return value is the same as for
+    download_feed_item.
+    """
+    return call_with_retries(
+        partial(
+            download_feed_item,
+            feed_item,
+            base_directory,
+            transfer_options,
+            catalog,
+            policy,
+            layout
+        ),
+        log,
+        retry_budget
+    )
+
+# The engines which can be used for downloading videos.
+ENGINE_LIST = ("threads",) if PYTHON_2 else ("threads", "asyncio")
+
+# These command line options are only used by the threads engine.
+THREADS_ENGINE_OPTIONS = (
+    "--mux-jobs",
+    "--segments",
+    "--buffer-size",
+    "--no-preallocate",
+    "--direct-io",
+    "--sync-every",
+    "--stream-mux",
+    "--max-bandwidth",
+    "--max-download-bandwidth",
+    "--bandwidth-schedule",
+)
+
+# This is put in the work queue to tell a worker thread to stop.
+_STOP_WORKER = object()
+
+def run_in_threads(function, item_seq, jobs):
+    """
+    Call a function for each item in a sequence with a pool of worker
+    threads, and wait for all of the calls to finish.
+
+    Items are only taken from the sequence when a worker is free, so
+    the sequence can be a lazy generator. If any call raises an exception,
+    no more items will be taken, and the first exception will be raised
+    again here once the workers have stopped.
+    """
+    assert isinstance(jobs, int)
+    assert jobs >= 1
+
+    if jobs == 1:
+        # There's no point starting a thread for this.
+        for item in item_seq:
+            function(item)
+
+        return
+
+    que = Queue(jobs)
+    exception_queue = Queue()
+
+    def work():
+        while True:
+            item = que.get()
+
+            try:
+                if item is _STOP_WORKER:
+                    return
+
+                if exception_queue.empty():
+                    function(item)
+            except Exception as ex:
+                exception_queue.put(ex)
+            finally:
+                que.task_done()
+
+    thread_list = [Thread(target= work) for i in range(jobs)]
+
+    for thread in thread_list:
+        # Daemon threads won't stop the process exiting on an interrupt.
+        thread.daemon = True
+        thread.start()
+
+    for item in item_seq:
+        if not exception_queue.empty():
+            break
+
+        que.put(item)
+
+    for thread in thread_list:
+        que.put(_STOP_WORKER)
+
+    for thread in thread_list:
+        thread.join()
+
+    if not exception_queue.empty():
+        raise exception_queue.get()
+
+class PipelineStage (object):
+    """
+    This object runs one stage of a pipeline, where a number of worker
+    threads call a function for the items put into a bounded queue.
+
+    Putting an item into a full queue waits for space, so a slow stage
+    holds back the stages before it. The depth of the queue is tracked,
+    so the stages where items are waiting can be reported.
+
+    If the function raises an exception, the rest of the items will be
+    skipped, and the first exception will be raised again by close.
+    A stage can also be cancelled, which skips the rest of the items
+    without an exception.
+    """
+    def __init__(self, name, function, workers= 1, queue_size= None):
+        assert isinstance(workers, int)
+        assert workers >= 1
+
+        self.name = name
+        self.workers = workers
+        self.max_depth = 0
+
+        self.__function = function
+        self.__que = Queue(queue_size or workers)
+        self.__exception_queue = Queue()
+        self.__cancel_event = Event()
+        self.__stopped = False
+        self.__depth_lock = Lock()
+        self.__thread_list = [
+            Thread(target= self.__work)
+            for i in range(workers)
+        ]
+
+        for thread in self.__thread_list:
+            # Daemon threads won't stop the process exiting on an interrupt.
+            thread.daemon = True
+            thread.start()
+
+    def __work(self):
+        while True:
+            item = self.__que.get()
+
+            if item is _STOP_WORKER:
+                return
+
+            try:
+                if self.__exception_queue.empty() and not self.cancelled:
+                    self.__function(item)
+            except Exception as ex:
+                self.__exception_queue.put(ex)
+
+    @property
+    def depth(self):
+        """
+        The number of items waiting in the queue.
+        """
+        return self.__que.qsize()
+
+    @property
+    def failed(self):
+        return not self.__exception_queue.empty()
+
+    @property
+    def cancelled(self):
+        return self.__cancel_event.is_set()
+
+    def put(self, item):
+        """
+        Put an item into the queue, waiting for space if it is full.
+        Items put into a cancelled stage are dropped.
+        """
+        if self.cancelled:
+            return
+
+        self.__que.put(item)
+
+        with self.__depth_lock:
+            self.max_depth = max(self.max_depth, self.__que.qsize())
+
+    def cancel(self):
+        """
+        Drop the items waiting in the queue, and any items put into it
+        later. The items the workers have already started are finished.
+        """
+        self.__cancel_event.set()
+
+    def close(self):
+        """
+        Wait for the items in the queue to be finished, and stop
+        the workers. The first exception from the workers is raised here,
+        unless the stage was cancelled.
+
+        This can be called again after it was interrupted.
+        """
+        if not self.__stopped:
+            self.__stopped = True
+
+            for thread in self.__thread_list:
+                self.__que.put(_STOP_WORKER)
+
+        for thread in self.__thread_list:
+            thread.join()
+
+        if self.failed and not self.cancelled:
+            raise self.__exception_queue.get()
+
+    def __str__(self):
+        return "{}: {} waiting, at most {}, with {} workers".format(
+            self.name,
+            self.depth,
+            self.max_depth,
+            self.workers
+        )
+
+def cancel_pipeline(stage_list):
+    """
+    Cancel every PipelineStage in a list, and wait for the workers to
+    finish the items they have already started. The items waiting in
+    the queues are dropped.
+    """
+    for stage in stage_list:
+        stage.cancel()
+
+    for stage in stage_list:
+        stage.close()
+
+def close_pipeline(stage_list):
+    """
+    Close every PipelineStage in a list in order, so items from one stage
+    are passed on before the next stage is closed.
+
+    The first exception from any of the stages is raised at the end.
+    If the wait is interrupted with KeyboardInterrupt, the pipeline is
+    cancelled instead, and the interrupt is raised again.
+    """
+    error = None
+
+    try:
+        for stage in stage_list:
+            try:
+                stage.close()
+            except Exception as ex:
+                if error is None:
+                    error = ex
+    except KeyboardInterrupt:
+        cancel_pipeline(stage_list)
+        raise
+
+    if error is not None:
+        raise error
+
+class ItemLog (object):
+    """
+    This object collects log lines for one feed item.
+
+    The lines are held back until the item is done, so the lines for
+    items downloaded at the same time are not mixed together.
+    """
+    def __init__(self):
+        self.lines = []
+
+    def __call__(self, format_string, *args):
+        self.lines.append(format_string.format(*args))
+
+def download_videos_for_user(username, output_directory, log_file= None,
+jobs= 1, engine= "threads", prefetch_pages= DEFAULT_PREFETCH_PAGES,
+transfer_options= DEFAULT_TRANSFER_OPTIONS, catalog= None,
+incremental= None, retry_budget= DEFAULT_RETRY_BUDGET, mux_jobs= 1,
+policy= DEFAULT_SELECTION_POLICY, layout= DEFAULT_LAYOUT, any_layout= None):
+    """
+    Download all of the videos for a user into a directory named after
+    the user inside of the output directory.
+
+    Up to 'jobs' videos will be downloaded at the same time, and up to
+    'prefetch_pages' pages of the feed will be downloaded ahead. The engine
+    can be "threads", for a pool of threads, or "asyncio", which runs
+    download_videos_for_user_async from riptube_async on an event loop.
+    Only the hash_algorithm from the transfer options can be changed for
+    the "asyncio" engine, and ValueError is raised if other options are,
+    or if BANDWIDTH_GOVERNOR has a limit.
+    'mux_jobs' is only used by the "threads" engine, where up to 'mux_jobs'
+    ffmpeg processes will join tracks together while other videos are
+    downloaded.
+
+    If an ArchiveCatalog is given, it will be used for finding videos
+    which were already downloaded, and for recording new ones.
+
+    If 'incremental' is set to a number, the feed will stop being read
+    after that many videos in a row were already downloaded, so only the
+    videos uploaded since the last run will be downloaded.
+
+    Each video will be tried up to 'retry_budget' times when requests fail.
+
+    The content for each video is picked with the SelectionPolicy, and
+    the files for new videos are put in the directories for the layout.
+    Videos already downloaded are looked for in the catalog and in
+    the layouts from archive_layouts for any_layout, which are all of them
+    by default, until a user directory has been migrated to the layout.
+    """
+    assert engine in ENGINE_LIST
+
+    if engine == "asyncio":
+        import asyncio
+        from riptube_async import (
+            download_videos_for_user_async,
+            unsupported_transfer_options,
+        )
+
+        unsupported_list = unsupported_transfer_options(transfer_options)
+
+        if BANDWIDTH_GOVERNOR.limited:
+            raise ValueError(
+                "The asyncio engine doesn't support bandwidth limits"
+            )
+
+        if unsupported_list:
+            raise ValueError(
+                "The asyncio engine doesn't support these transfer "
+                "options: {}".format(", ".join(unsupported_list))
+            )
+
+        return asyncio.run(download_videos_for_user_async(
+            username,
+            output_directory,
+            log_file= log_file,
+            jobs= jobs,
+            prefetch_pages= prefetch_pages,
+            catalog= catalog,
+            incremental= incremental,
+            retry_budget= retry_budget,
+            policy= policy,
+            layout= layout,
+            any_layout= any_layout,
+            hash_algorithm= transfer_options.hash_algorithm
+        ))
+
+    return download_videos_for_users(
+        (username,),
+        output_directory,
+        log_file= log_file,
+        jobs= jobs,
+        prefetch_pages= prefetch_pages,
+        transfer_options= transfer_options,
+        catalog= catalog,
+        incremental= incremental,
+        retry_budget= retry_budget,
+        keep_going= False,
+        mux_jobs= mux_jobs,
+        policy= policy,
+        layout= layout,
+        any_layout= any_layout
+    )
+
+class ChannelStats (object):
+    """
+    This object counts what happened for one channel in a run.
+    """
+    def __init__(self, username):
+        self.username = username
+        self.downloaded_count = 0
+        self.skipped_count = 0
+        self.failed_count = 0
+        self.byte_count = 0
+        # This is set to the exception if the feed couldn't be read.
+        self.feed_error = None
+        self.__lock = Lock()
+
+    def add_downloaded(self, byte_count):
+        with self.__lock:
+            self.downloaded_count += 1
+            self.byte_count += byte_count
+
+    def add_skipped(self, feed_item= None):
+        with self.__lock:
+            self.skipped_count += 1
+
+    def add_failed(self):
+        with self.__lock:
+            self.failed_count += 1
+
+    def __str__(self):
+        return "{}: {} downloaded, {} skipped, {} failed, {} bytes{}".format(
+            self.username,
+            self.downloaded_count,
+            self.skipped_count,
+            self.failed_count,
+            self.byte_count,
+            " (feed error: {})".format(self.feed_error)
+            if self.feed_error is not None else
+            ""
+        )
+
+def interleave(iterable_list):
+    """
+    Generate the items from several iterables, taking one from each in
+    turn, until all of them are exhausted.
+    """
+    iterator_list = [iter(iterable) for iterable in iterable_list]
+
+    while iterator_list:
+        for iterator in list(iterator_list):
+            try:
+                yield next(iterator)
+            except StopIteration:
+                iterator_list.remove(iterator)
+
+def read_line_file(filename):
+    """
+    Read a list of the lines in a file.
+
+    Blank lines and lines starting with # are skipped.
+    """
+    with open(filename) as line_file:
+        return [
+            line.strip()
+            for line in line_file
+            if line.strip() and not line.strip().startswith("#")
+        ]
+
+def read_username_file(filename):
+    """
+    Read a list of usernames from a file with one username on each line.
+
+    Blank lines and lines starting with # are skipped.
+    """
+    return read_line_file(filename)
+
+def replace_archived_files(new_filename_pair, old_filename_pair,
+directory):
+    """
+    Move the video and JSON files for a new download into a directory,
+    in place of the old video and JSON files for the same video, which may
+    have other names or be in another directory.
+
+    The JSON file is moved last, so the video is never missing for
+    a JSON file. A pair (video_filename, json_filename) is returned with
+    the new names.
+    """
+    make_directories(directory)
+
+    result_list = []
+
+    for new_filename, old_filename in zip(
+        new_filename_pair,
+        old_filename_pair
+    ):
+        filename = os.path.join(directory, os.path.basename(new_filename))
+        replace_file(new_filename, filename)
+
+        if os.path.abspath(old_filename) != os.path.abspath(filename) \
+        and os.path.exists(old_filename):
+            os.remove(old_filename)
+
+        remove_download_state(old_filename)
+        result_list.append(filename)
+
+    return tuple(result_list)
+
+def redownload_json_files(json_filename_list, output_directory,
+log_file= None, jobs= 1, transfer_options= DEFAULT_TRANSFER_OPTIONS,
+catalog= None, retry_budget= DEFAULT_RETRY_BUDGET,
+policy= DEFAULT_SELECTION_POLICY, layout= DEFAULT_LAYOUT):
+    """
+    Download the videos for a list of JSON files in an output directory
+    again, like the list written by --verify --bad-list.
+
+    The feed item is read from the JSON file, so the feeds don't need to
+    be read. Each video is downloaded into a temporary directory in
+    the user directory, and the old video, JSON file and catalog row are
+    only replaced once the new video is downloaded and verified, so
+    the archived copy is kept if the video can't be downloaded again.
+    JSON files which can't be read are only removed, so the videos will be
+    downloaded by the next run over their feeds. Return the number of
+    videos which failed or weren't downloaded.
+    """
+    log_lock = Lock()
+    # This is a list so it can be changed in the function below.
+    failed_count = [0]
+
+    def write_lines(line_seq):
+        if log_file is not None:
+            with log_lock:
+                for line in line_seq:
+                    log_file.write(line)
+                    log_file.write("\n")
+
+    def redownload(json_filename):
+        item_log = ItemLog()
+
+        try:
+            try:
+                with open(json_filename) as json_file:
+                    item_json = json.load(json_file)
+
+                feed_item = FeedItem.from_json(item_json["feed_item"])
+            except (ValueError, KeyError, TypeError, AssertionError):
+                os.remove(json_filename)
+
+                if catalog is not None:
+                    catalog.forget(
+                        os.path.basename(json_filename)
+                        .split(".")[0].split("_", 1)[1]
+                    )
+
+                raise
+
+            username = os.path.relpath(json_filename, output_directory) \
+                .split(os.sep)[0]
+            user_directory = os.path.join(output_directory, username)
+            temp_directory = tempfile.mkdtemp(
+                prefix= ".redownload-",
+                dir= user_directory
+            )
+
+            try:
+                feed_result = download_feed_item_with_retries(
+                    feed_item,
+                    temp_directory,
+                    item_log,
+                    transfer_options,
+                    None,
+                    retry_budget,
+                    policy
+                )
+
+                if feed_result is None:
+                    raise RuntimeError("The video wasn't downloaded")
+
+                problem_list = verify_json_file(feed_result[1])[1]
+
+                if problem_list:
+                    raise RuntimeError(
+                        "The new download is bad: {}".format(
+                            "; ".join(problem_list)
+                        )
+                    )
+
+                feed_result = replace_archived_files(
+                    feed_result,
+                    (
+                        video_filename_for_json(json_filename, item_json),
+                        json_filename
+                    ),
+                    layout_directory(
+                        user_directory,
+                        base_filename_for_feed_item(feed_item),
+                        layout
+                    )
+                )
+            finally:
+                shutil.rmtree(temp_directory, ignore_errors= True)
+
+            if catalog is not None:
+                catalog.import_json_file(username, feed_result[1])
+
+            item_log(
+                "Grabbed item {} - {}",
+                feed_item.video_id,
+                feed_item.title
+            )
+            item_log("filename: {}", feed_result[0])
+            item_log("JSON filename: {}", feed_result[1])
+        except Exception as ex:
+            with log_lock:
+                failed_count[0] += 1
+
+            item_log("Failed to download {} again: {!r}", json_filename, ex)
+
+        write_lines(item_log.lines)
+
+    run_in_threads(redownload, json_filename_list, jobs)
+
+    return failed_count[0]
+
+def download_videos_for_users(username_list, output_directory,
+log_file= None, jobs= 1, prefetch_pages= DEFAULT_PREFETCH_PAGES,
+transfer_options= DEFAULT_TRANSFER_OPTIONS, catalog= None,
+incremental= None, retry_budget= DEFAULT_RETRY_BUDGET, keep_going= True,
+mux_jobs= 1, policy= DEFAULT_SELECTION_POLICY, layout= DEFAULT_LAYOUT,
+any_layout= None):
+    """
+    Download all of the videos for several users at once, each into
+    a directory named after the user inside of the output directory.
+
+    The feeds for the users are read in turn, and the videos from all of
+    them share one pool of 'jobs' threads, and the connections in HTTP_POOL,
+    which limits the connections to each host. The other options are the
+    same as for download_videos_for_user.
+
+    The videos go through a pipeline of stages. The download stage
+    downloads the media files with 'jobs' threads, the mux stage joins
+    separate tracks together with ffmpeg with 'mux_jobs' threads, and
+    the write stage writes the JSON files and the catalog. Each stage has
+    a bounded queue, so downloads can continue while ffmpeg runs, without
+    getting too far ahead. The depths of the queues are logged at the end.
+    On KeyboardInterrupt, the videos waiting in the queues are dropped,
+    and only the ones already being worked on are finished.
+
+    If keep_going is True, a failure for one video or one feed will be
+    logged and counted, and the other videos will still be downloaded.
+    Otherwise, the first failure will be raised.
+
+    A list of ChannelStats is returned, and a summary is logged at the end.
+    """
+    log_lock = Lock()
+
+    def write_lines(line_seq):
+        if log_file is not None:
+            with log_lock:
+                for line in line_seq:
+                    log_file.write(line)
+                    log_file.write("\n")
+
+    def log(format_string, *args):
+        write_lines((format_string.format(*args),))
+
+    def channel_items(username, stats):
+        """
+        Generate (user_directory, stats, feed_item) triples for a user.
+        """
+        user_directory = os.path.join(output_directory, username)
+        prepare_user_directory(user_directory, layout)
+
+        log("Downloading videos for username: {}", username)
+
+        try:
+            for feed_item in unarchived_feed_items(
+                user_videos(username, prefetch_pages),
+                user_directory,
+                catalog,
+                incremental,
+                stats.add_skipped,
+                layout,
+                any_layout
+            ):
+                yield (user_directory, stats, feed_item)
+        except Exception as ex:
+            if not keep_going:
+                raise
+
+            stats.feed_error = ex
+            log("Failed to read the feed for {}: {}", username, ex)
+
+    def item_failed(stats, feed_item, item_log, ex):
+        stats.add_failed()
+
+        if catalog is not None:
+            catalog.record_failure(stats.username, feed_item)
+
+        item_log(
+            "Failed to download item {} - {}: {!r}",
+            feed_item.video_id,
+            feed_item.title,
+            ex
+        )
+        write_lines(item_log.lines)
+
+        if not keep_going:
+            raise ex
+
+    def download_item(item):
+        user_directory, stats, feed_item = item
+        item_log = ItemLog()
+
+        def prepare_and_fetch():
+            download = prepare_feed_item(
+                feed_item,
+                user_directory,
+                catalog,
+                policy,
+                layout
+            )
+
+            if download is not None:
+                fetch_feed_item(download, transfer_options)
+
+            return download
+
+        try:
+            download = call_with_retries(
+                prepare_and_fetch,
+                item_log,
+                retry_budget
+            )
+        except Exception as ex:
+            return item_failed(stats, feed_item, item_log, ex)
+
+        if download is None:
+            stats.add_skipped()
+            write_lines(item_log.lines)
+        else:
+            mux_stage.put((stats, download, item_log))
+
+    def mux_item(item):
+        stats, download, item_log = item
+
+        try:
+            mux_feed_item(download)
+        except Exception as ex:
+            return item_failed(stats, download.feed_item, item_log, ex)
+
+        write_stage.put(item)
+
+    def write_item(item):
+        stats, download, item_log = item
+        feed_item = download.feed_item
+
+        try:
+            video_filename, json_filename = finalize_feed_item(
+                download,
+                catalog
+            )
+        except Exception as ex:
+            return item_failed(stats, feed_item, item_log, ex)
+
+        item_log("Grabbed item {} - {}", feed_item.video_id, feed_item.title)
+        item_log("filename: {}", video_filename)
+        item_log("JSON filename: {}", json_filename)
+
+        stats.add_downloaded(os.path.getsize(video_filename))
+        write_lines(item_log.lines)
+
+    stats_list = []
+    username_set = set()
+
+    for username in username_list:
+        username = username.lower()
+
+        # Skip duplicates, keeping the order.
+        if username not in username_set:
+            username_set.add(username)
+            stats_list.append(ChannelStats(username))
+
+    # The JSON files and the catalog are written by one thread, as
+    # the catalog can only be written to by one thread at a time anyway.
+    download_stage = PipelineStage("download", download_item, jobs)
+    mux_stage = PipelineStage("mux", mux_item, mux_jobs, max(jobs, mux_jobs))
+    write_stage = PipelineStage("write", write_item)
+    stage_list = [download_stage, mux_stage, write_stage]
+
+    try:
+        for item in interleave([
+            channel_items(stats.username, stats)
+            for stats in stats_list
+        ]):
+            if any(stage.failed for stage in stage_list):
+                break
+
+            download_stage.put(item)
+    except KeyboardInterrupt:
+        # The videos waiting in the queues aren't downloaded.
+        cancel_pipeline(stage_list)
+        raise
+    finally:
+        close_pipeline(stage_list)
+
+    log("Summary:")
+
+    for stats in stats_list:
+        log("  {}", stats)
+
+    log(
+        "  Total: {} downloaded, {} skipped, {} failed, {} bytes",
+        sum(stats.downloaded_count for stats in stats_list),
+        sum(stats.skipped_count for stats in stats_list),
+        sum(stats.failed_count for stats in stats_list),
+        sum(stats.byte_count for stats in stats_list)
+    )
+    log("  Throttling: {}", RATE_CONTROLLER.summary())
+    log("  Bandwidth: {}", BANDWIDTH_GOVERNOR.summary())
+    log("  Info cache: {}", DOWNLOAD_INFO_CACHE.summary())
+    log("  Queues: {}", ", ".join(str(stage) for stage in stage_list))
+
+    return stats_list
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description= "Rip entire YouTube accounts with metadata."
+    )
+    parser.add_argument("username", nargs= "?")
+    parser.add_argument("output_directory", nargs= "?")
+    parser.add_argument(
+        "-j", "--jobs",
+        type= int,
+        default= 1,
+        help= "The number of videos to download at the same time."
+    )
+
+    parser.add_argument(
+        "--mux-jobs",
+        type= int,
+        default= 1,
+        metavar= "N",
+        help= (
+            "The number of ffmpeg processes to run at the same time for "
+            "joining video and audio tracks together."
+        )
+    )
+
+    parser.add_argument(
+        "--engine",
+        choices= ENGINE_LIST,
+        default= "threads",
+        help= "How requests are made at the same time."
+    )
+
+    parser.add_argument(
+        "--prefetch-pages",
+        type= int,
+        default= DEFAULT_PREFETCH_PAGES,
+        metavar= "N",
+        help= "The number of feed pages to download ahead of the one in use."
+    )
+
+    parser.add_argument(
+        "--max-connections-per-host",
+        type= int,
+        default= HTTP_POOL.max_connections_per_host,
+        metavar= "N",
+        help= "The number of connections to keep open for each host."
+    )
+
+    parser.add_argument(
+        "--segments",
+        type= int,
+        default= 1,
+        metavar= "N",
+        help= "The number of byte ranges to download each file in."
+    )
+
+    parser.add_argument(
+        "--max-height",
+        type= int,
+        metavar= "PIXELS",
+        help= "Download videos up to this height, like 1080."
+    )
+
+    parser.add_argument(
+        "--max-video-bitrate",
+        type= float,
+        metavar= "MBITS",
+        help= "Download videos up to this video bitrate, in Mbit/s."
+    )
+
+    parser.add_argument(
+        "--max-size",
+        metavar= "SIZE",
+        help= (
+            "Download the best content which should be at most this size, "
+            "like 500M, going by the bitrates and the length of the video."
+        )
+    )
+
+    parser.add_argument(
+        "--prefer-formats",
+        metavar= "FORMATS",
+        help= (
+            "File types to prefer in order over others, like mp4,webm. "
+            "By default, open formats are preferred."
+        )
+    )
+
+    parser.add_argument(
+        "--max-bandwidth",
+        metavar= "RATE",
+        help= (
+            "The most bytes per second to download at, for all downloads "
+            "together, like 500K or 2M."
+        )
+    )
+
+    parser.add_argument(
+        "--max-download-bandwidth",
+        metavar= "RATE",
+        help= "The most bytes per second to download each file at."
+    )
+
+    parser.add_argument(
+        "--bandwidth-schedule",
+        metavar= "SCHEDULE",
+        help= (
+            "Limits for all downloads by the time of day, like "
+            "08:00=1M,18:00=10M,23:00=unlimited. Each limit is used from "
+            "its time until the next one."
+        )
+    )
+
+    parser.add_argument(
+        "--buffer-size",
+        type= int,
+        default= COPY_BUFFER_SIZE // 1024,
+        metavar= "KIB",
+        help= "The size of the buffer for writing each download, in KiB."
+    )
+
+    parser.add_argument(
+        "--no-preallocate",
+        action= "store_true",
+        help= "Don't reserve the space for files on disk before writing them."
+    )
+
+    parser.add_argument(
+        "--direct-io",
+        action= "store_true",
+        help= "Write files with O_DIRECT, skipping the page cache."
+    )
+
+    parser.add_argument(
+        "--sync-every",
+        type= int,
+        metavar= "MIB",
+        help= "Flush downloaded data to disk after this many MiB."
+    )
+
+    parser.add_argument(
+        "--hash",
+        choices= HASH_ALGORITHMS + ("none",),
+        default= DEFAULT_HASH_ALGORITHM,
+        help= (
+            "The hash to record in the JSON files for downloaded files, "
+            "computed as they are written."
+        )
+    )
+
+    parser.add_argument(
+        "--stream-mux",
+        action= "store_true",
+        help= (
+            "Send separate video and audio tracks straight into ffmpeg "
+            "while they download, instead of saving them first. Streamed "
+            "downloads can't be continued if they stop."
+        )
+    )
+
+    parser.add_argument(
+        "--layout",
+        choices= DIRECTORY_LAYOUTS,
+        default= DEFAULT_LAYOUT,
+        help= (
+            "How to lay out the files in each user directory. \"prefix\" "
+            "uses directories for the first two characters of video IDs, "
+            "and \"date\" uses <year>/<month> directories."
+        )
+    )
+
+    parser.add_argument(
+        "--any-layout",
+        action= "store_true",
+        default= None,
+        help= (
+            "Look for videos which were already downloaded in every layout, "
+            "even in directories which were migrated to --layout. Otherwise, "
+            "the other layouts are only looked in until a directory has "
+            "been migrated."
+        )
+    )
+
+    parser.add_argument(
+        "--migrate-layout",
+        choices= DIRECTORY_LAYOUTS,
+        metavar= "LAYOUT",
+        help= (
+            "Move the files in every user directory in the output "
+            "directory into a layout for --layout, in place."
+        )
+    )
+
+    parser.add_argument(
+        "--no-catalog",
+        action= "store_true",
+        help= "Don't use the {} catalog in the output directory.".format(
+            CATALOG_FILENAME
+        )
+    )
+
+    parser.add_argument(
+        "--import-catalog",
+        action= "store_true",
+        help= "Build the catalog from the JSON files in the output directory."
+    )
+
+    parser.add_argument(
+        "--verify",
+        action= "store_true",
+        help= (
+            "Check the size and hash of every video in the output directory "
+            "against its JSON file, instead of downloading anything."
+        )
+    )
+
+    parser.add_argument(
+        "--verify-jobs",
+        type= int,
+        metavar= "N",
+        help= (
+            "The number of processes to check videos with. By default, "
+            "there is one for each CPU."
+        )
+    )
+
+    parser.add_argument(
+        "--probe",
+        action= "store_true",
+        help= "Also check that ffprobe can read every video with --verify."
+    )
+
+    parser.add_argument(
+        "--bad-list",
+        metavar= "FILE",
+        help= (
+            "Write the JSON files for the videos which failed --verify to "
+            "a file, which can be given to --redownload."
+        )
+    )
+
+    parser.add_argument(
+        "--redownload",
+        metavar= "FILE",
+        help= (
+            "Download the videos for a list of JSON files again, like "
+            "the list written by --bad-list, replacing the old files."
+        )
+    )
+
+    parser.add_argument(
+        "--incremental",
+        type= int,
+        metavar= "K",
+        help= (
+            "Stop reading the feed after K videos in a row were already "
+            "downloaded."
+        )
+    )
+
+    parser.add_argument(
+        "--batch",
+        metavar= "FILE",
+        help= (
+            "Download the videos for every username in a file, with one "
+            "username on each line, in one run."
+        )
+    )
+
+    parser.add_argument(
+        "--retries",
+        type= int,
+        default= DEFAULT_RETRY_BUDGET,
+        metavar= "N",
+        help= "The number of times to try each video before giving up."
+    )
+
+    parser.add_argument(
+        "--max-request-rate",
+        type= float,
+        default= RATE_CONTROLLER.max_rate,
+        metavar= "R",
+        help= (
+            "The most requests per second to make to each host. The rate "
+            "is lowered automatically when a host starts refusing requests."
+        )
+    )
+
+    args = parser.parse_args()
+
+    if args.import_catalog or args.migrate_layout is not None \
+    or args.verify or args.redownload is not None \
+    or args.batch is not None:
+        # The only argument is the output directory.
+        if args.output_directory is not None:
+            parser.error("Only an output directory can be given")
+
+        args.output_directory = args.username
+    elif args.username is None:
+        parser.error("A username is required")
+
+    if args.batch is not None and args.engine != "threads":
+        parser.error("--batch only works with the threads engine")
+
+    if args.engine != "threads":
+        for option in THREADS_ENGINE_OPTIONS:
+            name = option[2:].replace("-", "_")
+
+            if getattr(args, name) != parser.get_default(name):
+                parser.error("{} only works with the threads engine".format(
+                    option
+                ))
+
+    if args.output_directory is None:
+        args.output_directory = "output"
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    if args.mux_jobs < 1:
+        parser.error("--mux-jobs must be at least 1")
+
+    if args.prefetch_pages < 0:
+        parser.error("--prefetch-pages must not be negative")
+
+    if args.max_connections_per_host < 1:
+        parser.error("--max-connections-per-host must be at least 1")
+
+    if args.segments < 1:
+        parser.error("--segments must be at least 1")
+
+    try:
+        max_bandwidth = (
+            parse_byte_rate(args.max_bandwidth)
+            if args.max_bandwidth is not None else
+            None
+        )
+        max_download_bandwidth = (
+            parse_byte_rate(args.max_download_bandwidth)
+            if args.max_download_bandwidth is not None else
+            None
+        )
+        bandwidth_schedule = (
+            parse_bandwidth_schedule(args.bandwidth_schedule)
+            if args.bandwidth_schedule is not None else
+            ()
+        )
+        max_size = (
+            parse_byte_count(args.max_size)
+            if args.max_size is not None else
+            None
+        )
+    except ValueError as err:
+        parser.error(str(err))
+
+    if args.max_height is not None and args.max_height < 1:
+        parser.error("--max-height must be at least 1")
+
+    if args.max_video_bitrate is not None and args.max_video_bitrate <= 0:
+        parser.error("--max-video-bitrate must be more than 0")
+
+    preferred_formats = tuple(
+        file_type.strip().lower()
+        for file_type in (args.prefer_formats or "").split(",")
+        if file_type.strip()
+    )
+
+    for file_type in preferred_formats:
+        if file_type not in VIDEO_RATING_DICT:
+            parser.error("Unknown format for --prefer-formats: {}".format(
+                file_type
+            ))
+
+    if args.buffer_size < 1:
+        parser.error("--buffer-size must be at least 1")
+
+    if args.direct_io and not DIRECT_IO_SUPPORTED:
+        parser.error("--direct-io isn't supported on this system")
+
+    if args.direct_io and args.buffer_size * 1024 % DIRECT_IO_ALIGNMENT:
+        parser.error(
+            "--buffer-size must be a multiple of {} for --direct-io".format(
+                DIRECT_IO_ALIGNMENT // 1024
+            )
+        )
+
+    if args.sync_every is not None and args.sync_every < 1:
+        parser.error("--sync-every must be at least 1")
+
+    if args.stream_mux and not STREAM_MUX_SUPPORTED:
+        parser.error("--stream-mux needs Python 3 on a POSIX system")
+
+    if args.verify_jobs is not None and args.verify_jobs < 1:
+        parser.error("--verify-jobs must be at least 1")
+
+    if (args.probe or args.bad_list is not None) and not args.verify:
+        parser.error("--probe and --bad-list only work with --verify")
+
+    if args.incremental is not None and args.incremental < 1:
+        parser.error("--incremental must be at least 1")
+
+    if args.retries < 1:
+        parser.error("--retries must be at least 1")
+
+    if args.max_request_rate <= 0:
+        parser.error("--max-request-rate must be more than 0")
+
+    RATE_CONTROLLER.max_rate = args.max_request_rate
+    RATE_CONTROLLER.min_rate = min(
+        RATE_CONTROLLER.min_rate,
+        args.max_request_rate
+    )
+
+    HTTP_POOL.max_connections_per_host = args.max_connections_per_host
+
+    BANDWIDTH_GOVERNOR.max_rate = max_bandwidth
+    BANDWIDTH_GOVERNOR.schedule = bandwidth_schedule
+
+    if args.import_catalog:
+        if not os.path.isdir(args.output_directory):
+            sys.exit("{} is not a directory!".format(args.output_directory))
+
+        catalog = ArchiveCatalog.for_output_directory(args.output_directory)
+
+        sys.stderr.write("Imported {} videos into {}\n".format(
+            catalog.import_directory(args.output_directory),
+            catalog.filename
+        ))
+
+        sys.exit()
+
+    if args.verify:
+        if not os.path.isdir(args.output_directory):
+            sys.exit("{} is not a directory!".format(args.output_directory))
+
+        if args.probe:
+            try:
+                with open(os.devnull, "wb") as null_out:
+                    subprocess.check_call(
+                        ("ffprobe", "-h"),
+                        stdout= null_out,
+                        stderr= null_out
+                    )
+            except:
+                sys.exit("'ffprobe -h' failed! Please install ffmpeg.")
+
+        bad_list = []
+        video_count = 0
+        byte_count = 0
+        start_time = time.time()
+
+        for json_filename, problem_list, read_count in verify_archive(
+            args.output_directory,
+            args.verify_jobs,
+            args.probe
+        ):
+            video_count += 1
+            byte_count += read_count
+
+            if problem_list:
+                bad_list.append(json_filename)
+
+                for problem in problem_list:
+                    sys.stderr.write("{}: {}\n".format(json_filename, problem))
+
+        seconds = max(time.time() - start_time, 0.001)
+
+        sys.stderr.write(
+            "Verified {} videos, {:.1f} MiB in {:.1f}s "
+            "({:.1f} MiB/s, {:.1f} videos/s). {} had problems.\n".format(
+                video_count,
+                byte_count / 1024.0 / 1024,
+                seconds,
+                byte_count / 1024.0 / 1024 / seconds,
+                video_count / seconds,
+                len(bad_list)
+            )
+        )
+
+        if args.bad_list is not None:
+            with open(args.bad_list, "w") as bad_file:
+                for json_filename in sorted(bad_list):
+                    bad_file.write(json_filename)
+                    bad_file.write("\n")
+
+        sys.exit(1 if bad_list else 0)
+
+    if args.migrate_layout is not None:
+        if not os.path.isdir(args.output_directory):
+            sys.exit("{} is not a directory!".format(args.output_directory))
+
+        catalog_filename = os.path.join(
+            args.output_directory,
+            CATALOG_FILENAME
+        )
+
+        if not args.no_catalog and os.path.exists(catalog_filename):
+            catalog = ArchiveCatalog(catalog_filename)
+        else:
+            catalog = None
+
+        for username in sorted(os.listdir(args.output_directory)):
+            user_directory = os.path.join(args.output_directory, username)
+
+            if not os.path.isdir(user_directory):
+                continue
+
+            moved_count = migrate_layout(
+                user_directory,
+                args.migrate_layout,
+                catalog
+            )
+
+            sys.stderr.write("Moved {} videos for {} into {}\n".format(
+                moved_count,
+                username,
+                args.migrate_layout
+            ))
+
+        sys.exit()
+
+    try:
+        with open(os.devnull, "wb") as null_out:
+            subprocess.check_call(
+                ("ffmpeg", "-h"),
+                stdout= null_out,
+                stderr= null_out
+            )
+    except:
+        sys.exit("'ffmpeg -h' failed! Please install ffmpeg.")
+
+    if not os.path.exists(args.output_directory):
+        os.mkdir(args.output_directory)
+
+    if args.no_catalog:
+        catalog = None
+    else:
+        catalog = ArchiveCatalog.for_output_directory(args.output_directory)
+
+    transfer_options = TransferOptions(
+        segment_count= args.segments,
+        stream_mux= args.stream_mux,
+        buffer_size= args.buffer_size * 1024,
+        preallocate= not args.no_preallocate,
+        direct_io= args.direct_io,
+        sync_interval=
+            args.sync_every * 1024 * 1024
+            if args.sync_every is not None else
+            None,
+        max_download_rate= max_download_bandwidth,
+        hash_algorithm= args.hash if args.hash != "none" else None
+    )
+
+    policy = SelectionPolicy(
+        max_height= args.max_height,
+        max_video_bitrate= args.max_video_bitrate,
+        max_size= max_size,
+        preferred_formats= preferred_formats
+    )
+
+    if args.redownload is not None:
+        failed_count = redownload_json_files(
+            read_line_file(args.redownload),
+            args.output_directory,
+            log_file= sys.stderr,
+            jobs= args.jobs,
+            transfer_options= transfer_options,
+            catalog= catalog,
+            retry_budget= args.retries,
+            policy= policy,
+            layout= args.layout
+        )
+
+        sys.exit(1 if failed_count else 0)
+    elif args.batch is not None:
+        download_videos_for_users(
+            read_username_file(args.batch),
+            args.output_directory,
+            log_file= sys.stderr,
+            jobs= args.jobs,
+            prefetch_pages= args.prefetch_pages,
+            transfer_options= transfer_options,
+            catalog= catalog,
+            incremental= args.incremental,
+            retry_budget= args.retries,
+            mux_jobs= args.mux_jobs,
+            policy= policy,
+            layout= args.layout,
+            any_layout= args.any_layout
+        )
+    else:
+        download_videos_for_user(
+            args.username,
+            args.output_directory,
+            log_file= sys.stderr,
+            jobs= args.jobs,
+            engine= args.engine,
+            prefetch_pages= args.prefetch_pages,
+            transfer_options= transfer_options,
+            catalog= catalog,
+            incremental= args.incremental,
+            retry_budget= args.retries,
+            mux_jobs= args.mux_jobs,
+            policy= policy,
+            layout= args.layout,
+            any_layout= args.any_layout
+        )
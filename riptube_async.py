@@ -0,0 +1,1004 @@
+"""
+An asyncio engine for riptube, for Python 3.7 and above.
+
+The functions here mirror the blocking functions in riptube, but many
+requests can be made at the same time on one event loop, without
+a thread for each of them. The parsing and formatting functions from
+riptube are shared, so both engines produce the same files.
+
+This module has the same license as riptube.py.
+"""
+
+from itertools import count, islice
+from collections import deque
+from functools import partial
+import asyncio
+import os
+import socket
+import ssl
+import hashlib
+import io
+import http.client
+from urllib.parse import urlsplit, urljoin
+from urllib.error import HTTPError
+
+from riptube import (
+    MAX_RESULTS,
+    DEFAULT_PREFETCH_PAGES,
+    DEFAULT_RETRY_BUDGET,
+    HTTP_POOL,
+    RATE_CONTROLLER,
+    DOWNLOAD_INFO_CACHE,
+    backoff_delay,
+    is_retryable_error,
+    ItemLog,
+    browser_spoof_headers,
+    create_feed_url,
+    create_info_url,
+    feed_items_from_page_data,
+    remaining_page_indexes,
+    parse_video_info,
+    set_length_seconds,
+    download_options_from_stream_map,
+    download_options_from_hls_playlist,
+    download_options_from_dash_xml,
+    highest_quality_content,
+    DEFAULT_SELECTION_POLICY,
+    DEFAULT_LAYOUT,
+    DEFAULT_HASH_ALGORITHM,
+    DEFAULT_TRANSFER_OPTIONS,
+    file_hash_json,
+    hash_file,
+    layout_directory,
+    make_directories,
+    is_feed_item_archived,
+    needs_any_layout,
+    prepare_user_directory,
+    base_filename_for_feed_item,
+    mux_command,
+    write_feed_item_json,
+)
+
+# The number of seconds to wait for a connection or some data.
+REQUEST_TIMEOUT = 30
+
+# The maximum number of redirects to follow for one request.
+MAX_REDIRECTS = 10
+
+READ_SIZE = 1024 * 64
+
+# These transfer options are only used by the threads engine, and must
+# be left as they are in DEFAULT_TRANSFER_OPTIONS for this one.
+UNSUPPORTED_TRANSFER_OPTIONS = (
+    "segment_count",
+    "stream_mux",
+    "buffer_size",
+    "preallocate",
+    "direct_io",
+    "sync_interval",
+    "max_download_rate",
+)
+
+def unsupported_transfer_options(transfer_options):
+    """
+    Return a list of the names of the transfer options which were changed,
+    but which this engine doesn't support. Only the hash_algorithm can be
+    changed.
+    """
+    return [
+        name
+        for name in UNSUPPORTED_TRANSFER_OPTIONS
+        if getattr(transfer_options, name)
+        != getattr(DEFAULT_TRANSFER_OPTIONS, name)
+    ]
+
+async def run_blocking(function, *args):
+    """
+    Call a function which blocks, like one which writes to a file or
+    the catalog, in the default executor, so the event loop keeps running.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        None,
+        partial(function, *args)
+    )
+
+class AsyncConnection (object):
+    """
+    This object holds the streams for one connection from
+    an AsyncConnectionPool.
+    """
+    def __init__(self, key, reader, writer, reused, semaphore):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        # True if the connection was used for an earlier request.
+        self.reused = reused
+        # This is released when the connection is given back.
+        self.semaphore = semaphore
+
+class AsyncConnectionPool (object):
+    """
+    This object keeps HTTP connections open for the asyncio engine, like
+    riptube.HTTPConnectionPool does for threads, so requests to the same
+    host reuse them with keep-alive, and the handshakes are only paid
+    once per connection.
+
+    Up to max_connections_per_host connections to one host are used at
+    once, or as many as riptube.HTTP_POOL allows if that is None, and
+    other requests to the host wait for one to be released. Connections
+    belong to the event loop they were opened on, so the pool starts
+    again empty when it is used on a new loop.
+    """
+    def __init__(self, max_connections_per_host= None):
+        assert max_connections_per_host is None \
+            or max_connections_per_host >= 1
+
+        self.max_connections_per_host = max_connections_per_host
+        # The number of connections which have been opened.
+        self.open_count = 0
+        self.__loop = None
+        self.__idle_dict = {}
+        self.__semaphore_dict = {}
+
+    def __semaphore(self, key):
+        loop = asyncio.get_running_loop()
+
+        if loop is not self.__loop:
+            # The connections from an old loop can't be used on this one,
+            # and that loop is closed already, which closed them.
+            self.__loop = loop
+            self.__idle_dict = {}
+            self.__semaphore_dict = {}
+
+        if key not in self.__semaphore_dict:
+            self.__semaphore_dict[key] = asyncio.Semaphore(
+                self.max_connections_per_host
+                or HTTP_POOL.max_connections_per_host
+            )
+
+        return self.__semaphore_dict[key]
+
+    async def acquire(self, url):
+        """
+        Return an AsyncConnection for the host of a URL, reusing an idle
+        connection if there is one. It must be given back with release.
+        """
+        parts = urlsplit(url)
+
+        if parts.scheme == "https":
+            port = parts.port or 443
+            ssl_context = ssl.create_default_context()
+        else:
+            port = parts.port or 80
+            ssl_context = None
+
+        key = (parts.scheme, parts.hostname, port)
+        semaphore = self.__semaphore(key)
+
+        await semaphore.acquire()
+
+        idle_list = self.__idle_dict.get(key, [])
+
+        while idle_list:
+            reader, writer = idle_list.pop()
+
+            if not reader.at_eof() and not writer.is_closing():
+                return AsyncConnection(
+                    key,
+                    reader,
+                    writer,
+                    True,
+                    semaphore
+                )
+
+            # The server closed this connection while it was idle.
+            writer.close()
+
+        try:
+            reader, writer = await _with_timeout(asyncio.open_connection(
+                parts.hostname,
+                port,
+                ssl= ssl_context
+            ))
+        except BaseException:
+            semaphore.release()
+            raise
+
+        self.open_count += 1
+
+        return AsyncConnection(key, reader, writer, False, semaphore)
+
+    def release(self, connection, reusable):
+        """
+        Give back a connection from acquire. If reusable is True,
+        the response was read to the end and the connection can be used
+        for another request. Otherwise, it is closed.
+        """
+        if reusable and self.__loop is asyncio.get_running_loop():
+            self.__idle_dict.setdefault(connection.key, []).append(
+                (connection.reader, connection.writer)
+            )
+        else:
+            connection.writer.close()
+
+        connection.semaphore.release()
+
+    def close(self):
+        """
+        Close the idle connections.
+        """
+        for idle_list in self.__idle_dict.values():
+            for reader, writer in idle_list:
+                writer.close()
+
+        self.__idle_dict = {}
+
+ASYNC_HTTP_POOL = AsyncConnectionPool()
+
+class AsyncResponse (object):
+    """
+    This object represents the response for an HTTP request made with
+    async_urlopen. The body can be read with the read coroutine.
+
+    The connection is given back to ASYNC_HTTP_POOL when the response is
+    closed, or when the body has been read to the end, and it is kept
+    open for the next request if the server allows that.
+    """
+    def __init__(self, url, status, headers, connection, keep_alive):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.__connection = connection
+        self.__reader = connection.reader
+
+        transfer_encoding = headers.get("Transfer-Encoding", "").lower()
+
+        self.__chunked = transfer_encoding == "chunked"
+        self.__chunk_left = 0
+        self.__done = False
+
+        if self.__chunked or headers.get("Content-Length") is None:
+            self.__length_left = None
+        else:
+            self.__length_left = int(headers["Content-Length"])
+
+        # Without a length, the body ends when the connection is closed.
+        self.__keep_alive = keep_alive and (
+            self.__chunked or self.__length_left is not None
+        )
+        self.__complete = self.__length_left == 0
+
+    async def __read_some(self, size):
+        return await _with_timeout(self.__reader.read(size))
+
+    async def __read_exactly(self, size):
+        try:
+            return await _with_timeout(self.__reader.readexactly(size))
+        except asyncio.IncompleteReadError as err:
+            raise http.client.IncompleteRead(err.partial, size)
+
+    async def __read_chunk(self, size):
+        if self.__chunk_left == 0:
+            size_line = await _with_timeout(self.__reader.readline())
+            # Chunk extensions after ; are ignored.
+            self.__chunk_left = int(size_line.split(b";")[0], 16)
+
+            if self.__chunk_left == 0:
+                # Skip the trailer, up to the final blank line.
+                while (await _with_timeout(self.__reader.readline())) \
+                not in (b"\r\n", b"\n", b""):
+                    pass
+
+                self.__complete = True
+
+                return b""
+
+        data = await self.__read_exactly(min(size, self.__chunk_left))
+        self.__chunk_left -= len(data)
+
+        if self.__chunk_left == 0:
+            # Skip the CRLF after the chunk data.
+            await self.__read_exactly(2)
+
+        return data
+
+    async def read(self, size= -1):
+        """
+        Read up to size bytes of the body, or all of the remaining body
+        when size is negative. Empty bytes are returned at the end.
+        """
+        if size < 0:
+            part_list = []
+
+            while True:
+                data = await self.read(READ_SIZE)
+
+                if not data:
+                    return b"".join(part_list)
+
+                part_list.append(data)
+
+        if self.__done or size == 0:
+            return b""
+
+        if self.__chunked:
+            data = await self.__read_chunk(size)
+        elif self.__length_left is not None:
+            if self.__length_left == 0:
+                data = b""
+            else:
+                data = await self.__read_some(min(size, self.__length_left))
+
+                if not data:
+                    raise http.client.IncompleteRead(b"", self.__length_left)
+
+                self.__length_left -= len(data)
+                self.__complete = self.__length_left == 0
+        else:
+            # Read until the server closes the connection.
+            data = await self.__read_some(size)
+
+        if not data:
+            self.close()
+
+        return data
+
+    def close(self):
+        """
+        Give the connection back to the pool. It is only kept open if
+        the whole body was read.
+        """
+        self.__done = True
+
+        if self.__connection is not None:
+            ASYNC_HTTP_POOL.release(
+                self.__connection,
+                self.__keep_alive and self.__complete
+            )
+            self.__connection = None
+
+async def _with_timeout(coroutine):
+    """
+    Wait for a coroutine with the request timeout, raising socket.timeout
+    like the blocking functions do when the time runs out.
+    """
+    try:
+        return await asyncio.wait_for(coroutine, REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise socket.timeout("timed out")
+
+async def _send_request(url, headers):
+    parts = urlsplit(url)
+    path = parts.path or "/"
+
+    if parts.query:
+        path += "?" + parts.query
+
+    header_lines = [
+        "GET {} HTTP/1.1".format(path),
+        "Host: {}".format(parts.netloc),
+        # Ask for the body as it is.
+        "Accept-Encoding: identity",
+    ]
+    header_lines.extend(
+        "{}: {}".format(name, value)
+        for name, value in sorted(headers.items())
+    )
+    request_data = ("\r\n".join(header_lines) + "\r\n\r\n").encode(
+        "latin-1"
+    )
+
+    while True:
+        connection = await ASYNC_HTTP_POOL.acquire(url)
+
+        try:
+            connection.writer.write(request_data)
+            status_line = await _with_timeout(connection.reader.readline())
+        except ConnectionError:
+            ASYNC_HTTP_POOL.release(connection, False)
+
+            if connection.reused:
+                # The server closed the idle connection, so try a new one.
+                continue
+
+            raise
+        except BaseException:
+            ASYNC_HTTP_POOL.release(connection, False)
+            raise
+
+        if not status_line and connection.reused:
+            ASYNC_HTTP_POOL.release(connection, False)
+            continue
+
+        break
+
+    try:
+        status_line = status_line.decode("latin-1")
+
+        try:
+            status = int(status_line.split(None, 2)[1])
+        except (IndexError, ValueError):
+            raise http.client.BadStatusLine(status_line)
+
+        header_data = bytearray()
+
+        while True:
+            line = await _with_timeout(connection.reader.readline())
+            header_data += line
+
+            if line in (b"\r\n", b"\n", b""):
+                break
+    except BaseException:
+        ASYNC_HTTP_POOL.release(connection, False)
+        raise
+
+    response_headers = http.client.parse_headers(io.BytesIO(header_data))
+    keep_alive = status_line.startswith("HTTP/1.1") \
+        and response_headers.get("Connection", "").lower() != "close"
+
+    return AsyncResponse(
+        url,
+        status,
+        response_headers,
+        connection,
+        keep_alive
+    )
+
+async def async_urlopen(url, headers= None):
+    """
+    Make a GET request for a URL, following redirects, and return
+    an AsyncResponse.
+
+    Each request waits for RATE_CONTROLLER, and the status of each
+    response is reported to it, like for riptube.HTTP_POOL.
+
+    HTTPError will be raised for error responses, like urlopen does.
+    """
+    headers = dict(headers or ())
+
+    for redirect_count in range(MAX_REDIRECTS + 1):
+        host = urlsplit(url).hostname
+        delay = RATE_CONTROLLER.reserve(host)
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        response = await _send_request(url, headers)
+
+        RATE_CONTROLLER.record_response(host, response.status)
+
+        if response.status in (301, 302, 303, 307, 308) \
+        and "Location" in response.headers:
+            response.close()
+            url = urljoin(url, response.headers["Location"])
+            continue
+
+        if response.status >= 400:
+            response.close()
+
+            raise HTTPError(
+                url,
+                response.status,
+                http.client.responses.get(response.status, ""),
+                response.headers,
+                None
+            )
+
+        return response
+
+    raise HTTPError(url, response.status, "Too many redirects", None, None)
+
+async def async_browser_spoof_open(url):
+    return await async_urlopen(url, browser_spoof_headers())
+
+async def async_read_url(url, spoof= True):
+    """
+    Download the whole body for a URL.
+    """
+    if spoof:
+        response = await async_browser_spoof_open(url)
+    else:
+        response = await async_urlopen(url)
+
+    try:
+        return await response.read()
+    finally:
+        response.close()
+
+async def download_video_feed_async(feed_url):
+    """
+    Given a feed URL, download a tuple of FeedItems.
+    """
+    return (await download_video_feed_with_total_async(feed_url))[1]
+
+async def download_video_feed_with_total_async(feed_url):
+    """
+    Given a feed URL, download a pair (total_results, feed_items), where
+    total_results is the total number of videos in the whole feed, or None
+    if the URL didn't ask for it, and feed_items is a tuple of FeedItems.
+    """
+    body = await async_read_url(feed_url, spoof= False)
+    total_list = []
+    # The whole body is read already, so it's decoded at once.
+    feed_items = feed_items_from_page_data(body, total_list.append)
+
+    return (total_list[0] if total_list else None, feed_items)
+
+async def feed_pages_async(username, prefetch= DEFAULT_PREFETCH_PAGES):
+    """
+    Generate the pages of the uploads feed for a user, in order, as tuples
+    of FeedItems, like riptube.feed_pages.
+
+    The first page is downloaded with the total number of videos in the
+    feed, and then up to 'prefetch' of the other pages will be downloaded
+    in other tasks at the same time, while the current page is being used.
+    """
+    assert isinstance(prefetch, int)
+    assert prefetch >= 0
+
+    def download_page(page_index):
+        return asyncio.ensure_future(download_video_feed_async(
+            create_feed_url(username, page_index)
+        ))
+
+    total_results, entry_list = await download_video_feed_with_total_async(
+        create_feed_url(username, 0, with_total= True)
+    )
+
+    page_index_iter = iter(remaining_page_indexes(total_results))
+    pending_tasks = deque(
+        download_page(page_index)
+        for page_index in islice(page_index_iter, prefetch)
+    )
+
+    try:
+        while True:
+            yield entry_list
+
+            if len(entry_list) < MAX_RESULTS:
+                break
+
+            if prefetch == 0:
+                # The next page is only downloaded once this one is used.
+                for page_index in islice(page_index_iter, 1):
+                    pending_tasks.append(download_page(page_index))
+
+            if not pending_tasks:
+                # There are no more pages, going by the total.
+                break
+
+            task = pending_tasks.popleft()
+
+            if prefetch > 0:
+                # Keep 'prefetch' pages downloading ahead.
+                for page_index in islice(page_index_iter, 1):
+                    pending_tasks.append(download_page(page_index))
+
+            entry_list = await task
+    finally:
+        # Pages past the end of the feed aren't needed.
+        for task in pending_tasks:
+            task.cancel()
+
+async def user_videos_async(username, prefetch= DEFAULT_PREFETCH_PAGES):
+    """
+    Generate a list of all videos for a user.
+    """
+    async for entry_list in feed_pages_async(username, prefetch):
+        for entry in entry_list:
+            yield entry
+
+async def _download_options_from_hlsvp_async(video_info):
+    m3u_url_list = video_info.get("hlsvp")
+
+    if not m3u_url_list:
+        return ()
+
+    playlist_text = (await async_read_url(m3u_url_list[0])).decode()
+
+    return tuple(download_options_from_hls_playlist(playlist_text))
+
+async def _download_options_from_dash_document_async(video_info):
+    manifest_url_list = video_info.get("dashmpd")
+
+    if not manifest_url_list:
+        return ()
+
+    document_data = await async_read_url(manifest_url_list[0])
+
+    return tuple(download_options_from_dash_xml(document_data))
+
+async def download_info_async(info_url, satisfied= None):
+    """
+    Download the info for a video, and return a tuple of DownloadInfo
+    objects for every available format, like riptube.download_info.
+
+    The HLS playlist and the DASH document are downloaded at the same time,
+    unless 'satisfied' returns True for the formats in the stream map.
+    """
+    info_text = (await async_read_url(info_url)).decode()
+    video_info = parse_video_info(info_url, info_text)
+
+    stream_map_options = set_length_seconds(
+        download_options_from_stream_map(video_info),
+        video_info
+    )
+
+    if satisfied is not None and satisfied(stream_map_options):
+        return stream_map_options
+
+    hls_options, dash_options = await asyncio.gather(
+        _download_options_from_hlsvp_async(video_info),
+        _download_options_from_dash_document_async(video_info),
+    )
+
+    return stream_map_options + set_length_seconds(
+        hls_options + dash_options,
+        video_info
+    )
+
+async def download_to_file_async(url, filename,
+hash_algorithm= DEFAULT_HASH_ALGORITHM):
+    """
+    Download an entire file to a given filename.
+
+    The file is hashed as it is written, and the JSON for the hash is
+    returned, or None if hash_algorithm is None.
+    """
+    response = await async_browser_spoof_open(url)
+    hasher = hashlib.new(hash_algorithm) if hash_algorithm else None
+    size = 0
+
+    def write_data(out_file, data):
+        out_file.write(data)
+
+        if hasher is not None:
+            hasher.update(data)
+
+    try:
+        out_file = await run_blocking(open, filename, "wb")
+
+        try:
+            while True:
+                data = await response.read(READ_SIZE)
+
+                if not data:
+                    break
+
+                # The data is written and hashed in the executor.
+                await run_blocking(write_data, out_file, data)
+                size += len(data)
+        finally:
+            await run_blocking(out_file.close)
+    finally:
+        response.close()
+
+    if hasher is None:
+        return None
+
+    return file_hash_json(
+        hash_algorithm,
+        size,
+        [(0, size, hasher.hexdigest())]
+    )
+
+def remove_old_video(item_directory, video_filename):
+    """
+    Make the directory for a video, and remove the video file if it's
+    there already.
+    """
+    make_directories(item_directory)
+
+    if os.path.exists(video_filename):
+        os.remove(video_filename)
+
+def remove_files(filename_seq):
+    for filename in filename_seq:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+async def download_feed_item_async(feed_item, base_directory, catalog= None,
+policy= DEFAULT_SELECTION_POLICY, layout= DEFAULT_LAYOUT,
+hash_algorithm= DEFAULT_HASH_ALGORITHM):
+    """
+    Download a feed item into a directory.
+
+    Return a pair (video_filename, json_filename) if the item is downloaded,
+    otherwise return None if the video has already been downloaded.
+
+    If an ArchiveCatalog is given, it will be used for checking if the item
+    was downloaded before, and it will be updated with the JSON file.
+    The content is picked with the SelectionPolicy, and the files are put
+    in the directory for the layout. The files are hashed with
+    the hash_algorithm, like for riptube.fetch_feed_item.
+    """
+    base_filename = base_filename_for_feed_item(feed_item)
+    item_directory = layout_directory(base_directory, base_filename, layout)
+
+    json_filename = os.path.join(
+        item_directory,
+        "{}.json".format(base_filename)
+    )
+
+    # The other layouts were looked in before the item was queued.
+    if await run_blocking(
+        is_feed_item_archived,
+        feed_item,
+        base_directory,
+        catalog,
+        layout,
+        False
+    ):
+        # Stop here, we already have this video.
+        return
+
+    download_options = DOWNLOAD_INFO_CACHE.get(feed_item.video_id)
+
+    if download_options is None:
+        download_options = await download_info_async(
+            create_info_url(feed_item.video_id),
+            policy.satisfied
+        )
+        DOWNLOAD_INFO_CACHE.put(feed_item.video_id, download_options)
+
+    content = highest_quality_content(download_options, policy)
+
+    video_content = content[0] if isinstance(content, tuple) else content
+
+    assert video_content.media_type.has_video
+
+    video_filename = os.path.join(item_directory, "{}.{}".format(
+        base_filename, video_content.media_type.file_type
+    ))
+
+    await run_blocking(remove_old_video, item_directory, video_filename)
+
+    try:
+        if isinstance(content, tuple):
+            temp_video_filename = video_filename + ".video"
+            temp_audio_filename = video_filename + ".audio"
+
+            try:
+                # Download video and audio at the same time.
+                track_hash_list = list(await asyncio.gather(
+                    download_to_file_async(
+                        content[0].url,
+                        temp_video_filename,
+                        hash_algorithm
+                    ),
+                    download_to_file_async(
+                        content[1].url,
+                        temp_audio_filename,
+                        hash_algorithm
+                    ),
+                ))
+
+                # Now use ffmpeg to join the audio and video together.
+                process = await asyncio.create_subprocess_exec(*mux_command(
+                    temp_video_filename,
+                    temp_audio_filename,
+                    video_filename
+                ))
+
+                if await process.wait() != 0:
+                    raise RuntimeError("ffmpeg failed for {}".format(
+                        video_filename
+                    ))
+
+                if hash_algorithm is not None:
+                    # ffmpeg wrote the file, so it has to be read again.
+                    video_hash_json = await run_blocking(
+                        hash_file,
+                        video_filename,
+                        hash_algorithm
+                    )
+                else:
+                    video_hash_json = None
+            finally:
+                # Clean up temporary files.
+                await run_blocking(
+                    remove_files,
+                    (temp_video_filename, temp_audio_filename)
+                )
+        else:
+            # Download one audio-video file.
+            track_hash_list = None
+            video_hash_json = await download_to_file_async(
+                video_content.url,
+                video_filename,
+                hash_algorithm
+            )
+    except HTTPError as err:
+        if err.code == 403:
+            # The signed URLs have probably expired.
+            DOWNLOAD_INFO_CACHE.invalidate(feed_item.video_id)
+
+        raise
+
+    if video_hash_json is not None:
+        integrity_json = {"video": video_hash_json}
+
+        if track_hash_list is not None:
+            integrity_json["tracks"] = track_hash_list
+    else:
+        integrity_json = None
+
+    await run_blocking(
+        write_feed_item_json,
+        json_filename,
+        feed_item,
+        content,
+        catalog,
+        video_filename,
+        os.path.basename(os.path.normpath(base_directory)),
+        integrity_json
+    )
+
+    return (video_filename, json_filename)
+
+async def download_feed_item_with_retries_async(feed_item, base_directory,
+log, catalog= None, retry_budget= DEFAULT_RETRY_BUDGET,
+policy= DEFAULT_SELECTION_POLICY, layout= DEFAULT_LAYOUT,
+hash_algorithm= DEFAULT_HASH_ALGORITHM):
+    """
+    Download a feed item into a directory, retrying the download when
+    the request errors which YouTube randomly returns are hit, like
+    riptube.download_feed_item_with_retries.
+    """
+    for attempt in count():
+        try:
+            return await download_feed_item_async(
+                feed_item,
+                base_directory,
+                catalog,
+                policy,
+                layout,
+                hash_algorithm
+            )
+        except Exception as err:
+            if not is_retryable_error(err):
+                raise
+
+            if retry_budget is not None and attempt + 1 >= retry_budget:
+                log("Giving up after {} tries: {}", attempt + 1, err)
+                raise
+
+            delay = backoff_delay(attempt)
+
+            log(
+                "Got a request error ({}), sleeping for {:.1f}s...",
+                err,
+                delay
+            )
+            RATE_CONTROLLER.record_backoff(delay)
+            await asyncio.sleep(delay)
+
+async def download_videos_for_user_async(username, output_directory,
+log_file= None, jobs= 1, prefetch_pages= DEFAULT_PREFETCH_PAGES,
+catalog= None, incremental= None, retry_budget= DEFAULT_RETRY_BUDGET,
+policy= DEFAULT_SELECTION_POLICY, layout= DEFAULT_LAYOUT,
+any_layout= None, hash_algorithm= DEFAULT_HASH_ALGORITHM):
+    """
+    Download all of the videos for a user into a directory named after
+    the user inside of the output directory.
+
+    Up to 'jobs' videos will be downloaded at the same time, all on the
+    running event loop, and up to 'prefetch_pages' pages of the feed
+    will be downloaded ahead. Connections are kept open in ASYNC_HTTP_POOL
+    and reused for the requests to each host.
+
+    If an ArchiveCatalog is given, it will be used for finding videos which
+    were already downloaded, and for recording new ones. 'incremental',
+    'retry_budget', 'policy', 'layout' and 'any_layout' work like they do
+    for riptube.download_videos_for_user, and files are hashed with
+    the hash_algorithm.
+    """
+    assert isinstance(jobs, int)
+    assert jobs >= 1
+
+    def write_lines(line_seq):
+        if log_file is not None:
+            for line in line_seq:
+                log_file.write(line)
+                log_file.write("\n")
+
+    username = username.lower()
+
+    user_directory = os.path.join(output_directory, username)
+    prepare_user_directory(user_directory, layout)
+
+    write_lines(("Downloading videos for username: {}".format(username),))
+
+    semaphore = asyncio.Semaphore(jobs)
+    task_set = set()
+
+    async def download_item(feed_item):
+        item_log = ItemLog()
+
+        try:
+            feed_result = await download_feed_item_with_retries_async(
+                feed_item,
+                user_directory,
+                item_log,
+                catalog,
+                retry_budget,
+                policy,
+                layout,
+                hash_algorithm
+            )
+
+            if feed_result is not None:
+                item_log(
+                    "Grabbed item {} - {}",
+                    feed_item.video_id,
+                    feed_item.title
+                )
+                item_log("filename: {}", feed_result[0])
+                item_log("JSON filename: {}", feed_result[1])
+        except Exception:
+            if catalog is not None:
+                await run_blocking(
+                    catalog.record_failure,
+                    username,
+                    feed_item
+                )
+
+            raise
+        finally:
+            write_lines(item_log.lines)
+            semaphore.release()
+
+    def forget_task(task):
+        # Failed tasks are kept around so the error can be raised.
+        if not task.cancelled() and task.exception() is None:
+            task_set.discard(task)
+
+    archived_count = 0
+
+    if any_layout is None:
+        any_layout = await run_blocking(
+            needs_any_layout,
+            user_directory,
+            layout
+        )
+
+    try:
+        async for feed_item in user_videos_async(username, prefetch_pages):
+            if await run_blocking(
+                is_feed_item_archived,
+                feed_item,
+                user_directory,
+                catalog,
+                layout,
+                any_layout
+            ):
+                archived_count += 1
+
+                if incremental is not None and archived_count >= incremental:
+                    break
+
+                continue
+
+            archived_count = 0
+
+            await semaphore.acquire()
+
+            # Stop early if a download has failed.
+            for task in task_set:
+                if task.done() and task.exception() is not None:
+                    semaphore.release()
+                    raise task.exception()
+
+            task = asyncio.ensure_future(download_item(feed_item))
+            task_set.add(task)
+            task.add_done_callback(forget_task)
+
+        # Wait for the rest, raising the first error.
+        if task_set:
+            await asyncio.gather(*task_set)
+    finally:
+        for task in task_set:
+            task.cancel()
+
+        # The connections can't be used after the event loop is closed.
+        ASYNC_HTTP_POOL.close()
@@ -0,0 +1,72 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import riptube
+
+# This stands in for ffmpeg when tracks are streamed into it. It reads all
+# of the audio before any of the video, which a real ffmpeg can also do
+# for a while, so the video track is held up until the audio arrives.
+FAKE_FFMPEG = """#!{}
+import os
+import sys
+
+input_list = [
+    sys.argv[index + 1].replace("pipe:", "/dev/fd/")
+    for index, arg in enumerate(sys.argv)
+    if arg == "-i"
+]
+
+with open(sys.argv[-1], "wb") as out_file:
+    for filename in reversed(input_list):
+        with open(filename, "rb") as in_file:
+            out_file.write(in_file.read())
+"""
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    bin_directory = tmp_path / "bin"
+    bin_directory.mkdir()
+    ffmpeg_filename = bin_directory / "ffmpeg"
+    ffmpeg_filename.write_text(FAKE_FFMPEG.format(sys.executable))
+    ffmpeg_filename.chmod(0o755)
+
+    monkeypatch.setenv(
+        "PATH",
+        str(bin_directory) + os.pathsep + os.environ.get("PATH", "")
+    )
+
+@pytest.fixture
+def stand_in_server(monkeypatch):
+    """
+    Return a function which starts a benchmark.StandInServer with
+    the arguments it is given, and points riptube at it for the test.
+    """
+    server_list = []
+
+    # StandInServer.start changes these, so they are put back afterwards.
+    monkeypatch.setattr(riptube, "API_URL", riptube.API_URL)
+    monkeypatch.setattr(riptube, "INFO_URL", riptube.INFO_URL)
+
+    def start(video_count= 2, size= 1024 * 64, **kwargs):
+        server = benchmark.StandInServer(video_count, size, **kwargs)
+        server.start()
+        server_list.append(server)
+
+        return server
+
+    yield start
+
+    for server in server_list:
+        server.shutdown()
+        server.server_close()
+
+        # The URLs for the videos are only good for this server.
+        for index in range(server.video_count):
+            riptube.DOWNLOAD_INFO_CACHE.invalidate(
+                benchmark.stand_in_video_id(index)
+            )
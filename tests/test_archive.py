@@ -0,0 +1,140 @@
+import os
+
+import benchmark
+import riptube
+
+def download_archive(output_directory, catalog= None, **kwargs):
+    riptube.download_videos_for_user(
+        benchmark.STAND_IN_USERNAME,
+        output_directory,
+        catalog= catalog,
+        retry_budget= 1,
+        **kwargs
+    )
+
+    return sorted(riptube.archive_json_filenames(output_directory))
+
+def corrupt(filename):
+    with open(filename, "r+b") as media_file:
+        media_file.write(b"corrupted")
+
+def read_file(filename):
+    with open(filename, "rb") as media_file:
+        return media_file.read()
+
+def test_verify_finds_corrupted_videos(stand_in_server, tmp_path):
+    stand_in_server()
+    output_directory = str(tmp_path)
+    json_filename_list = download_archive(output_directory)
+
+    assert len(json_filename_list) == 2
+
+    for json_filename in json_filename_list:
+        assert riptube.verify_json_file(json_filename)[1] == []
+
+    video_filename = os.path.splitext(json_filename_list[0])[0] + ".mp4"
+    corrupt(video_filename)
+
+    problem_dict = {
+        json_filename: problem_list
+        for json_filename, problem_list, _ in riptube.verify_archive(
+            output_directory,
+            jobs= 1
+        )
+    }
+
+    assert problem_dict[json_filename_list[0]]
+    assert problem_dict[json_filename_list[1]] == []
+
+def test_redownload_keeps_the_archive_when_the_video_is_gone(
+stand_in_server, tmp_path):
+    server = stand_in_server()
+    output_directory = str(tmp_path)
+    catalog = riptube.ArchiveCatalog.for_output_directory(output_directory)
+    json_filename = download_archive(output_directory, catalog)[0]
+    video_filename = os.path.splitext(json_filename)[0] + ".mp4"
+    video_id = riptube.BASE_FILENAME_REGEX.match(
+        os.path.basename(json_filename)
+    ).group(1).split("_", 1)[1]
+
+    corrupt(video_filename)
+    old_video_data = read_file(video_filename)
+    old_json_data = read_file(json_filename)
+
+    server.removed_video_ids.add(video_id)
+    riptube.DOWNLOAD_INFO_CACHE.invalidate(video_id)
+
+    failed_count = riptube.redownload_json_files(
+        [json_filename],
+        output_directory,
+        catalog= catalog,
+        retry_budget= 1
+    )
+
+    assert failed_count == 1
+    assert read_file(video_filename) == old_video_data
+    assert read_file(json_filename) == old_json_data
+    assert catalog.is_archived(video_id)
+    assert not any(
+        filename.startswith(".redownload-")
+        for filename in os.listdir(os.path.dirname(json_filename))
+    )
+
+    server.removed_video_ids.clear()
+
+    failed_count = riptube.redownload_json_files(
+        [json_filename],
+        output_directory,
+        catalog= catalog,
+        retry_budget= 1
+    )
+
+    assert failed_count == 0
+    assert riptube.verify_json_file(json_filename)[1] == []
+    assert catalog.is_archived(video_id)
+    assert len(list(riptube.archive_json_filenames(output_directory))) == 2
+
+def test_redownload_moves_videos_into_the_layout(stand_in_server, tmp_path):
+    stand_in_server()
+    output_directory = str(tmp_path)
+    json_filename = download_archive(output_directory)[0]
+
+    failed_count = riptube.redownload_json_files(
+        [json_filename],
+        output_directory,
+        retry_budget= 1,
+        layout= "prefix"
+    )
+
+    assert failed_count == 0
+    assert not os.path.exists(json_filename)
+
+    json_filename_list = list(
+        riptube.archive_json_filenames(output_directory)
+    )
+
+    assert len(json_filename_list) == 2
+    assert all(
+        riptube.verify_json_file(filename)[1] == []
+        for filename in json_filename_list
+    )
+
+def test_verify_reports_a_missing_ffprobe(stand_in_server, tmp_path,
+monkeypatch):
+    stand_in_server()
+    output_directory = str(tmp_path)
+    download_archive(output_directory)
+
+    monkeypatch.setenv("PATH", str(tmp_path / "empty"))
+
+    result_list = list(riptube.verify_archive(
+        output_directory,
+        jobs= 1,
+        probe= True
+    ))
+
+    assert len(result_list) == 2
+
+    for json_filename, problem_list, _ in result_list:
+        assert len(problem_list) == 1
+        assert problem_list[0].startswith("ffprobe can't be run")
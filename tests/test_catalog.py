@@ -0,0 +1,90 @@
+import sqlite3
+
+import pytest
+
+import benchmark
+import riptube
+
+def video_status(catalog, video_id):
+    connection = sqlite3.connect(catalog.filename)
+
+    try:
+        row = connection.execute(
+            "SELECT status FROM video WHERE video_id = ?",
+            (video_id,)
+        ).fetchone()
+    finally:
+        connection.close()
+
+    return row[0] if row is not None else None
+
+@pytest.mark.parametrize("engine", riptube.ENGINE_LIST)
+def test_failed_videos_are_recorded_and_tried_again(stand_in_server,
+tmp_path, engine):
+    server = stand_in_server(video_count= 3)
+    output_directory = str(tmp_path)
+    catalog = riptube.ArchiveCatalog.for_output_directory(output_directory)
+    video_id = benchmark.stand_in_video_id(1)
+
+    server.removed_video_ids.add(video_id)
+
+    if engine == "threads":
+        stats_list = riptube.download_videos_for_users(
+            [benchmark.STAND_IN_USERNAME],
+            output_directory,
+            catalog= catalog,
+            retry_budget= 1
+        )
+
+        assert stats_list[0].failed_count == 1
+    else:
+        with pytest.raises(RuntimeError):
+            riptube.download_videos_for_user(
+                benchmark.STAND_IN_USERNAME,
+                output_directory,
+                engine= engine,
+                catalog= catalog,
+                retry_budget= 1
+            )
+
+    assert video_status(catalog, video_id) == "failed"
+    assert not catalog.is_archived(video_id)
+
+    server.removed_video_ids.clear()
+
+    riptube.download_videos_for_user(
+        benchmark.STAND_IN_USERNAME,
+        output_directory,
+        engine= engine,
+        catalog= catalog,
+        retry_budget= 1
+    )
+
+    assert all(
+        video_status(catalog, benchmark.stand_in_video_id(index))
+        == "complete"
+        for index in range(3)
+    )
+
+def test_failures_dont_replace_archived_videos(tmp_path):
+    catalog = riptube.ArchiveCatalog.for_output_directory(str(tmp_path))
+    feed_item = riptube.FeedItem(
+        "abcdefghijk",
+        riptube.datetime.datetime(2013, 5, 6),
+        "A video",
+        "A description"
+    )
+    item_json = {
+        "content": [{"media_type": riptube.ITAG_MAP[22].to_json()}],
+        "feed_item": feed_item.to_json(),
+    }
+
+    catalog.record_failure("someone", feed_item)
+
+    assert video_status(catalog, feed_item.video_id) == "failed"
+
+    catalog.record("someone", item_json, None, None)
+    catalog.record_failure("someone", feed_item)
+
+    assert video_status(catalog, feed_item.video_id) == "complete"
+    assert catalog.is_archived(feed_item.video_id)
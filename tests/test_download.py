@@ -0,0 +1,268 @@
+import hashlib
+import http.client
+import os
+import time
+
+import pytest
+
+import benchmark
+import riptube
+
+@pytest.mark.parametrize("size, segment_count", [
+    (0, 4),
+    (1000, 4),
+    (riptube.MIN_SEGMENT_SIZE * 4, 4),
+    (riptube.MIN_SEGMENT_SIZE * 4 + 12345, 4),
+    (riptube.MIN_SEGMENT_SIZE * 3 - 1, 8),
+    (riptube.MIN_SEGMENT_SIZE * 100, 7),
+])
+def test_split_byte_range(size, segment_count):
+    range_list = riptube.split_byte_range(size, segment_count)
+
+    assert 1 <= len(range_list) <= segment_count
+    assert range_list[0][0] == 0
+    assert range_list[-1][1] == size
+
+    for (start, end), (next_start, _) in zip(range_list, range_list[1:]):
+        assert end == next_start
+        assert end - start >= riptube.MIN_SEGMENT_SIZE - \
+            riptube.DIRECT_IO_ALIGNMENT
+        assert start % riptube.DIRECT_IO_ALIGNMENT == 0
+
+def cache_options(expire_time= None):
+    url = "http://example.com/media"
+
+    if expire_time is not None:
+        url += "?expire={}".format(int(expire_time))
+
+    return (riptube.DownloadInfo(riptube.ITAG_MAP[22], url),)
+
+def test_download_info_cache_ttl():
+    cache = riptube.DownloadInfoCache(ttl= 60)
+    cache.put("a", cache_options())
+
+    assert cache.get("a") is not None
+
+    expired_cache = riptube.DownloadInfoCache(ttl= 0)
+    expired_cache.put("a", cache_options())
+
+    assert expired_cache.get("a") is None
+
+def test_download_info_cache_url_expiry():
+    cache = riptube.DownloadInfoCache(ttl= 3600)
+
+    # URLs which expire within the margin aren't used.
+    cache.put("a", cache_options(
+        time.time() + riptube.URL_EXPIRY_MARGIN - 10
+    ))
+    cache.put("b", cache_options(
+        time.time() + riptube.URL_EXPIRY_MARGIN + 600
+    ))
+
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+
+def test_download_info_cache_drops_the_least_recently_used():
+    cache = riptube.DownloadInfoCache(max_size= 2)
+    cache.put("a", cache_options())
+    cache.put("b", cache_options())
+    cache.get("a")
+    cache.put("c", cache_options())
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+
+def test_dash_document():
+    size_dict = {133: 1000, 140: 5000}
+    document_data = benchmark.make_dash_document(
+        "http://example.com",
+        "abcdefghijk",
+        (133, 140),
+        size_dict,
+        3
+    )
+
+    option_list = list(riptube.download_options_from_dash_xml(document_data))
+
+    assert [option.media_type.itag for option in option_list] == [133, 140]
+    assert [option.content_length for option in option_list] == [1000, 5000]
+    assert option_list[0].url == "http://example.com/media/abcdefghijk/133"
+    assert option_list[1].bits_per_second() == 5000 * 8 // 60
+
+def test_dash_content_length_from_segments():
+    document_data = (
+        b'<MPD xmlns="urn:mpeg:DASH:schema:MPD:2011"><Period><AdaptationSet>'
+        b'<Representation id="140" bandwidth="128000">'
+        b'<BaseURL>http://example.com/140</BaseURL>'
+        b'<SegmentList>'
+        b'<SegmentURL media="sq/0" mediaRange="0-999"/>'
+        b'<SegmentURL media="sq/1" mediaRange="1000-2499"/>'
+        b'</SegmentList>'
+        b'</Representation>'
+        b'<Representation id="133" bandwidth="256000">'
+        b'<BaseURL>http://example.com/133</BaseURL>'
+        b'</Representation>'
+        b'</AdaptationSet></Period></MPD>'
+    )
+
+    option_list = list(riptube.download_options_from_dash_xml(document_data))
+
+    assert [option.content_length for option in option_list] == [2500, None]
+
+def check_segment_hashes(filename, hash_json):
+    assert hash_json["size"] == os.path.getsize(filename)
+
+    for start, end, hex_digest in hash_json["segments"]:
+        hasher = hashlib.new(hash_json["algorithm"])
+        riptube.hash_file_range(filename, start, end, hasher)
+
+        assert hasher.hexdigest() == hex_digest
+
+def test_interrupted_download_resumes(stand_in_server, tmp_path):
+    size = riptube.MIN_SEGMENT_SIZE * 4
+    server = stand_in_server(size= size)
+    url = "{}/media/{}/22".format(
+        server.host,
+        benchmark.stand_in_video_id(0)
+    )
+    filename = str(tmp_path / "video.mp4")
+    transfer_options = riptube.TransferOptions(segment_count= 4)
+
+    # Every response stops part of the way through its segment.
+    server.cut_after = riptube.MIN_SEGMENT_SIZE // 2
+
+    with pytest.raises(http.client.IncompleteRead):
+        riptube.download_to_file(url, filename, transfer_options, itag= 22)
+
+    assert not os.path.exists(filename)
+    assert os.path.exists(filename + ".part")
+    assert os.path.exists(filename + ".resume")
+
+    partial = riptube.PartialDownload.load(filename)
+
+    assert len(partial.range_list) == 4
+    assert 0 < partial.bytes_done < size
+
+    server.cut_after = None
+    byte_count = server.byte_count
+
+    hash_json = riptube.download_to_file(
+        url,
+        filename,
+        transfer_options,
+        itag= 22
+    )
+
+    with open(filename, "rb") as video_file:
+        assert video_file.read() == server.media_dict[None]
+
+    # Only the rest of each segment was downloaded again.
+    assert server.byte_count - byte_count == size - partial.bytes_done
+    assert len(hash_json["segments"]) == 4
+    check_segment_hashes(filename, hash_json)
+
+    # A finished download isn't downloaded again.
+    byte_count = server.byte_count
+
+    assert riptube.download_to_file(
+        url,
+        filename,
+        transfer_options,
+        itag= 22
+    ) == hash_json
+    assert server.byte_count == byte_count
+
+    riptube.remove_download_state(filename)
+
+    assert not os.path.exists(filename + ".resume")
+
+def test_resume_with_a_new_itag_starts_again(stand_in_server, tmp_path):
+    server = stand_in_server(size= riptube.MIN_SEGMENT_SIZE * 2)
+    url = "{}/media/{}/22".format(
+        server.host,
+        benchmark.stand_in_video_id(0)
+    )
+    filename = str(tmp_path / "video.mp4")
+    transfer_options = riptube.TransferOptions(segment_count= 2)
+
+    server.cut_after = riptube.MIN_SEGMENT_SIZE // 2
+
+    with pytest.raises(http.client.IncompleteRead):
+        riptube.download_to_file(url, filename, transfer_options, itag= 22)
+
+    server.cut_after = None
+
+    hash_json = riptube.download_to_file(
+        url,
+        filename,
+        transfer_options,
+        itag= 18
+    )
+
+    with open(filename, "rb") as video_file:
+        assert video_file.read() == server.media_dict[None]
+
+    check_segment_hashes(filename, hash_json)
+
+def test_stale_downloads_are_removed(stand_in_server, tmp_path):
+    server = stand_in_server(size= riptube.MIN_SEGMENT_SIZE * 2)
+    url = "{}/media/{}/22".format(
+        server.host,
+        benchmark.stand_in_video_id(0)
+    )
+    feed_item = riptube.FeedItem(
+        benchmark.stand_in_video_id(0),
+        riptube.datetime.datetime(2013, 5, 6),
+        "A video",
+        "A description"
+    )
+    transfer_options = riptube.TransferOptions(segment_count= 2)
+
+    def feed_item_download(*itag_list):
+        content = tuple(
+            riptube.DownloadInfo(riptube.ITAG_MAP[itag], url)
+            for itag in itag_list
+        )
+
+        return riptube.FeedItemDownload(
+            feed_item,
+            str(tmp_path),
+            content if len(content) > 1 else content[0]
+        )
+
+    # Separate mp4 tracks are picked first, and the download stops.
+    track_download = feed_item_download(135, 140)
+    server.cut_after = riptube.MIN_SEGMENT_SIZE // 2
+
+    with pytest.raises(http.client.IncompleteRead):
+        riptube.fetch_feed_item(track_download, transfer_options)
+
+    assert all(
+        os.path.exists(track_filename + ".resume")
+        for track_filename in track_download.track_filename_list
+    )
+
+    # Then one webm file is picked in the next run.
+    server.cut_after = None
+    video_download = feed_item_download(43)
+    riptube.fetch_feed_item(video_download, transfer_options)
+    riptube.remove_download_state(video_download.video_filename)
+
+    assert os.listdir(str(tmp_path)) \
+        == [os.path.basename(video_download.video_filename)]
+
+    # A single mp4 file is picked, and then separate tracks, which are
+    # joined into a file with the same name.
+    video_download = feed_item_download(22)
+    server.cut_after = riptube.MIN_SEGMENT_SIZE // 2
+
+    with pytest.raises(http.client.IncompleteRead):
+        riptube.fetch_feed_item(video_download, transfer_options)
+
+    server.cut_after = None
+    track_download = feed_item_download(135, 140)
+    riptube.fetch_feed_item(track_download, transfer_options)
+
+    assert not os.path.exists(video_download.video_filename + ".part")
+    assert not os.path.exists(video_download.video_filename + ".resume")
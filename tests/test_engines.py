@@ -0,0 +1,147 @@
+import subprocess
+import sys
+
+import pytest
+
+import benchmark
+import riptube
+
+pytestmark = pytest.mark.skipif(
+    "asyncio" not in riptube.ENGINE_LIST,
+    reason= "The asyncio engine needs Python 3.7"
+)
+
+def test_asyncio_engine_downloads_an_archive(stand_in_server, tmp_path):
+    stand_in_server(video_count= 3)
+    output_directory = str(tmp_path)
+    catalog = riptube.ArchiveCatalog.for_output_directory(output_directory)
+
+    riptube.download_videos_for_user(
+        benchmark.STAND_IN_USERNAME,
+        output_directory,
+        jobs= 2,
+        engine= "asyncio",
+        catalog= catalog,
+        retry_budget= 1
+    )
+
+    result_list = list(riptube.verify_archive(output_directory, jobs= 1))
+
+    assert len(result_list) == 3
+    assert all(not problem_list for _, problem_list, _ in result_list)
+    assert all(
+        catalog.is_archived(benchmark.stand_in_video_id(index))
+        for index in range(3)
+    )
+
+def test_asyncio_engine_rejects_thread_transfer_options(tmp_path):
+    with pytest.raises(ValueError):
+        riptube.download_videos_for_user(
+            benchmark.STAND_IN_USERNAME,
+            str(tmp_path),
+            engine= "asyncio",
+            transfer_options= riptube.TransferOptions(segment_count= 4)
+        )
+
+def test_asyncio_engine_rejects_bandwidth_limits(tmp_path, monkeypatch):
+    with pytest.raises(ValueError):
+        riptube.download_videos_for_user(
+            benchmark.STAND_IN_USERNAME,
+            str(tmp_path),
+            engine= "asyncio",
+            transfer_options= riptube.TransferOptions(
+                max_download_rate= 1024
+            )
+        )
+
+    monkeypatch.setattr(riptube.BANDWIDTH_GOVERNOR, "max_rate", 1024)
+
+    with pytest.raises(ValueError):
+        riptube.download_videos_for_user(
+            benchmark.STAND_IN_USERNAME,
+            str(tmp_path),
+            engine= "asyncio"
+        )
+
+@pytest.mark.parametrize("option_list", [
+    ["--max-bandwidth", "1M"],
+    ["--max-download-bandwidth", "1M"],
+    ["--bandwidth-schedule", "08:00=1M"],
+    ["--segments", "4"],
+    ["--stream-mux"],
+    ["--sync-every", "4"],
+])
+def test_asyncio_engine_rejects_thread_options(option_list, tmp_path):
+    process = subprocess.run(
+        [sys.executable, riptube.__file__, "--engine", "asyncio"]
+        + option_list
+        + ["someone", str(tmp_path)],
+        stdout= subprocess.PIPE,
+        stderr= subprocess.PIPE
+    )
+
+    assert process.returncode == 2
+    assert b"only works with the threads engine" in process.stderr
+
+def test_asyncio_engine_waits_for_the_rate_controller(stand_in_server,
+tmp_path, monkeypatch):
+    import riptube_async
+
+    stand_in_server(video_count= 1)
+    rate_controller = riptube.RateController(max_rate= 5.0, burst= 1)
+    monkeypatch.setattr(riptube_async, "RATE_CONTROLLER", rate_controller)
+
+    riptube.download_videos_for_user(
+        benchmark.STAND_IN_USERNAME,
+        str(tmp_path),
+        engine= "asyncio",
+        retry_budget= 1
+    )
+
+    # The feed, the info, the manifests and the video are at least five
+    # requests, and only the first one can be made without waiting.
+    assert rate_controller.wait_time >= 0.5
+    assert rate_controller.rate("127.0.0.1") == 5.0
+
+def test_asyncio_engine_reuses_connections(stand_in_server):
+    import asyncio
+    import riptube_async
+
+    server = stand_in_server()
+    url = "{}/media/{}/22".format(server.host, benchmark.stand_in_video_id(0))
+    pool = riptube_async.ASYNC_HTTP_POOL
+    open_count = pool.open_count
+
+    async def read_twice():
+        try:
+            return [
+                await riptube_async.async_read_url(url)
+                for index in range(2)
+            ]
+        finally:
+            pool.close()
+
+    assert asyncio.run(read_twice()) == [server.media_dict[None]] * 2
+    assert pool.open_count - open_count == 1
+
+def test_asyncio_engine_limits_connections_per_host(stand_in_server,
+monkeypatch):
+    import asyncio
+    import riptube_async
+
+    server = stand_in_server()
+    url = "{}/media/{}/22".format(server.host, benchmark.stand_in_video_id(0))
+    pool = riptube_async.AsyncConnectionPool(max_connections_per_host= 2)
+    monkeypatch.setattr(riptube_async, "ASYNC_HTTP_POOL", pool)
+
+    async def read_many():
+        try:
+            return await asyncio.gather(*[
+                riptube_async.async_read_url(url)
+                for index in range(6)
+            ])
+        finally:
+            pool.close()
+
+    assert asyncio.run(read_many()) == [server.media_dict[None]] * 6
+    assert pool.open_count == 2
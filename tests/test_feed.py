@@ -0,0 +1,171 @@
+import pytest
+
+import benchmark
+import riptube
+
+def chunks(data, size):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+def feed_json(feed_item_seq):
+    return [feed_item.to_json() for feed_item in feed_item_seq]
+
+@pytest.mark.parametrize("with_total", [False, True])
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024, 1024 * 1024])
+def test_incremental_feed_parser_matches_json_loads(with_total, chunk_size):
+    page_data = benchmark.make_feed_page(
+        1,
+        riptube.MAX_RESULTS,
+        120,
+        with_total
+    )
+    whole_total_list = []
+    total_list = []
+
+    whole_item_list = riptube.feed_items_from_page_data(
+        page_data,
+        whole_total_list.append
+    )
+    item_list = list(riptube.iter_feed_page(
+        chunks(page_data, chunk_size),
+        total_list.append
+    ))
+
+    assert len(item_list) == riptube.MAX_RESULTS
+    assert feed_json(item_list) == feed_json(whole_item_list)
+    assert total_list == whole_total_list == ([120] if with_total else [])
+
+def test_empty_feed_page():
+    page_data = benchmark.make_feed_page(121, riptube.MAX_RESULTS, 120, True)
+    total_list = []
+
+    assert list(riptube.iter_feed_page([page_data], total_list.append)) \
+        == []
+    assert riptube.feed_items_from_page_data(page_data) == ()
+    assert total_list == [120]
+
+def test_parse_feed_time():
+    assert riptube.parse_feed_time("2013-01-01T05:06:07.000Z") \
+        == riptube.datetime.datetime(2013, 1, 1, 5, 6, 7)
+    # Other formats fall back to strptime.
+    with pytest.raises(ValueError):
+        riptube.parse_feed_time("2013-01-01 05:06:07")
+
+@pytest.mark.parametrize("whole_page_size", [0, 1024 * 1024])
+@pytest.mark.parametrize("prefetch", [0, 1, 3])
+def test_user_videos_reads_every_page(stand_in_server, monkeypatch,
+whole_page_size, prefetch):
+    stand_in_server(video_count= 120)
+    monkeypatch.setattr(riptube, "FEED_WHOLE_PAGE_SIZE", whole_page_size)
+
+    video_id_list = [
+        feed_item.video_id
+        for feed_item in riptube.user_videos(
+            benchmark.STAND_IN_USERNAME,
+            prefetch
+        )
+    ]
+
+    assert video_id_list == [
+        benchmark.stand_in_video_id(index)
+        for index in range(120)
+    ]
+
+class FakePageDownload (object):
+    """
+    This stands in for FeedPageDownload, for a feed of 'page_count' full
+    pages, and counts the pages which were started.
+    """
+    page_count = 10
+    started_list = []
+
+    def __init__(self, feed_url):
+        self.started_list.append(feed_url)
+
+    def total_results(self):
+        return self.page_count * riptube.MAX_RESULTS
+
+    def __len__(self):
+        return riptube.MAX_RESULTS
+
+@pytest.mark.parametrize("prefetch", [0, 1, 3])
+def test_feed_pages_prefetch(monkeypatch, prefetch):
+    monkeypatch.setattr(FakePageDownload, "started_list", [])
+    monkeypatch.setattr(riptube, "FeedPageDownload", FakePageDownload)
+
+    page_count = 0
+
+    for page in riptube.feed_pages("someone", prefetch):
+        page_count += 1
+        ahead_count = len(FakePageDownload.started_list) - page_count
+
+        assert ahead_count \
+            == min(prefetch, FakePageDownload.page_count - page_count)
+
+    assert page_count == FakePageDownload.page_count
+
+def test_feed_pages_fan_out_by_default(monkeypatch):
+    monkeypatch.setattr(FakePageDownload, "started_list", [])
+    monkeypatch.setattr(riptube, "FeedPageDownload", FakePageDownload)
+
+    page_iter = riptube.feed_pages("someone")
+    next(page_iter)
+
+    # The first page and more than one of the pages after it are started
+    # before the first page is used.
+    assert len(FakePageDownload.started_list) > 2
+    assert len(FakePageDownload.started_list) \
+        <= riptube.HTTP_POOL.max_connections_per_host + 1
+    assert len(list(page_iter)) == FakePageDownload.page_count - 1
+
+@pytest.mark.skipif(
+    "asyncio" not in riptube.ENGINE_LIST,
+    reason= "The asyncio engine needs Python 3.7"
+)
+@pytest.mark.parametrize("prefetch", [0, 1, 3])
+def test_feed_pages_async_prefetch(monkeypatch, prefetch):
+    import asyncio
+    import riptube_async
+
+    page_count = 10
+    started_list = []
+
+    async def download_page(feed_url):
+        started_list.append(feed_url)
+
+        return (
+            page_count * riptube.MAX_RESULTS,
+            (None,) * riptube.MAX_RESULTS
+        )
+
+    async def download_entries(feed_url):
+        return (await download_page(feed_url))[1]
+
+    monkeypatch.setattr(
+        riptube_async,
+        "download_video_feed_with_total_async",
+        download_page
+    )
+    monkeypatch.setattr(
+        riptube_async,
+        "download_video_feed_async",
+        download_entries
+    )
+
+    async def read_pages():
+        used_count = 0
+
+        async for entry_list in riptube_async.feed_pages_async(
+            "someone",
+            prefetch
+        ):
+            used_count += 1
+
+            # Let the tasks for the pages ahead start.
+            await asyncio.sleep(0)
+
+            assert len(started_list) - used_count \
+                == min(prefetch, page_count - used_count)
+
+        return used_count
+
+    assert asyncio.run(read_pages()) == page_count
@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+import benchmark
+import riptube
+
+def media_url(server, itag):
+    return "{}/media/{}/{}".format(
+        server.host,
+        benchmark.stand_in_video_id(0),
+        itag
+    )
+
+def test_reserved_connections_skip_the_limit(stand_in_server, monkeypatch):
+    server = stand_in_server()
+    monkeypatch.setattr(riptube.HTTP_POOL, "max_connections_per_host", 1)
+
+    with riptube.browser_spoof_open(media_url(server, 22)) as first_conn:
+        with riptube.browser_spoof_open(
+            media_url(server, 22),
+            reserved= True
+        ) as second_conn:
+            assert second_conn.read() == server.media_dict[None]
+
+        assert first_conn.read() == server.media_dict[None]
+
+@pytest.mark.skipif(
+    not riptube.STREAM_MUX_SUPPORTED,
+    reason= "Streaming into ffmpeg isn't supported here"
+)
+def test_stream_mux_with_one_connection_per_host(stand_in_server,
+fake_ffmpeg, tmp_path, monkeypatch):
+    # The tracks are much bigger than a pipe buffer, so the video track
+    # can't be written until the audio track has been read.
+    server = stand_in_server(size= 1024 * 1024 * 2)
+    monkeypatch.setattr(riptube.HTTP_POOL, "max_connections_per_host", 1)
+
+    output_filename = str(tmp_path / "output.mp4")
+    track_hash_list = []
+    result_list = []
+
+    thread = threading.Thread(target= lambda: result_list.append(
+        riptube.stream_mux_to_file(
+            media_url(server, 137),
+            media_url(server, 140),
+            output_filename,
+            track_hash_list= track_hash_list
+        )
+    ))
+    thread.daemon = True
+    thread.start()
+    thread.join(30)
+
+    assert not thread.is_alive(), "stream_mux_to_file is stuck"
+    assert result_list == [True]
+
+    with open(output_filename, "rb") as output_file:
+        assert output_file.read() == server.media_dict[None] * 2
+
+    assert [hash_json["size"] for hash_json in track_hash_list] \
+        == [len(server.media_dict[None])] * 2
@@ -0,0 +1,191 @@
+import os
+import sqlite3
+
+import pytest
+
+import benchmark
+import riptube
+
+FEED_ITEM = riptube.FeedItem(
+    "abcdefghijk",
+    riptube.datetime.datetime(2013, 5, 6, 7, 8, 9),
+    "A video",
+    "A description"
+)
+
+def catalog_filenames(catalog):
+    connection = sqlite3.connect(catalog.filename)
+
+    try:
+        return sorted(connection.execute(
+            "SELECT video_id, video_filename, json_filename FROM video"
+        ))
+    finally:
+        connection.close()
+
+@pytest.mark.parametrize("layout, directory_list", [
+    ("flat", []),
+    ("prefix", ["ab"]),
+    ("date", ["2013", "05"]),
+])
+def test_layout_directory(layout, directory_list):
+    assert riptube.layout_directory(
+        "user",
+        riptube.base_filename_for_feed_item(FEED_ITEM),
+        layout
+    ) == os.path.join("user", *directory_list)
+
+def test_archive_check_looks_in_every_layout_until_migrated(tmp_path,
+monkeypatch):
+    user_directory = str(tmp_path)
+    checked_list = []
+    exists = os.path.exists
+    monkeypatch.setattr(
+        riptube.os.path,
+        "exists",
+        lambda filename: checked_list.append(filename)
+    )
+
+    assert not riptube.is_feed_item_archived(FEED_ITEM, user_directory)
+    assert len(checked_list) == len(riptube.DIRECTORY_LAYOUTS)
+
+    monkeypatch.setattr(riptube.os.path, "exists", exists)
+    riptube.set_directory_layout(user_directory, "date")
+    monkeypatch.setattr(
+        riptube.os.path,
+        "exists",
+        lambda filename: checked_list.append(filename)
+    )
+    del checked_list[:]
+
+    assert not riptube.is_feed_item_archived(
+        FEED_ITEM,
+        user_directory,
+        layout= "date"
+    )
+    assert checked_list == list(riptube.json_filenames_for_feed_item(
+        FEED_ITEM,
+        user_directory,
+        ("date",)
+    ))
+
+    del checked_list[:]
+
+    # The directory isn't in the flat layout, so every layout is used.
+    assert not riptube.is_feed_item_archived(FEED_ITEM, user_directory)
+    assert len(checked_list) == len(riptube.DIRECTORY_LAYOUTS)
+
+    del checked_list[:]
+
+    assert not riptube.is_feed_item_archived(
+        FEED_ITEM,
+        user_directory,
+        layout= "date",
+        any_layout= True
+    )
+    assert len(checked_list) == len(riptube.DIRECTORY_LAYOUTS)
+
+    del checked_list[:]
+
+    assert not riptube.is_feed_item_archived(
+        FEED_ITEM,
+        user_directory,
+        any_layout= False
+    )
+    assert len(checked_list) == 1
+
+def test_prepare_user_directory(tmp_path):
+    user_directory = str(tmp_path / "user")
+
+    riptube.prepare_user_directory(user_directory, "prefix")
+
+    assert riptube.directory_layout(user_directory) == "prefix"
+
+    riptube.prepare_user_directory(user_directory, "prefix")
+
+    assert riptube.directory_layout(user_directory) == "prefix"
+
+    # Adding videos in another layout mixes the layouts.
+    riptube.prepare_user_directory(user_directory, "date")
+
+    assert riptube.directory_layout(user_directory) is None
+
+def test_migrate_layout(stand_in_server, tmp_path):
+    server = stand_in_server(video_count= 4)
+    output_directory = str(tmp_path)
+    user_directory = os.path.join(
+        output_directory,
+        benchmark.STAND_IN_USERNAME
+    )
+    catalog = riptube.ArchiveCatalog.for_output_directory(output_directory)
+
+    riptube.download_videos_for_user(
+        benchmark.STAND_IN_USERNAME,
+        output_directory,
+        catalog= catalog,
+        retry_budget= 1
+    )
+
+    assert riptube.migrate_layout(user_directory, "prefix", catalog) == 4
+    assert sorted(os.listdir(user_directory)) \
+        == [riptube.LAYOUT_FILENAME, "be"]
+    assert riptube.directory_layout(user_directory) == "prefix"
+
+    json_filename_list = list(
+        riptube.archive_json_filenames(output_directory)
+    )
+
+    assert len(json_filename_list) == 4
+    assert all(
+        riptube.verify_json_file(json_filename)[1] == []
+        for json_filename in json_filename_list
+    )
+
+    # The moved videos are found without the catalog in the new layout, so
+    # nothing is downloaded again.
+    byte_count = server.byte_count
+
+    riptube.download_videos_for_user(
+        benchmark.STAND_IN_USERNAME,
+        output_directory,
+        retry_budget= 1,
+        layout= "prefix"
+    )
+
+    assert server.byte_count - byte_count < 1024 * 16
+
+    # Migrating back to the old layout also works.
+    assert riptube.migrate_layout(user_directory, "flat", catalog) == 4
+
+    # An import puts the same filenames in the catalog as the migration did.
+    migrated_row_list = catalog_filenames(catalog)
+    catalog.import_directory(output_directory)
+
+    assert catalog_filenames(catalog) == migrated_row_list
+
+def test_unmigrated_videos_are_found_without_the_catalog(stand_in_server,
+tmp_path):
+    server = stand_in_server(video_count= 2)
+    output_directory = str(tmp_path)
+
+    riptube.download_videos_for_user(
+        benchmark.STAND_IN_USERNAME,
+        output_directory,
+        retry_budget= 1
+    )
+
+    byte_count = server.byte_count
+
+    # The directory isn't in the date layout, so the videos are looked
+    # for in the others.
+    riptube.download_videos_for_user(
+        benchmark.STAND_IN_USERNAME,
+        output_directory,
+        retry_budget= 1,
+        layout= "date"
+    )
+
+    assert server.byte_count - byte_count < 1024 * 16
+    assert riptube.directory_layout(
+        os.path.join(output_directory, benchmark.STAND_IN_USERNAME)
+    ) is None
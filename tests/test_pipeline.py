@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+import riptube
+
+def test_stage_passes_every_item_on():
+    done_list = []
+    stage = riptube.PipelineStage("test", done_list.append, 2)
+
+    for index in range(20):
+        stage.put(index)
+
+    stage.close()
+
+    assert sorted(done_list) == list(range(20))
+
+def test_stage_raises_the_first_exception():
+    def fail(item):
+        raise ValueError(item)
+
+    stage = riptube.PipelineStage("test", fail)
+    stage.put(1)
+
+    with pytest.raises(ValueError):
+        stage.close()
+
+def test_cancelled_stage_drops_waiting_items():
+    started_event = threading.Event()
+    release_event = threading.Event()
+    done_list = []
+
+    def work(item):
+        started_event.set()
+        release_event.wait()
+        done_list.append(item)
+
+        raise ValueError(item)
+
+    stage = riptube.PipelineStage("test", work, 1, 10)
+    stage.put(0)
+    started_event.wait()
+
+    for index in range(1, 5):
+        stage.put(index)
+
+    stage.cancel()
+    stage.put(5)
+    release_event.set()
+
+    # The item which was started is finished, and its exception isn't
+    # raised for a cancelled stage.
+    stage.close()
+
+    assert done_list == [0]
+    assert stage.depth == 0
+
+def test_interrupt_drops_queued_videos(tmp_path, monkeypatch):
+    feed_item_list = [
+        riptube.FeedItem(
+            "video{:06d}".format(index),
+            riptube.datetime.datetime(2013, 5, 6),
+            "A video",
+            "A description"
+        )
+        for index in range(3)
+    ]
+    prepared_list = []
+
+    def user_videos(username, prefetch):
+        for feed_item in feed_item_list:
+            yield feed_item
+
+        raise KeyboardInterrupt
+
+    def prepare_feed_item(feed_item, *args):
+        prepared_list.append(feed_item)
+        time.sleep(0.2)
+
+    monkeypatch.setattr(riptube, "user_videos", user_videos)
+    monkeypatch.setattr(riptube, "prepare_feed_item", prepare_feed_item)
+
+    with pytest.raises(KeyboardInterrupt):
+        riptube.download_videos_for_users(["someone"], str(tmp_path))
+
+    # The first video was being downloaded when the second one was queued,
+    # and the second one was being downloaded when the third was queued.
+    assert prepared_list == feed_item_list[:2]
@@ -0,0 +1,91 @@
+import json
+import os
+
+import pytest
+
+import benchmark
+import riptube
+
+def download_info(itag, length_seconds= 600):
+    return riptube.DownloadInfo(
+        riptube.ITAG_MAP[itag],
+        "http://example.com/%d" % itag,
+        length_seconds
+    )
+
+def itags(content):
+    if isinstance(content, tuple):
+        return tuple(option.media_type.itag for option in content)
+
+    return content.media_type.itag
+
+OPTION_LIST = [
+    download_info(itag)
+    for itag in (5, 18, 22, 37, 43, 46, 133, 134, 135, 137, 139, 140, 171)
+]
+
+def test_default_picks_the_best_quality():
+    assert itags(riptube.highest_quality_content(OPTION_LIST)) == 46
+
+def test_preferred_formats_come_first():
+    policy = riptube.SelectionPolicy(preferred_formats= ("mp4",))
+
+    assert itags(riptube.highest_quality_content(OPTION_LIST, policy)) \
+        == 37
+
+def test_max_height_limits_the_video():
+    policy = riptube.SelectionPolicy(
+        max_height= 720,
+        preferred_formats= ("mp4",)
+    )
+
+    assert itags(riptube.highest_quality_content(OPTION_LIST, policy)) \
+        == 22
+
+@pytest.mark.parametrize("policy_kwargs", [
+    {"max_height": 100},
+    {"max_video_bitrate": 0.01},
+    {"max_height": 100, "max_video_bitrate": 0.01, "max_size": 10},
+])
+def test_too_strict_limits_pick_the_smallest_content(policy_kwargs):
+    policy = riptube.SelectionPolicy(**policy_kwargs)
+
+    assert not policy.satisfied(OPTION_LIST)
+
+    content = riptube.highest_quality_content(OPTION_LIST, policy)
+
+    assert itags(content) == (133, 139)
+
+def test_satisfied_by_the_best_allowed_video():
+    policy = riptube.SelectionPolicy(
+        max_height= 720,
+        preferred_formats= ("mp4",)
+    )
+
+    assert policy.satisfied([download_info(22), download_info(18)])
+    assert not policy.satisfied([download_info(18)])
+
+@pytest.mark.parametrize("engine", riptube.ENGINE_LIST)
+def test_engines_pick_the_same_content_under_a_max_size(stand_in_server,
+fake_ffmpeg, tmp_path, engine):
+    stand_in_server(video_count= 1)
+    output_directory = str(tmp_path / "output")
+    os.mkdir(output_directory)
+
+    riptube.download_videos_for_user(
+        benchmark.STAND_IN_USERNAME,
+        output_directory,
+        engine= engine,
+        retry_budget= 1,
+        policy= riptube.SelectionPolicy(max_size= 1024 * 1024 * 8)
+    )
+
+    json_filename, = riptube.archive_json_filenames(output_directory)
+
+    with open(json_filename) as json_file:
+        item_json = json.load(json_file)
+
+    assert [
+        content_json["media_type"]["itag"]
+        for content_json in item_json["content"]
+    ] == [135, 140]